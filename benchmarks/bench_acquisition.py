@@ -0,0 +1,71 @@
+"""
+Speed and accuracy of the EI kernels of minimint.acquisition.
+
+Compares expected_improvement (with its gradients) against the previous
+scipy.stats.norm.cdf/pdf formula for an increasing number of candidates,
+and checks that log_expected_improvement matches the log of EI where EI
+does not underflow and stays finite where it does.  Run from the
+repository root:
+
+    python -m benchmarks.bench_acquisition [repeats]
+"""
+import sys
+import time
+
+import numpy as np
+import scipy.stats as sps
+
+from minimint import acquisition
+
+def stats_ei(best, func_m, func_s):
+    # The previous implementation.
+    u    = (best - func_m) / func_s
+    ncdf = sps.norm.cdf(u)
+    npdf = sps.norm.pdf(u)
+    return func_s*(u*ncdf + npdf), -ncdf, npdf
+
+def timed(func, repeats, *args):
+    t_init = time.time()
+    for i in range(repeats):
+        out = func(*args)
+    return (time.time() - t_init)/repeats, out
+
+def main(repeats=20):
+    rs = np.random.RandomState(0)
+    print('%9s %11s %11s %8s %10s' % ('M', 'stats [ms]', 'special [ms]',
+                                      'speedup', 'max err'))
+    for M in [1000, 10000, 100000, 1000000]:
+        func_m = rs.randn(M)
+        func_s = 0.1 + rs.rand(M)
+
+        (t_stats, ref) = timed(stats_ei, repeats, 0.0, func_m, func_s)
+        (t_special, out) = timed(acquisition.expected_improvement, repeats,
+                                 0.0, func_m, func_s, True)
+
+        err = max(np.max(np.abs(a - b)) for (a, b) in zip(ref, out))
+        if err > 1e-12:
+            raise Exception("EI kernels differ: %g" % err)
+
+        print('%9d %11.2f %11.2f %8.1f %10.1e' % (M, 1e3*t_stats,
+                                                  1e3*t_special,
+                                                  t_stats/t_special, err))
+
+    # Far from the best, EI underflows while log EI keeps a slope.
+    func_m = np.array([0.0, 5.0, 30.0, 1e3, 1e6])
+    ei     = acquisition.expected_improvement(0.0, func_m, 1.0)
+    (log_ei, g_m, g_s) = acquisition.log_expected_improvement(0.0, func_m,
+                                                              1.0, True)
+    if not (np.all(np.isfinite(log_ei)) and np.all(g_m < 0) and np.all(g_s > 0)):
+        raise Exception("log EI is not finite with a slope")
+    finite = ei > 0
+    if np.max(np.abs(log_ei[finite] - np.log(ei[finite]))) > 1e-10:
+        raise Exception("log EI differs from the log of EI")
+
+    print('')
+    print('%9s %11s %11s %11s' % ('mean', 'EI', 'log EI', 'dlogEI/dm'))
+    for i in range(func_m.shape[0]):
+        print('%9.0e %11.3e %11.4g %11.4g' % (func_m[i], ei[i], log_ei[i],
+                                              g_m[i]))
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
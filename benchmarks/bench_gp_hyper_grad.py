@@ -0,0 +1,78 @@
+"""
+Benchmark and gradient check of the hyperparameter gradient of
+gp.GP.optimize_hypers.
+
+Compares the elementwise-sum gradient with the previous per-dimension
+trace(jacobian*dK/dls) products for an increasing number of points N, and
+checks the gradient against finite differences.  Run from the repository
+root:
+
+    python -m benchmarks.bench_gp_hyper_grad [D]
+"""
+import sys
+import time
+
+import numpy as np
+import scipy.linalg as spla
+
+from minimint import gp
+
+def trace_grad(comp, diffs, amp2, noise, ls):
+    # The previous implementation, with the length scale gradients as
+    # traces of matrix products, one per dimension.
+    kern    = gp.Kernel('Matern52', ls, comp)
+    covmat  = (amp2 * (kern.cov + 1e-6*np.eye(comp.shape[0]))
+               + noise * np.eye(comp.shape[0]))
+    chol    = spla.cholesky(covmat, lower=True)
+    solve   = spla.cho_solve((chol, True), diffs)
+    inv_cov = spla.cho_solve((chol, True), np.eye(chol.shape[0]))
+
+    jacobian  = np.outer(solve, solve) - inv_cov
+    grad_corr = kern.grad_ls()
+
+    grad = np.zeros(ls.shape[0] + 2)
+    grad[0] = 0.5 * np.trace(np.dot(jacobian, kern.cov + 1e-6*np.eye(chol.shape[0]))) * amp2
+    grad[1] = 0.5 * np.trace(np.dot(jacobian, np.eye(chol.shape[0]))) * noise
+    for dd in range(ls.shape[0]):
+        grad[dd+2] = 0.5 * np.trace(np.dot(jacobian, amp2*grad_corr[:,:,dd])) * ls[dd]
+    return -grad
+
+def main(D=10):
+    rs = np.random.RandomState(0)
+    print('D = %d' % D)
+    print('%8s %12s %12s %10s %12s' % ('N', 't_trace [s]', 't_sum [s]',
+                                       'speedup', 'grad check'))
+    for N in [100, 250, 500, 1000]:
+        comp  = rs.rand(N, D)
+        vals  = np.sin(3*comp).sum(1) + 0.1*rs.randn(N)
+        diffs = vals - np.mean(vals)
+
+        mygp = gp.GP('Matern52')
+        mygp.real_init(D, vals)
+        mygp.ls = 0.5 + rs.rand(D)
+        hypers = np.hstack((np.log(mygp.amp2), np.log(0.01), np.log(mygp.ls)))
+
+        (nlogprob, grad_nlogprob) = mygp.hyper_objective(comp, vals)
+        nlogprob(hypers)
+
+        t_init = time.time()
+        grad_sum = grad_nlogprob(hypers)
+        t_sum = time.time() - t_init
+
+        t_init = time.time()
+        grad_trace = trace_grad(comp, diffs, mygp.amp2, 0.01, mygp.ls)
+        t_trace = time.time() - t_init
+
+        if not np.allclose(grad_sum, grad_trace):
+            raise Exception("Elementwise and trace gradients differ")
+
+        err = (mygp.check_grad_hypers(comp, vals, hypers) /
+               np.sqrt(np.sum(grad_sum**2)))
+        if err > 1e-4:
+            raise Exception("Hyperparameter gradient check failed: %g" % err)
+
+        print('%8d %12.4f %12.4f %10.1f %12.2e' % (N, t_trace, t_sum,
+                                                   t_trace/t_sum, err))
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
@@ -0,0 +1,83 @@
+"""
+Accuracy, speed and memory of the iterative solvers (gp.IterativeSolver)
+against the Cholesky factorization.
+
+For an increasing number of points N, compares the time and peak memory
+of the weights alpha, the log likelihood and the predictive variances at
+the candidates, and the errors of the iterative ones.  Past 2048 points
+the kernel matrix is no longer stored but recomputed in blocks on every
+product (see gp.KernelMatrix), so that the memory of the iterative solvers
+stays O(N).  Past max_chol points only the iterative solvers are run.  Run
+from the repository root:
+
+    python -m benchmarks.bench_iterative_solver [max_N D max_chol]
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.linalg as spla
+
+from minimint import gp
+
+def cholesky(comp, vals, cand, mean, amp2, noise, ls):
+    cov   = (amp2*(gp.Matern52(ls, comp, None) + 1e-6*np.eye(comp.shape[0])) +
+             noise*np.eye(comp.shape[0]))
+    chol  = spla.cholesky(cov, lower=True)
+    alpha = spla.cho_solve((chol, True), vals - mean)
+    lik   = -np.sum(np.log(np.diag(chol))) - 0.5*np.dot(vals - mean, alpha)
+    beta  = spla.solve_triangular(chol, amp2*gp.Matern52(ls, comp, cand),
+                                  lower=True)
+    return alpha, lik, amp2*(1+1e-6) - np.sum(beta**2, axis=0)
+
+def iterative(comp, vals, cand, mean, amp2, noise, ls):
+    solver = gp.IterativeSolver(gp.KernelMatrix(gp.Matern52, ls, comp),
+                                amp2, noise)
+    alpha  = solver.solve(vals - mean)
+    lik    = solver.loglik(vals, mean)
+    beta   = np.dot(solver.pred_factor(), amp2*gp.Matern52(ls, comp, cand))
+    return alpha, lik, amp2*(1+1e-6) - np.sum(beta**2, axis=0)
+
+def run(func, *args):
+    tracemalloc.start()
+    t_init = time.time()
+    out = func(*args)
+    t = time.time() - t_init
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (t, peak/2.0**20) + out
+
+def main(max_N=16000, D=4, max_chol=4000):
+    rs   = np.random.RandomState(0)
+    cand = rs.rand(500, D)
+    (mean, amp2, noise, ls) = (0.0, 1.0, 1e-2, 0.5*np.ones(D))
+
+    print('D = %d' % D)
+    print('%6s %9s %9s %9s %9s %10s %10s %10s' % (
+            'N', 'chol [s]', 'cg [s]', 'chol [MB]', 'cg [MB]',
+            'alpha err', 'loglik err', 'var RMSE'))
+    N = 1000
+    while N <= max_N:
+        comp = rs.rand(N, D)
+        vals = np.sin(3*comp).sum(1) + 0.1*rs.randn(N)
+
+        (t_cg, m_cg, alpha_cg, lik_cg, var_cg) = run(iterative, comp, vals,
+                                                     cand, mean, amp2, noise, ls)
+        if not np.all(np.isfinite(alpha_cg)) or not np.isfinite(lik_cg):
+            raise Exception("Iterative solvers did not converge")
+
+        if N <= max_chol:
+            (t_chol, m_chol, alpha, lik, var) = run(cholesky, comp, vals, cand,
+                                                    mean, amp2, noise, ls)
+            print('%6d %9.2f %9.2f %9.0f %9.0f %10.1e %10.1e %10.1e' % (
+                    N, t_chol, t_cg, m_chol, m_cg,
+                    np.linalg.norm(alpha - alpha_cg)/np.linalg.norm(alpha),
+                    abs(lik - lik_cg)/abs(lik),
+                    np.sqrt(np.mean((var - var_cg)**2))))
+        else:
+            print('%6d %9s %9.2f %9s %9.0f' % (N, '-', t_cg, '-', m_cg))
+        N *= 2
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
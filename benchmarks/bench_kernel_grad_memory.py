@@ -0,0 +1,55 @@
+"""
+Peak-memory benchmark of the kernel gradients w.r.t. the candidates.
+
+Compares forming the NxMxD gradients and contracting them with the NxM
+weights of the EI gradient afterwards (the previous grad_optimize_ei) with
+passing the weights to the gradient functions, which contract directly.
+Memory is measured with tracemalloc, which tracks numpy allocations.
+Run from the repository root:
+
+    python -m benchmarks.bench_kernel_grad_memory [N M D]
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from minimint import gp
+
+def peak_memory(func, *args, **kwargs):
+    tracemalloc.start()
+    t_init = time.time()
+    out = func(*args, **kwargs)
+    t = time.time() - t_init
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, t, out
+
+def dense_grad(grad_func, ls, x1, x2, weights):
+    return np.einsum('nm,nmd->md', weights, grad_func(ls, x1, x2))
+
+def main(N=2000, M=300, D=20):
+    rs      = np.random.RandomState(0)
+    obsv    = rs.rand(N, D)
+    cand    = rs.rand(M, D)
+    ls      = 0.5 + rs.rand(D)
+    weights = rs.randn(N, M)
+
+    print('N = %d  M = %d  D = %d' % (N, M, D))
+    print('%12s %14s %14s %10s %10s' % ('kernel', 'dense [MB]', 'lean [MB]',
+                                        'dense [s]', 'lean [s]'))
+    for name in ['ARDSE', 'Matern32', 'Matern52']:
+        grad_func = getattr(gp, 'grad_' + name)
+        (p_dense, t_dense, g_dense) = peak_memory(dense_grad, grad_func,
+                                                  ls, obsv, cand, weights)
+        (p_lean, t_lean, g_lean) = peak_memory(grad_func, ls, obsv, cand,
+                                               weights=weights)
+        if not np.allclose(g_dense, g_lean):
+            raise Exception("Contracted gradients differ for %s" % name)
+        print('%12s %14.1f %14.1f %10.4f %10.4f' % (name, p_dense/2.0**20,
+                                                    p_lean/2.0**20,
+                                                    t_dense, t_lean))
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
@@ -0,0 +1,54 @@
+"""
+Time of EI with pending points in GPEIChooser for the two pending
+strategies: averaging over fantasies ("fantasies") against multiplying by
+local penalizers ("penalize"), for an increasing number of pending points
+P.  Also reports the distance from the selected candidate to the nearest
+pending point, which the penalizers keep away from zero.  Run from the
+repository root:
+
+    python -m benchmarks.bench_local_penalization [N M]
+"""
+import sys
+import time
+
+import numpy as np
+
+from minimint.chooser.GPEIChooser import GPEIChooser
+
+def main(N=200, M=5000):
+    D    = 4
+    rs   = np.random.RandomState(0)
+    comp = rs.rand(N, D)
+    cand = rs.rand(M, D)
+    vals = np.sin(3*comp).sum(1) + 0.1*rs.randn(N)
+
+    print('N = %d  M = %d  D = %d, 10 hyperparameter samples, 100 fantasies'
+          % (N, M, D))
+    print('%6s %15s %15s %12s %12s' % ('P', 'fantasies [s]', 'penalize [s]',
+                                       'fant. dist', 'pen. dist'))
+    for P in [10, 50, 200, 500]:
+        pend = rs.rand(P, D)
+        times = []
+        dists = []
+        for strategy in ['fantasies', 'penalize']:
+            chooser = GPEIChooser(mcmc_iters=0, pending_samples=100,
+                                  pending_strategy=strategy)
+            chooser._real_init(D, vals)
+            hyper_samples = [(chooser.mean, 1e-3, chooser.amp2,
+                              (0.4 + 0.02*i)*np.ones(D)) for i in range(10)]
+
+            np.random.seed(0)
+            t_init = time.time()
+            ei = chooser.ei_over_hypers(comp, pend, cand, vals, hyper_samples)
+            times.append(time.time() - t_init)
+
+            if not np.all(np.isfinite(ei)):
+                raise Exception("EI with %s is not finite" % strategy)
+            best = cand[np.argmax(np.mean(ei, axis=1))]
+            dists.append(np.min(np.sqrt(np.sum((pend - best)**2, axis=1))))
+
+        print('%6d %15.2f %15.2f %12.3f %12.3f' % ((P,) + tuple(times) +
+                                                   tuple(dists)))
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
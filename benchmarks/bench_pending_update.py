@@ -0,0 +1,88 @@
+"""
+Time of the Cholesky factor of the complete and pending points in the
+exact posterior of GPEIChooser with pending points: factoring their joint
+(N+P)x(N+P) covariance, as before, against extending the cached factor of
+the complete points with a Schur complement block for the pending ones.
+
+Both factors, and the predictive means and covariances of the pending
+points, are compared.  Run from the repository root:
+
+    python -m benchmarks.bench_pending_update [N D]
+"""
+import sys
+import time
+
+import numpy as np
+import scipy.linalg as spla
+
+from minimint import gp
+from minimint.chooser.GPEIChooser import GPEIChooser
+
+def full(chooser, comp, pend, vals, hyper):
+    # The previous implementation.
+    (mean, noise, amp2, ls) = hyper
+    obsv = np.concatenate((comp, pend))
+    cov  = (amp2*(chooser.cov_func(ls, obsv, None) + 1e-6*np.eye(obsv.shape[0]))
+            + noise*np.eye(obsv.shape[0]))
+    obsv_chol  = spla.cholesky(cov, lower=True)
+    comp_chol  = obsv_chol[:comp.shape[0],:comp.shape[0]]
+    pend_cross = amp2*chooser.cov_func(ls, comp, pend)
+    alpha  = spla.cho_solve((comp_chol, True), vals - mean)
+    beta   = spla.cho_solve((comp_chol, True), pend_cross)
+    pend_m = np.dot(pend_cross.T, alpha) + mean
+    pend_K = (amp2*(chooser.cov_func(ls, pend, None) + 1e-6*np.eye(pend.shape[0]))
+              - np.dot(pend_cross.T, beta))
+    return obsv_chol, pend_m, pend_K
+
+def extend(chooser, comp, pend, vals, hyper):
+    (mean, noise, amp2, ls) = hyper
+    comp_chol  = chooser.comp_chol(comp, hyper)
+    pend_cross = amp2*chooser.cov_func(ls, comp, pend)
+    L21    = spla.solve_triangular(comp_chol, pend_cross, lower=True).T
+    pend_m = np.dot(L21, spla.solve_triangular(comp_chol, vals - mean,
+                                               lower=True)) + mean
+    pend_K = (amp2*(chooser.cov_func(ls, pend, None) + 1e-6*np.eye(pend.shape[0]))
+              - np.dot(L21, L21.T))
+    obsv_chol = np.zeros((comp.shape[0] + pend.shape[0],)*2)
+    obsv_chol[:comp.shape[0],:comp.shape[0]] = comp_chol
+    obsv_chol[comp.shape[0]:,:comp.shape[0]] = L21
+    obsv_chol[comp.shape[0]:,comp.shape[0]:] = gp.jitter_chol(
+        pend_K + noise*np.eye(pend.shape[0]), 'obsv')
+    return obsv_chol, pend_m, pend_K
+
+def timed(func, *args):
+    t_init = time.time()
+    out = func(*args)
+    return (time.time() - t_init,) + out
+
+def main(N=2000, D=4):
+    rs   = np.random.RandomState(0)
+    comp = rs.rand(N, D)
+    vals = np.sin(3*comp).sum(1) + 0.1*rs.randn(N)
+
+    chooser = GPEIChooser(mcmc_iters=0)
+    chooser._real_init(D, vals)
+    hyper = (chooser.mean, 1e-2, chooser.amp2, 0.5*np.ones(D))
+    # The factor of the complete points is cached across calls.
+    chooser.comp_chol(comp, hyper)
+
+    print('N = %d  D = %d' % (N, D))
+    print('%6s %10s %12s %8s %10s' % ('P', 'full [s]', 'extend [s]',
+                                      'speedup', 'max err'))
+    for P in [10, 50, 200, 800]:
+        pend = rs.rand(P, D)
+        (t_full, chol_f, m_f, K_f) = timed(full, chooser, comp, pend, vals,
+                                           hyper)
+        (t_ext, chol_e, m_e, K_e) = timed(extend, chooser, comp, pend, vals,
+                                          hyper)
+
+        err = max(np.max(np.abs(chol_f - chol_e)), np.max(np.abs(m_f - m_e)),
+                  np.max(np.abs(K_f - K_e)))
+        if err > 1e-6:
+            raise Exception("Extended and full factors differ: %g" % err)
+
+        print('%6d %10.3f %12.3f %8.1f %10.1e' % (P, t_full, t_ext,
+                                                  t_full/t_ext, err))
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
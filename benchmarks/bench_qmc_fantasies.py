@@ -0,0 +1,70 @@
+"""
+Variance and speed of EI with pending points for the fantasy samplers of
+acquisition.fantasy_normals: independent draws (mc), antithetic pairs,
+scrambled Sobol (qmc) and scrambled Sobol in antithetic pairs.
+
+For each sampler and number of fantasies F, computes the EI of the
+candidates with GPEIChooser.compute_ei for `repeats` random seeds, and
+reports the variance of the EI estimate (averaged over the candidates and
+relative to mc with the largest F) and the time of one compute_ei.  Run
+from the repository root:
+
+    python -m benchmarks.bench_qmc_fantasies [repeats num_pend]
+"""
+import sys
+import time
+
+import numpy as np
+
+from minimint.chooser.GPEIChooser import GPEIChooser
+
+SAMPLERS = [('mc', False, False), ('antithetic', False, True),
+            ('qmc', True, False), ('qmc+anti', True, True)]
+
+def main(repeats=50, num_pend=3):
+    D    = 4
+    rs   = np.random.RandomState(0)
+    comp = rs.rand(40, D)
+    pend = rs.rand(num_pend, D)
+    cand = rs.rand(2000, D)
+    vals = np.sin(3*comp).sum(1)
+
+    counts = [4, 8, 16, 32, 64, 128]
+    var    = np.zeros((len(counts), len(SAMPLERS)))
+    times  = np.zeros((len(counts), len(SAMPLERS)))
+    for (j, (name, qmc, antithetic)) in enumerate(SAMPLERS):
+        for (i, F) in enumerate(counts):
+            chooser = GPEIChooser(mcmc_iters=0, pending_samples=F,
+                                  qmc_fantasies=qmc,
+                                  antithetic_fantasies=antithetic)
+            chooser._real_init(D, vals)
+            chooser.ls    = 0.5*np.ones(D)
+            chooser.noise = 1e-3
+
+            ei = np.zeros((repeats, cand.shape[0]))
+            t_init = time.time()
+            for r in range(repeats):
+                np.random.seed(r)
+                ei[r] = chooser.compute_ei(comp, pend, cand, vals)
+            times[i,j] = (time.time() - t_init)/repeats
+            var[i,j]   = np.mean(np.var(ei, axis=0))
+
+    if not var[-1,2] < var[-1,0]:
+        raise Exception("QMC fantasies do not reduce the variance of EI")
+
+    print('%d pending points, %d candidates, %d repeats' % (num_pend,
+                                                            cand.shape[0],
+                                                            repeats))
+    print('Variance of EI relative to mc with %d fantasies' % counts[-1])
+    print('%6s' % 'F' + ''.join('%12s' % s[0] for s in SAMPLERS))
+    for (i, F) in enumerate(counts):
+        print('%6d' % F + ''.join('%12.2f' % v for v in var[i]/var[-1,0]))
+
+    print('')
+    print('Time of compute_ei [ms]')
+    print('%6s' % 'F' + ''.join('%12s' % s[0] for s in SAMPLERS))
+    for (i, F) in enumerate(counts):
+        print('%6d' % F + ''.join('%12.1f' % (1e3*t) for t in times[i]))
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
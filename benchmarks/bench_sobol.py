@@ -0,0 +1,58 @@
+"""
+Benchmark of the Sobol candidate grid generation.
+
+Compares the original per-point i4_sobol loop (copied here, since
+i4_sobol itself now jumps to each seed without state) with the batched
+i4_sobol_generate for an increasing number of points N.  Run from the
+repository root:
+
+    python -m benchmarks.bench_sobol
+"""
+import sys
+import time
+
+import numpy as np
+
+from minimint import sobol_lib
+
+def loop_generate(m, n, skip):
+    # The implementation of i4_sobol_generate before the batched one: one
+    # call of the original, stateful i4_sobol per point, each updating the
+    # previous point with a Python loop over the dimensions. Only its path
+    # for consecutive seeds from 0 (skip = 1) is kept, the one it took here.
+    if skip != 1:
+        raise Exception("The loop baseline only supports skip = 1")
+    (v, recipd) = sobol_lib.i4_sobol_directions(m)
+    v     = v.astype(float)
+    lastq = np.zeros(m)
+    r     = np.zeros((m, n))
+    for j in range(1, n+1):
+        seed = skip + j - 2
+        l = 1 if seed == 0 else sobol_lib.i4_bit_lo0(seed)
+        quasi = np.zeros(m)
+        for i in range(1, m+1):
+            quasi[i-1] = lastq[i-1] * recipd
+            lastq[i-1] = np.bitwise_xor(int(lastq[i-1]), int(v[i-1,l-1]))
+        r[0:m,j-1] = quasi
+    return r
+
+def timeit(func, *args):
+    t_init = time.time()
+    out = func(*args)
+    return time.time() - t_init, out
+
+def main(dims=10, max_loop_n=10**5):
+    print('D = %d' % dims)
+    print('%10s %12s %12s %10s' % ('N', 't_loop [s]', 't_batch [s]', 'speedup'))
+    for n in [10**3, 10**4, 10**5, 10**6]:
+        t_batch, r_batch = timeit(sobol_lib.i4_sobol_generate, dims, n, 1)
+        if n <= max_loop_n:
+            t_loop, r_loop = timeit(loop_generate, dims, n, 1)
+            if not np.array_equal(r_loop, r_batch):
+                raise Exception("Batched Sobol points differ from the loop")
+            print('%10d %12.4f %12.4f %10.1f' % (n, t_loop, t_batch, t_loop/t_batch))
+        else:
+            print('%10d %12s %12.4f %10s' % (n, '-', t_batch, '-'))
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
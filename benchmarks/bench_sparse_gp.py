@@ -0,0 +1,81 @@
+"""
+Accuracy and speed of the sparse (FITC) GP against the exact GP.
+
+For an increasing number of complete points N, fits the posterior of both
+with the same hyperparameters and compares the time to build the posterior
+and predict at the candidates, the predictive means and standard
+deviations at the candidates, and the log likelihood.  Run from the
+repository root:
+
+    python -m benchmarks.bench_sparse_gp [M D]
+
+where M is the number of inducing points.
+"""
+import sys
+import time
+
+import numpy as np
+import scipy.linalg as spla
+
+from minimint import gp
+
+def exact(comp, vals, cand, mean, amp2, noise, ls):
+    corr  = gp.Matern52(ls, comp, None) + 1e-6*np.eye(comp.shape[0])
+    chol  = spla.cholesky(amp2*corr + noise*np.eye(comp.shape[0]), lower=True)
+    alpha = spla.cho_solve((chol, True), vals - mean)
+    lik   = -np.sum(np.log(np.diag(chol))) - 0.5*np.dot(vals - mean, alpha)
+
+    chol_inv = spla.solve_triangular(chol, np.eye(comp.shape[0]), lower=True)
+    (func_m, func_v) = gp.batch_predict(gp.Matern52, np.array([mean]),
+                                        np.array([amp2]), ls[np.newaxis],
+                                        comp, chol_inv[np.newaxis],
+                                        alpha[np.newaxis], cand)
+    return func_m[0], np.sqrt(func_v[0]), lik
+
+def sparse(comp, vals, cand, mean, amp2, noise, ls, num_inducing):
+    inducing = comp[gp.select_inducing(comp, num_inducing, np.argmin(vals))]
+    fitc = gp.FITC(gp.Matern52(ls, inducing, None),
+                   gp.Matern52(ls, comp, inducing), amp2, noise)
+    alpha = fitc.weights(vals, mean)
+    lik   = fitc.loglik(vals, mean)
+
+    (func_m, func_v) = gp.batch_predict(gp.Matern52, np.array([mean]),
+                                        np.array([amp2]), ls[np.newaxis],
+                                        inducing, fitc.pred_factor()[np.newaxis],
+                                        alpha[np.newaxis], cand)
+    return func_m[0], np.sqrt(func_v[0]), lik
+
+def main(M=200, D=4):
+    rs   = np.random.RandomState(0)
+    cand = rs.rand(1000, D)
+    (mean, amp2, noise, ls) = (0.0, 1.0, 1e-2, 0.5*np.ones(D))
+
+    print('M = %d  D = %d' % (M, D))
+    print('%6s %11s %11s %8s %10s %10s %14s' % ('N', 'exact [s]', 'sparse [s]',
+                                                'speedup', 'mean RMSE',
+                                                'std RMSE', 'loglik / N'))
+    for N in [500, 1000, 2000, 4000]:
+        comp = rs.rand(N, D)
+        vals = np.sin(3*comp).sum(1) + 0.1*rs.randn(N)
+
+        t_init = time.time()
+        (m_exact, s_exact, lik_exact) = exact(comp, vals, cand,
+                                              mean, amp2, noise, ls)
+        t_exact = time.time() - t_init
+
+        t_init = time.time()
+        (m_sparse, s_sparse, lik_sparse) = sparse(comp, vals, cand,
+                                                  mean, amp2, noise, ls, M)
+        t_sparse = time.time() - t_init
+
+        if not np.all(np.isfinite(m_sparse)) or not np.all(np.isfinite(s_sparse)):
+            raise Exception("Sparse GP predictions are not finite")
+
+        print('%6d %11.3f %11.3f %8.1f %10.2e %10.2e %7.3f/%.3f' % (
+                N, t_exact, t_sparse, t_exact/t_sparse,
+                np.sqrt(np.mean((m_exact - m_sparse)**2)),
+                np.sqrt(np.mean((s_exact - s_sparse)**2)),
+                lik_exact/N, lik_sparse/N))
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
@@ -0,0 +1,66 @@
+"""
+Peak memory and time of the candidate evaluation of GPEIChooser with
+pending points, all the candidates at once against blocks of candidates
+from GridMap.hypercube_blocks with a running top-k.
+
+All at once is ei_over_hypers with a single block (block_size = M), as
+before candidates were evaluated in blocks; it holds the predictions of
+every candidate for every fantasy.  Run from the repository root:
+
+    python -m benchmarks.bench_streaming_ei [max_M pending_samples]
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from minimint.ExperimentGrid import GridMap
+from minimint.chooser.GPEIChooser import GPEIChooser
+
+def run(func, *args, **kwargs):
+    np.random.seed(0)
+    tracemalloc.start()
+    t_init = time.time()
+    out = func(*args, **kwargs)
+    t = time.time() - t_init
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return t, peak/2.0**20, out
+
+def main(max_M=100000, pending_samples=100):
+    D    = 4
+    rs   = np.random.RandomState(0)
+    comp = rs.rand(50, D)
+    pend = rs.rand(3, D)
+    vals = np.sin(3*comp).sum(1)
+    gmap = GridMap([{'name': 'x', 'size': D, 'type': 'float',
+                     'min': 0, 'max': 1}])
+
+    chooser = GPEIChooser(mcmc_iters=0, pending_samples=pending_samples)
+    chooser._real_init(D, vals)
+    hyper_samples = [(chooser.mean, 1e-3, chooser.amp2, 0.5*np.ones(D))]*10
+
+    print('%d hyperparameter samples, %d fantasies' % (len(hyper_samples),
+                                                       pending_samples))
+    print('%8s %10s %10s %10s %10s' % ('M', 'all [s]', 'blocks [s]',
+                                       'all [MB]', 'blocks [MB]'))
+    M = 1000
+    while M <= max_M:
+        cand = gmap.hypercube_grid(M, 1)
+        (t_all, m_all, ei) = run(chooser.ei_over_hypers, comp, pend, cand,
+                                 vals, hyper_samples, block_size=M)
+        (t_blocks, m_blocks, (top_cand, top_ei)) = run(
+            chooser.ei_over_hypers, comp, pend,
+            gmap.hypercube_blocks(M, 1, 1024), vals, hyper_samples, top_k=10)
+
+        best = np.argmax(np.mean(ei, axis=1))
+        if not np.array_equal(top_cand[0], cand[best]):
+            raise Exception("Streaming and full evaluation disagree")
+
+        print('%8d %10.2f %10.2f %10.0f %10.0f' % (M, t_all, t_blocks,
+                                                   m_all, m_blocks))
+        M *= 10
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
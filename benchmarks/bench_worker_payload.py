@@ -0,0 +1,66 @@
+"""
+Size and unpickling time of the payload GPEIOptChooser.optimize_pts_parallel
+shares with its workers once per next() call, against pickling the whole
+chooser state (which includes the cached Cholesky factors of the complete
+points, one NxN matrix per hyperparameter sample).
+
+The workers only read the cached posteriors, so the payload should not be
+much larger than their inverse Cholesky factors and weights.  Run from the
+repository root:
+
+    python -m benchmarks.bench_worker_payload [N mcmc_iters]
+"""
+import pickle
+import sys
+import time
+
+import numpy as np
+
+from minimint.chooser.GPEIOptChooser import GPEIOptChooser
+
+def timed_loads(data):
+    t_init = time.time()
+    pickle.loads(data)
+    return time.time() - t_init
+
+def main(N=1000, mcmc_iters=10):
+    D    = 4
+    rs   = np.random.RandomState(0)
+    comp = rs.rand(N, D)
+    pend = rs.rand(3, D)
+    cand = rs.rand(1000, D)
+    vals = np.sin(3*comp).sum(1) + 0.1*rs.randn(N)
+
+    chooser = GPEIOptChooser(mcmc_iters=mcmc_iters, pending_samples=10)
+    chooser._real_init(D, vals)
+    chooser.hyper_samples = [(chooser.mean, 1e-2, chooser.amp2,
+                              (0.4 + 0.02*i)*np.ones(D))
+                             for i in range(mcmc_iters)]
+    # Fill the posterior cache, as the first ei_over_hypers of next() does.
+    chooser.ei_over_hypers(comp, pend, cand, vals)
+
+    payload = pickle.dumps((comp, pend, vals, chooser),
+                           protocol=pickle.HIGHEST_PROTOCOL)
+    state   = chooser.__dict__.copy()
+    state['pool'] = None
+    full    = pickle.dumps((comp, pend, vals, state),
+                           protocol=pickle.HIGHEST_PROTOCOL)
+
+    # What the workers read: the posteriors and the data.
+    needed = sum(post[1].nbytes + post[2].nbytes
+                 for post in chooser.posterior_cache.values())
+    needed += comp.nbytes + pend.nbytes + vals.nbytes
+    if len(payload) > 1.05*needed + 2**20:
+        raise Exception("Worker payload is %.1f MB for %.1f MB of posteriors"
+                        % (len(payload)/2.0**20, needed/2.0**20))
+
+    print('N = %d  D = %d, %d hyperparameter samples' % (N, D, mcmc_iters))
+    print('%12s %10s %12s' % ('', 'size [MB]', 'unpickle [s]'))
+    print('%12s %10.1f %12.3f' % ('full state', len(full)/2.0**20,
+                                  timed_loads(full)))
+    print('%12s %10.1f %12.3f' % ('payload', len(payload)/2.0**20,
+                                  timed_loads(payload)))
+    print('%12s %10.1f' % ('posteriors', needed/2.0**20))
+
+if __name__ == '__main__':
+    main(*[int(float(a)) for a in sys.argv[1:]])
@@ -52,6 +52,7 @@ class GridMap:
 
     def __init__(self, variables):
         self.variables   = []
+        self.streams     = {}
         self.cardinality = 0
 
         # Count the total number of dimensions and roll into new format.
@@ -80,13 +81,40 @@ class GridMap:
             else:
                 raise Exception("Unknown parameter type.")
 
-    # Get a list of candidate experiments generated from a sobol sequence
-    def hypercube_grid(self, size, seed):
-        # Generate from a sobol sequence
-        sobol_grid = np.transpose(i4_sobol_generate(self.cardinality,size,seed))
+        # Stateful sobol sequence used to generate the candidate grids
+        self.sobol = SobolSequence(self.cardinality)
+
+    # Get a list of candidate experiments generated from a sobol sequence.
+    # If stream is given (e.g. an engine id), the points come from a
+    # scrambled sobol sequence specific to that stream, so that different
+    # workers get different low discrepancy candidate grids.
+    def hypercube_grid(self, size, seed, stream=None):
+        if stream is not None:
+            if stream not in self.streams:
+                self.streams[stream] = SobolSequence(self.cardinality,
+                                                     stream=stream)
+            self.streams[stream].skip_to(seed - 1 if seed > 0 else 0)
+            return self.streams[stream].draw(size)
+
+        if seed < 1:
+            # i4_sobol treats negative seeds as 0
+            return np.transpose(i4_sobol_generate(self.cardinality,size,seed))
+
+        # Generate from a sobol sequence. Consecutive calls continue the
+        # sequence, anything else is a jump ahead (or back) in O(D log(seed))
+        self.sobol.skip_to(seed - 1)
+        sobol_grid = self.sobol.draw(size)
 
         return sobol_grid
 
+    # Like hypercube_grid, but the size points are generated lazily, in
+    # blocks of at most block_size points, so that a chooser can evaluate a
+    # large candidate grid block by block without ever holding all of it.
+    def hypercube_blocks(self, size, seed, block_size, stream=None):
+        for i in range(0, size, block_size):
+            yield self.hypercube_grid(min(block_size, size - i),
+                                      seed + i, stream)
+
     # Convert a variable to the unit hypercube
     # Takes a single variable encoded as a list, assuming the ordering is
     # the same as specified in the configuration file
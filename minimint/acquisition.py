@@ -0,0 +1,353 @@
+"""
+acquisition.py contains the expected improvement (EI) acquisition function
+shared by the choosers, its logarithm, and the local penalizers that can
+stand in for fantasies of the pending points.
+
+Both are computed with scipy.special (ndtr, log_ndtr, erfcx) instead of the
+scipy.stats distributions, whose generic argument checking dominates the
+cost on large candidate sets.
+"""
+import copy
+
+import numpy         as np
+import scipy.special as spsp
+
+from minimint import gp
+from minimint import sobol_lib
+
+LOG_2PI      = np.log(2*np.pi)
+INV_SQRT_2PI = 1/np.sqrt(2*np.pi)
+SQRT_HALF    = np.sqrt(0.5)
+
+# Below this u, u*Phi(u) + phi(u) and Phi(u) are computed with their
+# asymptotic series in 1/u^2, exact to double precision there.
+LOG_H_ASYMPTOTE = -1e3
+
+# Above this z, log(Phi(z)) > -1e-15 and the penalty of LocalPenalizer is
+# taken as exactly 1.
+PENALTY_CUTOFF = 8.0
+
+def expected_improvement(best, func_m, func_s, grad=False):
+    # EI below best of normal predictions with means func_m and standard
+    # deviations func_s (all broadcast together),
+    #   s*(u*Phi(u) + phi(u)), u = (best - m)/s.
+    # With grad, also returns its derivatives w.r.t. the means (-Phi(u)) and
+    # w.r.t. the standard deviations (phi(u)).
+    u  = np.asarray(np.subtract(best, func_m), dtype=float)
+    u /= func_s
+
+    ncdf = spsp.ndtr(u)
+    npdf = u*u
+    npdf *= -0.5
+    npdf  = np.exp(npdf)
+    npdf *= INV_SQRT_2PI
+
+    ei  = u*ncdf
+    ei += npdf
+    ei *= func_s
+
+    if not grad:
+        return ei
+
+    return ei, -ncdf, npdf
+
+def log_h(u, grad=False):
+    # log(h(u)) with h(u) = u*Phi(u) + phi(u), without underflow for very
+    # negative u. With grad, also returns the ratios Phi(u)/h(u) and
+    # phi(u)/h(u) (h' = Phi and h - u*h' = phi).
+    #
+    # For u < -1, h(u) = phi(u)*(1 - exp(w)) with exp(w) = |u|*Phi(u)/phi(u),
+    # whose ratio of Phi to phi is computed with the scaled complementary
+    # error function. Below LOG_H_ASYMPTOTE, 1 - exp(w) ~ 1/u^2 has too few
+    # significant digits left and the asymptotic series are used instead.
+    u     = np.asarray(u, dtype=float)
+    out   = np.empty(u.shape)
+    r_cdf = np.empty(u.shape)
+    r_pdf = np.empty(u.shape)
+
+    upper = u > -1
+    uu = u[upper]
+    ncdf = spsp.ndtr(uu)
+    npdf = INV_SQRT_2PI*np.exp(-0.5*uu*uu)
+    h = uu*ncdf + npdf
+    out[upper]   = np.log(h)
+    r_cdf[upper] = ncdf / h
+    r_pdf[upper] = npdf / h
+
+    middle = ~upper & (u > LOG_H_ASYMPTOTE)
+    uu = u[middle]
+    w  = np.log(spsp.erfcx(-SQRT_HALF*uu)*np.abs(uu)) + 0.5*np.log(0.5*np.pi)
+    out[middle]   = -0.5*uu*uu - 0.5*LOG_2PI + np.where(w > -np.log(2),
+                                                        np.log(-np.expm1(w)),
+                                                        np.log1p(-np.exp(w)))
+    r_pdf[middle] = -1/np.expm1(w)
+    r_cdf[middle] = r_pdf[middle]*np.exp(w)/np.abs(uu)
+
+    # h(u) = phi(u)/u^2 * (1 - 3/u^2 + 15/u^4 - 105/u^6 + ...)
+    # Phi(u) = phi(u)/|u| * (1 - 1/u^2 + 3/u^4 - 15/u^6 + ...)
+    lower = u <= LOG_H_ASYMPTOTE
+    uu = u[lower]
+    v  = 1/(uu*uu)
+    c_h   = 1 + v*(-3 + v*(15 - 105*v))
+    c_cdf = 1 + v*(-1 + v*(3 - 15*v))
+    out[lower]   = -0.5*uu*uu - 0.5*LOG_2PI + np.log(v*c_h)
+    r_cdf[lower] = np.abs(uu)*c_cdf/c_h
+    r_pdf[lower] = 1/(v*c_h)
+
+    if not grad:
+        return out
+    return out, r_cdf, r_pdf
+
+def log_expected_improvement(best, func_m, func_s, grad=False):
+    # The logarithm of expected_improvement, finite wherever func_s > 0, so
+    # that a gradient optimizer still has a slope to follow where EI
+    # underflows to zero. With grad, also returns its derivatives w.r.t. the
+    # means (-Phi(u)/(s*h(u))) and w.r.t. the standard deviations
+    # (phi(u)/(s*h(u))), see log_h.
+    u  = np.asarray(np.subtract(best, func_m), dtype=float)
+    u /= func_s
+
+    if not grad:
+        log_ei  = log_h(u)
+        log_ei += np.log(func_s)
+        return log_ei
+
+    (log_ei, r_cdf, r_pdf) = log_h(u, grad=True)
+    log_ei += np.log(func_s)
+    r_cdf  /= -func_s
+    r_pdf  /= func_s
+    return log_ei, r_cdf, r_pdf
+
+def fantasy_normals(num_pend, num_fant, randomstate, qmc=False,
+                    antithetic=False):
+    # Standard normal draws (num_pend x num_fant) for the fantasized outcomes
+    # of the pending points, from randomstate (a numpy RandomState, or the
+    # numpy.random module). Without qmc or antithetic they are the draws
+    # randomstate.randn(num_pend, num_fant).
+    #
+    # With qmc, the fantasies are the points of a scrambled Sobol sequence in
+    # num_pend dimensions (with its scrambling drawn from randomstate) mapped
+    # through the inverse normal CDF, which fill the normal space more evenly
+    # than independent draws; num_fant is best a power of 2. With
+    # antithetic, the second half of the fantasies are the first half
+    # negated, which cancels the odd part of the integrand.
+    num_draws = (num_fant + 1)//2 if antithetic else num_fant
+
+    if qmc:
+        seq = sobol_lib.SobolSequence(num_pend,
+                                      stream=randomstate.randint(2**31 - 1))
+        # The points are on a grid of spacing recipd; centering them in
+        # their cells keeps them away from 0, where the inverse CDF is -inf.
+        z = spsp.ndtri(seq.draw(num_draws) + 0.5*seq.recipd).T
+    else:
+        z = randomstate.randn(num_pend, num_draws)
+
+    if antithetic:
+        z = np.hstack((z, -z))[:,:num_fant]
+
+    return z
+
+class TopK:
+    '''
+    The k candidates with the largest scores among all the blocks of
+    candidates passed to update, keeping nothing else, so that the memory
+    does not depend on the number of candidates.
+
+    With each block of candidates (MxD) come their scores (M) and any other
+    values to keep with them (M rows, e.g. the EI of each hyperparameter
+    sample). result returns the candidates and values sorted by decreasing
+    score.
+    '''
+    def __init__(self, k):
+        if k < 1:
+            raise Exception("TopK needs k >= 1, got %d" % k)
+        self.k      = int(k)
+        self.cand   = None
+        self.scores = None
+        self.values = None
+
+    def update(self, cand, scores, values):
+        if self.cand is not None:
+            cand   = np.concatenate((self.cand, cand))
+            scores = np.concatenate((self.scores, scores))
+            values = np.concatenate((self.values, values))
+
+        if scores.shape[0] > self.k:
+            idx    = np.argpartition(-scores, self.k-1)[:self.k]
+            cand   = cand[idx]
+            scores = scores[idx]
+            values = values[idx]
+
+        self.cand   = cand
+        self.scores = scores
+        self.values = values
+
+    def result(self):
+        if self.cand is None:
+            raise Exception("No candidates were evaluated")
+        order = np.argsort(-self.scores, kind='stable')
+        return self.cand[order], self.values[order]
+
+class LocalPenalizer:
+    '''
+    Local penalization of the acquisition function around pending points
+    (Gonzalez et al., "Batch Bayesian optimization via local penalization",
+    2016), an alternative to averaging EI over fantasized outcomes of the
+    pending points that needs no factorization and no fantasies.
+
+    If the objective has Lipschitz constant L, a pending point x_j with
+    predictive mean m_j and standard deviation s_j is unlikely to leave a
+    value below best within the ball of radius |m_j - best|/L around it.
+    The acquisition of a candidate x is multiplied, for each pending point,
+    by the probability that x is outside of that ball,
+      Phi((L*|x - x_j| - |m_j - best|)/s_j),
+    which costs O(M*P*D) for M candidates and P pending points in D
+    dimensions. Candidates far outside of a ball (Phi = 1 to double
+    precision) skip its normal CDF.
+
+    pend_m and pend_s are P vectors and best and lipschitz scalars, or for S
+    hyperparameter samples at once SxP arrays and S vectors.
+    '''
+    def __init__(self, pend, pend_m, pend_s, best, lipschitz):
+        best      = np.asarray(best, dtype=float)[...,np.newaxis]
+        lipschitz = np.asarray(lipschitz, dtype=float)[...,np.newaxis]
+        self.pend   = pend
+        self.radius = np.abs(pend_m - best) / lipschitz
+        self.scale  = pend_s / lipschitz
+
+    def log_penalty(self, cand, grad=False):
+        # The log of the penalty of the candidates (M, or SxM), and with grad
+        # its gradients w.r.t. the candidates (MxD, or SxMxD).
+        if grad:
+            diff = cand[:,np.newaxis,:] - self.pend[np.newaxis,:,:]
+            dist = np.sqrt(np.sum(diff**2, axis=2))
+        else:
+            dist = np.sqrt(np.maximum(np.sum(cand**2, axis=1)[:,np.newaxis]
+                                      + np.sum(self.pend**2, axis=1)
+                                      - 2*np.dot(cand, self.pend.T), 0.0))
+        z = dist - self.radius[...,np.newaxis,:]
+        z /= self.scale[...,np.newaxis,:]
+
+        near = z < PENALTY_CUTOFF
+        log_ncdf = np.zeros(z.shape)
+        log_ncdf[near] = spsp.log_ndtr(z[near])
+        log_pen = np.sum(log_ncdf, axis=-1)
+        if not grad:
+            return log_pen
+
+        # d log(Phi(z))/dz = phi(z)/Phi(z), and the gradient of the distance
+        # is the unit vector from the pending point (zero on top of it).
+        w = np.zeros(z.shape)
+        w[near] = np.exp(-0.5*z[near]**2 - 0.5*LOG_2PI - log_ncdf[near])
+        w /= self.scale[...,np.newaxis,:] * np.maximum(dist, 1e-12)
+        return log_pen, np.einsum('...mp,mpd->...md', w, diff)
+
+def stack_penalizers(penalizers):
+    # One LocalPenalizer for the hyperparameter samples of the penalizers
+    # (of the same pending points), whose log_penalty is SxM: the distances
+    # of the candidates to the pending points are then computed once.
+    stacked = copy.copy(penalizers[0])
+    stacked.radius = np.array([pen.radius for pen in penalizers])
+    stacked.scale  = np.array([pen.scale for pen in penalizers])
+    return stacked
+
+def local_penalizer(cov_func, hyper, post, comp, pend):
+    # The local penalizer of the pending points for the hyperparameter
+    # sample hyper, from its posterior post without the pending points (in
+    # the form of gp.exact_posterior). The Lipschitz constant is the largest
+    # norm of the gradient of the posterior mean over the complete and
+    # pending points and 1000 fixed random points of the unit hypercube.
+    (mean, noise, amp2, ls) = hyper
+    (obsv, chol_inv, alpha, best) = post
+
+    # Predictive means and standard deviations of the pending points.
+    pend_cross = amp2 * cov_func(ls, obsv, pend)
+    pend_m = np.dot(pend_cross.T, alpha) + mean
+    pend_v = amp2*(1+1e-6) - np.sum(np.dot(chol_inv, pend_cross)**2, axis=0)
+
+    pts    = np.vstack((comp, pend,
+                        np.random.RandomState(0).rand(1000, comp.shape[1])))
+    kern   = gp.get_kernel(cov_func.__name__, ls, obsv, pts)
+    grad_m = amp2*kern.grad_x(np.tile(alpha[:,np.newaxis], (1, pts.shape[0])))
+    lipschitz = max(np.max(np.sqrt(np.sum(grad_m**2, axis=1))), 1e-7)
+
+    return LocalPenalizer(pend, pend_m, np.sqrt(np.maximum(pend_v, 1e-10)),
+                          best, lipschitz)
+
+def ei_over_hypers(cov_func, posterior, comp, pend, cand, vals, hyper_samples,
+                   top_k=None, block_size=1024, penalize=False):
+    # EI for all the hyperparameter samples (mean, noise, amp2, ls) in one
+    # batched pass, block_size candidates at a time, so that the predictions
+    # (one per fantasy with pending points) are only ever held for one
+    # block. posterior(comp, pend, vals, hyper) returns the posterior of a
+    # sample, in the form of gp.exact_posterior.
+    #
+    # If cand is an array of candidates and top_k is None, returns the EI of
+    # each candidate (rows) for each sample (columns). Otherwise cand may
+    # also be an iterator of candidate blocks (e.g. from
+    # GridMap.hypercube_blocks), and only the top_k (or one) candidates with
+    # the largest EI averaged over the samples are kept: returns them and
+    # their EI for each sample, best first. The memory then does not depend
+    # on the number of candidates.
+    #
+    # With penalize, EI is computed without the pending points and
+    # multiplied by their local penalizers instead of being averaged over
+    # fantasies. The penalizers are built from the same posteriors.
+    penalizer = None
+    if pend.shape[0] > 0 and penalize:
+        posteriors = [posterior(comp, pend[:0], vals, hyper)
+                      for hyper in hyper_samples]
+        penalizer  = stack_penalizers([local_penalizer(cov_func, hyper, post,
+                                                       comp, pend)
+                                       for (hyper, post)
+                                       in zip(hyper_samples, posteriors)])
+        pend = pend[:0]
+    else:
+        posteriors = [posterior(comp, pend, vals, hyper)
+                      for hyper in hyper_samples]
+
+    mean  = np.array([hyper[0] for hyper in hyper_samples])
+    amp2  = np.array([hyper[2] for hyper in hyper_samples])
+    ls    = np.array([hyper[3] for hyper in hyper_samples])
+    obsv     = posteriors[0][0]
+    chol_inv = np.array([post[1] for post in posteriors])
+    alpha    = np.array([post[2] for post in posteriors])
+    bests    = np.array([post[3] for post in posteriors])
+
+    def block_ei(block):
+        # Predict the marginal means and variances at candidates.
+        func_m, func_v = gp.batch_predict(cov_func, mean, amp2, ls, obsv,
+                                          chol_inv, alpha, block)
+
+        if pend.shape[0] == 0:
+            func_s = np.sqrt(func_v)
+            ei     = expected_improvement(bests[:,np.newaxis], func_m, func_s)
+            if penalizer is not None:
+                ei *= np.exp(penalizer.log_penalty(block))
+
+            return ei.T
+        else:
+            # Average EI over the fantasies.
+            func_s = np.sqrt(func_v[:,:,np.newaxis])
+            ei     = expected_improvement(bests[:,np.newaxis,:], func_m, func_s)
+
+            return np.mean(ei, axis=2).T
+
+    if isinstance(cand, np.ndarray):
+        if top_k is None:
+            ei = np.zeros((cand.shape[0], len(hyper_samples)))
+            for i in range(0, cand.shape[0], block_size):
+                ei[i:i+block_size] = block_ei(cand[i:i+block_size])
+            return ei
+
+        blocks = [cand[i:i+block_size]
+                  for i in range(0, cand.shape[0], block_size)]
+    else:
+        blocks = cand
+
+    best = TopK(1 if top_k is None else top_k)
+    for block in blocks:
+        ei = block_ei(block)
+        best.update(block, np.mean(ei, axis=1), ei)
+
+    return best.result()
@@ -1114,6 +1114,14 @@ class GPConstrainedEIChooser:
         self.constraint_gain = hypers[0]
 
     def _sample_noisy(self, comp, vals):
+        # The length scales are fixed here, so one eigendecomposition of the
+        # correlation matrix makes every probe of the sampler O(N):
+        # cov = Q*diag(amp2*(lam + noise))*Q^T.
+        (lam, vecs) = np.linalg.eigh(self.cov_func(self.ls, comp, None) +
+                                     1e-6*np.eye(comp.shape[0]))
+        proj_vals   = np.dot(vecs.T, vals)
+        proj_ones   = np.sum(vecs, axis=0)
+
         def logprob(hypers):
             mean  = hypers[0]
             amp2  = hypers[1]
@@ -1126,12 +1134,11 @@ class GPConstrainedEIChooser:
             if amp2 < 0 or noise < 0:
                 return -np.inf
 
-            cov   = amp2 * ((self.cov_func(self.ls, comp, None) +
-                            1e-6*np.eye(comp.shape[0])) +
-                            noise*np.eye(comp.shape[0]))
-            chol  = spla.cholesky(cov, lower=True)
-            solve = spla.cho_solve((chol, True), vals - mean)
-            lp    = -np.sum(np.log(np.diag(chol)))-0.5*np.dot(vals-mean, solve)
+            d     = amp2*(lam + noise)
+            if np.any(d <= 0):
+                return -np.inf
+            r     = proj_vals - mean*proj_ones
+            lp    = -0.5*np.sum(np.log(d))-0.5*np.sum(r**2 / d)
 
             # Roll in noise horseshoe prior.
             lp += np.log(np.log(1 + (self.noise_scale/noise)**2))
@@ -1201,6 +1208,14 @@ class GPConstrainedEIChooser:
         self.ff = ff
 
     def _sample_noiseless(self, comp, vals):
+        # The length scales are fixed here, so one eigendecomposition of the
+        # correlation matrix makes every probe of the sampler O(N):
+        # cov = Q*diag(amp2*(lam + noise))*Q^T.
+        (lam, vecs) = np.linalg.eigh(self.cov_func(self.ls, comp, None) +
+                                     1e-6*np.eye(comp.shape[0]))
+        proj_vals   = np.dot(vecs.T, vals)
+        proj_ones   = np.sum(vecs, axis=0)
+
         def logprob(hypers):
             mean  = hypers[0]
             amp2  = hypers[1]
@@ -1213,12 +1228,11 @@ class GPConstrainedEIChooser:
             if amp2 < 0:
                 return -np.inf
 
-            cov   = amp2 * ((self.cov_func(self.ls, comp, None) +
-                             1e-6*np.eye(comp.shape[0])) +
-                            noise*np.eye(comp.shape[0]))
-            chol  = spla.cholesky(cov, lower=True)
-            solve = spla.cho_solve((chol, True), vals - mean)
-            lp    = -np.sum(np.log(np.diag(chol)))-0.5*np.dot(vals-mean, solve)
+            d     = amp2*(lam + noise)
+            if np.any(d <= 0):
+                return -np.inf
+            r     = proj_vals - mean*proj_ones
+            lp    = -0.5*np.sum(np.log(d))-0.5*np.sum(r**2 / d)
 
             # Roll in amplitude lognormal prior
             lp -= 0.5*(np.log(amp2)/self.amp2_scale)**2
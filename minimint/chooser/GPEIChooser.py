@@ -21,13 +21,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 from minimint import gp
+from minimint import acquisition
 import sys
 from minimint import util
 import tempfile
 import numpy          as np
 import numpy.random   as npr
-import scipy.linalg   as spla
-import scipy.stats    as sps
 import scipy.optimize as spo
 #import cPickle
 
@@ -43,22 +42,69 @@ is used to sample Gaussian process hyperparameters for the GP.
 class GPEIChooser:
 
     def __init__(self, covar="Matern52", mcmc_iters=10,
-                 pending_samples=100, noiseless=False):
+                 pending_samples=100, noiseless=False, hyper_restarts=0,
+                 hyper_threads=1, num_inducing=0, solver="cholesky",
+                 qmc_fantasies=False, antithetic_fantasies=False,
+                 pending_strategy="fantasies", refit_every=1):
         self.cov_func        = getattr(gp, covar)
         #self.locker          = Locker()
         #self.state_pkl       = os.path.join(expt_dir, self.__module__ + ".pkl")
 
         self.mcmc_iters      = int(mcmc_iters)
         self.burn_in_mcmc_iters = 100
+        # Burn-in sweeps per new observation once the chain is warm
+        self.burn_in_per_point  = 10
         self.pending_samples = pending_samples
         self.D               = -1
         self.hyper_iters     = 1
         self.noiseless       = bool(int(noiseless))
+        # Without MCMC, the number of random restarts of the hyperparameter
+        # fit and the number of threads they run in
+        self.hyper_restarts  = int(hyper_restarts)
+        self.hyper_threads   = int(hyper_threads)
+        # Without MCMC, refit the hyperparameters only once at least
+        # refit_every complete points were added since the last fit. In
+        # between, the optimum is kept, and so is the Cholesky factor of the
+        # complete points, which is then only extended with the new rows.
+        self.refit_every     = int(refit_every)
+        self.fit_size        = -1
+        # Number of inducing points of the sparse (FITC) GP used once there
+        # are more complete points than that; 0 always uses the exact GP
+        self.num_inducing    = int(num_inducing)
+        # Solver of the exact GP: "cholesky" factorizes the covariance, "cg"
+        # uses the iterative solvers of gp.IterativeSolver for large N
+        if solver not in ('cholesky', 'cg'):
+            raise Exception("Unknown solver %s" % solver)
+        self.solver          = solver
+        # Fantasies of the pending points from a scrambled Sobol sequence
+        # instead of independent draws, and/or in antithetic pairs, which
+        # need fewer pending_samples for the same variance of EI
+        self.qmc_fantasies        = bool(int(qmc_fantasies))
+        self.antithetic_fantasies = bool(int(antithetic_fantasies))
+        # How EI accounts for the pending points: "fantasies" averages it
+        # over fantasized outcomes, "penalize" multiplies it by local
+        # penalizers around them (see acquisition.LocalPenalizer), which
+        # needs no factorization and scales to many pending points
+        if pending_strategy not in ('fantasies', 'penalize'):
+            raise Exception("Unknown pending strategy %s" % pending_strategy)
+        self.pending_strategy     = pending_strategy
 
         self.noise_scale = 0.1  # horseshoe prior
         self.amp2_scale  = 1    # zero-mean log normal prior
         self.max_ls      = 2    # top-hat prior on length scales
 
+        # Cholesky factors of the covariance of the complete points, one per
+        # hyperparameter sample of the current next() (see release_chol_cache)
+        self.chol_cache  = gp.CholeskyCache(max_size=self.mcmc_iters+1)
+
+        # The complete points and values the hyperparameter chain was last
+        # run on, and the number of likelihood evaluations of the last next()
+        self.chain_data    = None
+        self.num_lik_evals = 0
+
+        # The inducing points of the sparse GP, see gp.InducingPoints
+        self.inducing_points = gp.InducingPoints(self.num_inducing)
+
     #def __del__(self):
         #self.locker.lock_wait(self.state_pkl)
 
@@ -117,6 +163,67 @@ class GPEIChooser:
         else:
             return self.amp2 * self.cov_func(self.ls, x1, x2)
 
+    # Cholesky of the noisy covariance of the complete points for the
+    # hyperparameter sample hyper = (mean, noise, amp2, ls). Cached per
+    # hyperparameter sample, and only extended with the new rows when points
+    # were added since the last call.
+    def comp_chol(self, comp, hyper):
+        (mean, noise, amp2, ls) = hyper
+
+        def noisy_cov(x1, x2=None):
+            if x2 is None:
+                return (amp2 * (self.cov_func(ls, x1, None) +
+                                1e-6*np.eye(x1.shape[0])) +
+                        noise*np.eye(x1.shape[0]))
+            else:
+                return amp2 * self.cov_func(ls, x1, x2)
+
+        return self.chol_cache.cholesky(self.chol_key(hyper), comp, noisy_cov)
+
+    # The key of the factor of the hyperparameter sample hyper in chol_cache.
+    def chol_key(self, hyper):
+        (mean, noise, amp2, ls) = hyper
+        return (amp2, noise, ls.tobytes())
+
+    # Drop the cached Cholesky factors at the end of next(), but the one of
+    # the point estimate if it may be kept for the next proposal.
+    def release_chol_cache(self):
+        if self.mcmc_iters == 0 and self.refit_every > 1:
+            self.chol_cache.retain(self.chol_key((self.mean, self.noise,
+                                                  self.amp2, self.ls)))
+        else:
+            self.chol_cache.clear()
+
+    # Whether the point estimate of the hyperparameters has to be refitted
+    # for the complete points comp, see refit_every.
+    def needs_refit(self, comp):
+        n = comp.shape[0]
+        return (self.fit_size < 0 or n < self.fit_size or
+                n - self.fit_size >= self.refit_every)
+
+    # The inducing points of the sparse GP for the complete points, or None
+    # if the exact GP is used (see gp.InducingPoints).
+    def inducing(self, comp, vals):
+        return self.inducing_points.select(self.cov_func.__name__, comp, vals)
+
+    # Number of burn-in sweeps to re-equilibrate the hyperparameter chain.
+    # The chain is kept across calls, so it only needs the full
+    # burn_in_mcmc_iters when it is cold or the old data changed; when points
+    # were only added, the posterior moves little and a few sweeps per new
+    # point are enough.
+    def num_burn_in(self, comp, vals):
+        if self.chain_data is None:
+            return self.burn_in_mcmc_iters
+
+        (chain_comp, chain_vals) = self.chain_data
+        n = chain_comp.shape[0]
+        if (n > comp.shape[0] or not np.array_equal(comp[:n], chain_comp)
+            or not np.array_equal(vals[:n], chain_vals)):
+            return self.burn_in_mcmc_iters
+
+        return min(self.burn_in_mcmc_iters,
+                   self.burn_in_per_point*(comp.shape[0] - n))
+
     def next(self, grid, values, durations, candidates, pending, complete):
         # The indexing here is really confusing and ineficient.
         # It is not clear if other choosers actually need this.
@@ -136,42 +243,49 @@ class GPEIChooser:
         pend = grid[pending,:]
         vals = values[complete]
 
-        # perform some MC steps to equilibrate the GP hyperparameters
-        if self.burn_in_mcmc_iters > 0:
-            for t in range(self.burn_in_mcmc_iters):
+        if self.mcmc_iters > 0:
+            # perform some MC steps to equilibrate the GP hyperparameters
+            self.num_lik_evals = 0
+            burn_in = self.num_burn_in(comp, vals)
+            for t in range(burn_in):
                 self.sample_hypers(comp, vals)
+            self.chain_data = (comp.copy(), vals.copy())
 
-
-        if self.mcmc_iters > 0:
             # Sample from the posterior distribution of the GP hyperparameters.
-
-            overall_ei = np.zeros((cand.shape[0], self.mcmc_iters))
-
+            hyper_samples = []
             for mcmc_iter in range(self.mcmc_iters):
 
                 self.sample_hypers(comp, vals)
                 log("mean: %f  amp: %f  noise: %f  min_ls: %f  max_ls: %f"
                                  % (self.mean, np.sqrt(self.amp2), self.noise, np.min(self.ls), np.max(self.ls)))
+                hyper_samples.append((self.mean, self.noise, self.amp2, self.ls))
 
-                overall_ei[:,mcmc_iter] = self.compute_ei(comp, pend, cand, vals)
+            log("%d burn-in sweeps, %d likelihood evaluations"
+                % (burn_in, self.num_lik_evals))
+
+            # Compute EI for all the samples at once
+            overall_ei = self.ei_over_hypers(comp, pend, cand, vals, hyper_samples)
 
             # find point of max EI from candidates
             best_cand = np.argmax(np.mean(overall_ei, axis=1))
+            self.release_chol_cache()
 
             #return index of best candidate
             return int(candidates[best_cand])
 
         else:
             # Optimize hyperparameters
-            try:
-                self.optimize_hypers(comp, vals)
-            except:
-                # Initial length scales.
-                self.ls = np.ones(self.D)
-                # Initial amplitude.
-                self.amp2 = np.std(vals)
-                # Initial observation noise.
-                self.noise = 1e-3
+            if self.needs_refit(comp):
+                self.fit_size = comp.shape[0]
+                try:
+                    self.optimize_hypers(comp, vals)
+                except:
+                    # Initial length scales.
+                    self.ls = np.ones(self.D)
+                    # Initial amplitude.
+                    self.amp2 = np.std(vals)
+                    # Initial observation noise.
+                    self.noise = 1e-3
             log("mean: %f  amp: %f  noise: %f  min_ls: %f  max_ls: %f"
                              % (self.mean, np.sqrt(self.amp2), self.noise, np.min(self.ls),
                                 np.max(self.ls)))
@@ -179,98 +293,54 @@ class GPEIChooser:
             ei = self.compute_ei(comp, pend, cand, vals)
 
             best_cand = np.argmax(ei)
+            self.release_chol_cache()
 
             return int(candidates[best_cand])
 
-    def compute_ei(self, comp, pend, cand, vals):
-        if pend.shape[0] == 0:
-            # If there are no pending, don't do anything fancy.
-
-            # Current best.
-            best = np.min(vals)
-
-            # The primary covariances for prediction.
-            comp_cov   = self.cov(comp)
-            cand_cross = self.cov(comp, cand)
-
-            # Compute the required Cholesky.
-            obsv_cov  = comp_cov + self.noise*np.eye(comp.shape[0])
-            obsv_chol = spla.cholesky( obsv_cov, lower=True )
-
-            # Solve the linear systems.
-            alpha  = spla.cho_solve((obsv_chol, True), vals - self.mean)
-            beta   = spla.solve_triangular(obsv_chol, cand_cross, lower=True)
-
-            # Predict the marginal means and variances at candidates.
-            func_m = np.dot(cand_cross.T, alpha) + self.mean
-            func_v = self.amp2*(1+1e-6) - np.sum(beta**2, axis=0)
-
-            # Expected improvement
-            func_s = np.sqrt(func_v)
-            u      = (best - func_m) / func_s
-            ncdf   = sps.norm.cdf(u)
-            npdf   = sps.norm.pdf(u)
-            ei     = func_s*( u*ncdf + npdf)
-
-            return ei
-        else:
-            # If there are pending experiments, fantasize their outcomes.
-
-            # Create a composite vector of complete and pending.
-            comp_pend = np.concatenate((comp, pend))
-
-            # Compute the covariance and Cholesky decomposition.
-            comp_pend_cov  = self.cov(comp_pend) + self.noise*np.eye(comp_pend.shape[0])
-            comp_pend_chol = spla.cholesky(comp_pend_cov, lower=True)
-
-            # Compute submatrices.
-            pend_cross = self.cov(comp, pend)
-            pend_kappa = self.cov(pend)
-
-            # Use the sub-Cholesky.
-            obsv_chol = comp_pend_chol[:comp.shape[0],:comp.shape[0]]
-
-            # Solve the linear systems.
-            alpha  = spla.cho_solve((obsv_chol, True), vals - self.mean)
-            beta   = spla.cho_solve((obsv_chol, True), pend_cross)
-
-            # Finding predictive means and variances.
-            pend_m = np.dot(pend_cross.T, alpha) + self.mean
-            pend_K = pend_kappa - np.dot(pend_cross.T, beta)
-
-            # Take the Cholesky of the predictive covariance.
-            pend_chol = spla.cholesky(pend_K, lower=True)
-
-            # Make predictions.
-            pend_fant = (np.dot(pend_chol, npr.randn(pend.shape[0],self.pending_samples))
-                         + pend_m[:,None])
-
-            # Include the fantasies.
-            fant_vals = np.concatenate((np.tile(vals[:,np.newaxis],
-                                                (1,self.pending_samples)), pend_fant))
-
-            # Compute bests over the fantasies.
-            bests = np.min(fant_vals, axis=0)
-
-            # Now generalize from these fantasies.
-            cand_cross = self.cov(comp_pend, cand)
-
-            # Solve the linear systems.
-            alpha  = spla.cho_solve((comp_pend_chol, True), fant_vals - self.mean)
-            beta   = spla.solve_triangular(comp_pend_chol, cand_cross, lower=True)
-
-            # Predict the marginal means and variances at candidates.
-            func_m = np.dot(cand_cross.T, alpha) + self.mean
-            func_v = self.amp2*(1+1e-6) - np.sum(beta**2, axis=0)
-
-            # Expected improvement
-            func_s = np.sqrt(func_v[:,np.newaxis])
-            u      = (bests[np.newaxis,:] - func_m) / func_s
-            ncdf   = sps.norm.cdf(u)
-            npdf   = sps.norm.pdf(u)
-            ei     = func_s*( u*ncdf + npdf)
-
-            return np.mean(ei, axis=1)
+    # Standard normal draws (num_pend x pending_samples) for the fantasies of
+    # the pending points, from randomstate, see acquisition.fantasy_normals.
+    def fantasy_normals(self, num_pend, randomstate):
+        return acquisition.fantasy_normals(num_pend, self.pending_samples,
+                                           randomstate, self.qmc_fantasies,
+                                           self.antithetic_fantasies)
+
+    # EI of the candidates for the current hyperparameters. With an iterator
+    # of candidate blocks or top_k, returns only the top_k candidates and
+    # their EI, see ei_over_hypers.
+    def compute_ei(self, comp, pend, cand, vals, top_k=None):
+        hyper = (self.mean, self.noise, self.amp2, self.ls)
+        if isinstance(cand, np.ndarray) and top_k is None:
+            return self.ei_over_hypers(comp, pend, cand, vals, [hyper])[:,0]
+
+        (top_cand, ei) = self.ei_over_hypers(comp, pend, cand, vals, [hyper],
+                                             top_k)
+        return top_cand, ei[:,0]
+
+    # EI for all the hyperparameter samples (mean, noise, amp2, ls), see
+    # acquisition.ei_over_hypers. With the "penalize" pending strategy, EI is
+    # multiplied by the local penalizers of the pending points instead of
+    # being averaged over fantasies.
+    def ei_over_hypers(self, comp, pend, cand, vals, hyper_samples, top_k=None,
+                       block_size=1024):
+        return acquisition.ei_over_hypers(self.cov_func, self.posterior, comp,
+                                          pend, cand, vals, hyper_samples,
+                                          top_k, block_size,
+                                          self.pending_strategy == 'penalize')
+
+    # The posterior quantities that do not depend on the candidates for the
+    # hyperparameter sample hyper = (mean, noise, amp2, ls), in the form of
+    # gp.exact_posterior: (obsv, chol_inv, alpha, bests). With the sparse GP,
+    # see gp.sparse_posterior. With the "cg" solver, the inverse Cholesky is
+    # replaced by the factor of gp.IterativeSolver.pred_factor.
+    def posterior(self, comp, pend, vals, hyper):
+        # The fantasies are drawn from the global random state.
+        normals = None
+        if pend.shape[0] > 0:
+            normals = self.fantasy_normals(pend.shape[0], npr)
+
+        return gp.posterior(self.cov_func, comp, pend, vals, hyper, normals,
+                            self.inducing(comp, vals), self.solver,
+                            self.comp_chol)
 
     def sample_hypers(self, comp, vals):
         if self.noiseless:
@@ -281,20 +351,25 @@ class GPEIChooser:
         self._sample_ls(comp, vals)
 
     def _sample_ls(self, comp, vals):
+        inducing = self.inducing(comp, vals)
+
         def logprob(ls):
+            self.num_lik_evals += 1
             if np.any(ls < 0) or np.any(ls > self.max_ls):
                 return -np.inf
 
-            cov   = self.amp2 * (self.cov_func(ls, comp, None) + 1e-6*np.eye(comp.shape[0])) + self.noise*np.eye(comp.shape[0])
-            chol  = spla.cholesky(cov, lower=True)
-            solve = spla.cho_solve((chol, True), vals - self.mean)
-            lp    = -np.sum(np.log(np.diag(chol)))-0.5*np.dot(vals-self.mean, solve)
-            return lp
+            return gp.log_likelihood(self.cov_func, comp, vals,
+                                     (self.mean, self.noise, self.amp2, ls),
+                                     inducing, self.solver)
 
         self.ls = util.slice_sample(self.ls, logprob, compwise=True)
 
     def _sample_noisy(self, comp, vals):
+        lik = gp.fixed_ls_likelihood(self.cov_func, self.ls, comp, vals,
+                                     self.inducing(comp, vals), self.solver)
+
         def logprob(hypers):
+            self.num_lik_evals += 1
             mean  = hypers[0]
             amp2  = hypers[1]
             noise = hypers[2]
@@ -306,11 +381,7 @@ class GPEIChooser:
             if amp2 < 0 or noise < 0:
                 return -np.inf
 
-            cov   = amp2 * (self.cov_func(self.ls, comp, None) +
-                            1e-6*np.eye(comp.shape[0])) + noise*np.eye(comp.shape[0])
-            chol  = spla.cholesky(cov, lower=True)
-            solve = spla.cho_solve((chol, True), vals - mean)
-            lp    = -np.sum(np.log(np.diag(chol)))-0.5*np.dot(vals-mean, solve)
+            lp    = lik(mean, amp2, noise)
 
             # Roll in noise horseshoe prior.
             lp += np.log(np.log(1 + (self.noise_scale/noise)**2))
@@ -327,7 +398,11 @@ class GPEIChooser:
         self.noise = hypers[2]
 
     def _sample_noiseless(self, comp, vals):
+        lik = gp.fixed_ls_likelihood(self.cov_func, self.ls, comp, vals,
+                                     self.inducing(comp, vals), self.solver)
+
         def logprob(hypers):
+            self.num_lik_evals += 1
             mean  = hypers[0]
             amp2  = hypers[1]
             noise = 1e-3
@@ -335,11 +410,7 @@ class GPEIChooser:
             if amp2 < 0:
                 return -np.inf
 
-            cov   = amp2 * (self.cov_func(self.ls, comp, None) +
-                            1e-6*np.eye(comp.shape[0])) + noise*np.eye(comp.shape[0])
-            chol  = spla.cholesky(cov, lower=True)
-            solve = spla.cho_solve((chol, True), vals - mean)
-            lp    = -np.sum(np.log(np.diag(chol)))-0.5*np.dot(vals-mean, solve)
+            lp    = lik(mean, amp2, noise)
 
             # Roll in amplitude lognormal prior
             lp -= 0.5*(np.log(amp2)/self.amp2_scale)**2
@@ -355,7 +426,13 @@ class GPEIChooser:
     def optimize_hypers(self, comp, vals):
         mygp = gp.GP(self.cov_func.__name__)
         mygp.real_init(comp.shape[1], vals)
-        mygp.optimize_hypers(comp,vals)
+        # Warm start from the previous fit (or the initial values), which
+        # changes little when a point is added.
+        mygp.optimize_hypers(comp, vals, init=(self.amp2, self.noise, self.ls),
+                             restarts=self.hyper_restarts,
+                             threads=self.hyper_threads,
+                             inducing=self.inducing(comp, vals),
+                             solver=self.solver)
         self.mean = mygp.mean
         self.ls = mygp.ls
         self.amp2 = mygp.amp2
@@ -21,26 +21,54 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 from minimint import gp
+from minimint import acquisition
 import sys
 from minimint import util
 import tempfile
-import copy
+import collections
 import numpy          as np
 import numpy.random   as npr
-import scipy.linalg   as spla
-import scipy.stats    as sps
-import scipy.optimize as spo
+import scipy.special  as spsp
 import pickle
 import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 
 from minimint.helpers import *
 #from minimint.Locker  import *
 
 def optimize_pt(c, b, comp, pend, vals, model):
-    ret = spo.fmin_l_bfgs_b(model.grad_optimize_ei_over_hypers,
-                            c.flatten(), args=(comp, pend, vals),
-                            bounds=b, disp=0)
-    return ret[0]
+    # c is a start point, or a matrix of start points optimized together.
+    cands = np.reshape(c, (-1, comp.shape[1]))
+    return np.reshape(model.optimize_pts(cands, b, comp, pend, vals), c.shape)
+
+# The (comp, pend, vals, model) of the current next() call in a worker
+# process, with the name of the shared memory block it was read from.
+_worker_name    = None
+_worker_payload = None
+
+def optimize_pt_shared(name, size, c, b):
+    # Like optimize_pt, but the data and the model are read from the shared
+    # memory block name, once per next() call and worker instead of being
+    # pickled with every start. The model also keeps its posterior cache
+    # across all the starts the worker optimizes.
+    global _worker_name, _worker_payload
+    if _worker_name != name:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13, attaching registers the block with the
+            # resource tracker. The workers share the tracker of the chooser's
+            # process (see optimize_pts_parallel), where the block is already
+            # registered, so this is a no-op.
+            shm = shared_memory.SharedMemory(name=name)
+        try:
+            _worker_payload = pickle.loads(bytes(shm.buf[:size]))
+        finally:
+            shm.close()
+        _worker_name = name
+
+    (comp, pend, vals, model) = _worker_payload
+    return optimize_pt(c, b, comp, pend, vals, model)
 
 """
 Chooser module for the Gaussian process expected improvement (EI)
@@ -53,7 +81,11 @@ class GPEIOptChooser:
 
     def __init__(self, covar="Matern52", mcmc_iters=10,
                  pending_samples=100, noiseless=False, burnin=100,
-                 grid_subset=20, use_multiprocessing=True):
+                 grid_subset=20, use_multiprocessing=True, hyper_restarts=0,
+                 hyper_threads=1, num_inducing=0, solver="cholesky",
+                 log_ei=False, qmc_fantasies=False,
+                 antithetic_fantasies=False,
+                 pending_strategy="fantasies", refit_every=1):
         self.cov_func        = getattr(gp, covar)
         #self.locker          = Locker()
         #self.state_pkl       = os.path.join(expt_dir, self.__module__ + ".pkl")
@@ -68,6 +100,39 @@ class GPEIOptChooser:
         # Number of points to optimize EI over
         self.grid_subset     = int(grid_subset)
         self.noiseless       = bool(int(noiseless))
+        # Without MCMC, the number of random restarts of the hyperparameter
+        # fit and the number of threads they run in
+        self.hyper_restarts  = int(hyper_restarts)
+        self.hyper_threads   = int(hyper_threads)
+        # Without MCMC, refit the hyperparameters only once at least
+        # refit_every complete points were added since the last fit. In
+        # between, the optimum is kept, and so is the Cholesky factor of the
+        # complete points, which is then only extended with the new rows.
+        self.refit_every     = int(refit_every)
+        self.fit_size        = -1
+        # Number of inducing points of the sparse (FITC) GP used once there
+        # are more complete points than that; 0 always uses the exact GP
+        self.num_inducing    = int(num_inducing)
+        # Solver of the exact GP: "cholesky" factorizes the covariance, "cg"
+        # uses the iterative solvers of gp.IterativeSolver for large N
+        if solver not in ('cholesky', 'cg'):
+            raise Exception("Unknown solver %s" % solver)
+        self.solver          = solver
+        # Fantasies of the pending points from a scrambled Sobol sequence
+        # instead of independent draws, and/or in antithetic pairs, which
+        # need fewer pending_samples for the same variance of EI
+        self.qmc_fantasies        = bool(int(qmc_fantasies))
+        self.antithetic_fantasies = bool(int(antithetic_fantasies))
+        # How EI accounts for the pending points: "fantasies" averages it
+        # over fantasized outcomes, "penalize" multiplies it by local
+        # penalizers around them (see acquisition.LocalPenalizer), which
+        # needs no factorization and scales to many pending points
+        if pending_strategy not in ('fantasies', 'penalize'):
+            raise Exception("Unknown pending strategy %s" % pending_strategy)
+        self.pending_strategy     = pending_strategy
+        # Maximize the log of EI when optimizing the candidates, which keeps
+        # a gradient where EI underflows to zero far from the data
+        self.log_ei          = bool(int(log_ei))
         self.hyper_samples = []
 
         self.noise_scale = 0.1  # horseshoe prior
@@ -76,7 +141,96 @@ class GPEIOptChooser:
 
         # If multiprocessing fails or deadlocks, set this to False
         self.use_multiprocessing = bool(int(use_multiprocessing))
-
+        # Worker pool, created on first use and kept until close()
+        self.pool = None
+
+        # Cholesky factors of the covariance of the complete points, one per
+        # hyperparameter sample of the current next() (see release_chol_cache)
+        self.chol_cache  = gp.CholeskyCache(max_size=self.mcmc_iters+1)
+
+        # Posterior quantities that do not depend on the candidates, one per
+        # hyperparameter sample, for the data in posterior_data
+        self.posterior_cache = collections.OrderedDict()
+        self.posterior_data  = None
+
+        # Local penalizers of the pending points, one per hyperparameter
+        # sample, for the data in penalizer_data
+        self.penalizer_cache = collections.OrderedDict()
+        self.penalizer_data  = None
+
+        # The inducing points of the sparse GP, see gp.InducingPoints
+        self.inducing_points = gp.InducingPoints(self.num_inducing)
+
+
+    # The worker pool is not sent to the workers, nor the Cholesky factors
+    # of the complete points: the workers only read the cached posteriors
+    # (and penalizers), and a worker that needs a new posterior refactors.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool']       = None
+        state['chol_cache'] = gp.CholeskyCache(max_size=self.mcmc_iters+1)
+        return state
+
+    # Shut down the worker pool. The chooser can still be used afterwards,
+    # a new pool is then created when it is needed.
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Adjust the candidates cand2 (MxD) to maximize EI within the bounds b
+    # (one (min, max) per dimension), using func to compute minus EI and its
+    # gradient (by default summed over the hyperparameter samples).
+    #
+    # The EI of each candidate and its gradient only depend on that
+    # candidate, so all the starts are optimized together, with one
+    # vectorized EI and gradient evaluation per iteration instead of one
+    # optimizer run per start.
+    def optimize_pts(self, cand2, b, comp, pend, vals, func=None):
+        if func is None:
+            func = self.grad_optimize_ei_over_hypers
+        b = np.array(b, dtype=float)
+
+        def batch_func(x):
+            return func(x, comp, pend, vals, summed=False)
+
+        (cand2, ei) = util.batch_minimize(batch_func, cand2, b[:,0], b[:,1])
+        return cand2
+
+    # Optimize the candidates cand2 within the bounds b on the worker pool,
+    # a block of candidates per worker.
+    def optimize_pts_parallel(self, cand2, b, comp, pend, vals):
+        if self.pool is None:
+            # Start the resource tracker before the workers, so that they
+            # share it instead of each tracking the shared memory blocks
+            # they attach to as their own.
+            if os.name == 'posix':
+                resource_tracker.ensure_running()
+            self.pool_size = min(self.grid_subset, multiprocessing.cpu_count())
+            self.pool      = multiprocessing.Pool(self.pool_size)
+
+        # Share the data and the model (with its posterior cache, so that the
+        # workers do not refactor the covariances) once for all the starts.
+        data = pickle.dumps((comp, pend, vals, self),
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        try:
+            shm.buf[:len(data)] = data
+            results = [self.pool.apply_async(optimize_pt_shared,
+                                             args=(shm.name, len(data), c, b))
+                       for c in np.array_split(cand2, self.pool_size)
+                       if c.shape[0] > 0]
+            return np.vstack([res.get(1e8) for res in results])
+        finally:
+            shm.close()
+            shm.unlink()
 
     def dump_hypers(self):
         '''self.locker.lock_wait(self.state_pkl)
@@ -211,6 +365,52 @@ class GPEIOptChooser:
         else:
             return self.amp2 * self.cov_func(self.ls, x1, x2)
 
+    # The current hyperparameters as a hyperparameter sample
+    # (mean, noise, amp2, ls).
+    def current_hyper(self):
+        return (self.mean, self.noise, self.amp2, self.ls)
+
+    # The inducing points of the sparse GP for the complete points, or None
+    # if the exact GP is used (see gp.InducingPoints).
+    def inducing(self, comp, vals):
+        return self.inducing_points.select(self.cov_func.__name__, comp, vals)
+
+    # Cholesky of the noisy covariance of the complete points for the
+    # hyperparameter sample hyper. Cached per hyperparameter sample, and only
+    # extended with the new rows when points were added since the last call.
+    def comp_chol(self, comp, hyper):
+        (mean, noise, amp2, ls) = hyper
+
+        def noisy_cov(x1, x2=None):
+            if x2 is None:
+                return (amp2 * (self.cov_func(ls, x1, None) +
+                                1e-6*np.eye(x1.shape[0])) +
+                        noise*np.eye(x1.shape[0]))
+            else:
+                return amp2 * self.cov_func(ls, x1, x2)
+
+        return self.chol_cache.cholesky(self.chol_key(hyper), comp, noisy_cov)
+
+    # The key of the factor of the hyperparameter sample hyper in chol_cache.
+    def chol_key(self, hyper):
+        (mean, noise, amp2, ls) = hyper
+        return (amp2, noise, ls.tobytes())
+
+    # Drop the cached Cholesky factors at the end of next(), but the one of
+    # the point estimate if it may be kept for the next proposal.
+    def release_chol_cache(self):
+        if self.mcmc_iters == 0 and self.refit_every > 1:
+            self.chol_cache.retain(self.chol_key(self.current_hyper()))
+        else:
+            self.chol_cache.clear()
+
+    # Whether the point estimate of the hyperparameters has to be refitted
+    # for the complete points comp, see refit_every.
+    def needs_refit(self, comp):
+        n = comp.shape[0]
+        return (self.fit_size < 0 or n < self.fit_size or
+                n - self.fit_size >= self.refit_every)
+
     # Given a set of completed 'experiments' in the unit hypercube with
     # corresponding objective 'values', pick from the next experiment to
     # run according to the acquisition function.
@@ -272,26 +472,16 @@ class GPEIOptChooser:
 
             # Optimize each point in parallel
             if self.use_multiprocessing:
-                pool = multiprocessing.Pool(self.grid_subset)
-                results = [pool.apply_async(optimize_pt,args=(
-                            c,b,comp,pend,vals,copy.copy(self))) for c in cand2]
-                for res in results:
-                    cand = np.vstack((cand, res.get(1e8)))
-                pool.close()
+                cand = np.vstack((cand, self.optimize_pts_parallel(
+                            cand2, b, comp, pend, vals)))
             else:
-                # This is old code to optimize each point in parallel.
-                for i in range(0, cand2.shape[0]):
-                    log("Optimizing candidate %d/%d" %
-                        (i+1, cand2.shape[0]))
-                    #self.check_grad_ei(cand2[i,:].flatten(), comp, pend, vals)
-                    ret = spo.fmin_l_bfgs_b(self.grad_optimize_ei_over_hypers,
-                                            cand2[i,:].flatten(), args=(comp,pend,vals),
-                                            bounds=b, disp=0)
-                    cand2[i,:] = ret[0]
-                cand = np.vstack((cand, cand2))
+                log("Optimizing %d candidates" % cand2.shape[0])
+                cand = np.vstack((cand, self.optimize_pts(
+                            cand2, b, comp, pend, vals)))
 
             overall_ei = self.ei_over_hypers(comp,pend,cand,vals)
             best_cand = np.argmax(np.mean(overall_ei, axis=1))
+            self.release_chol_cache()
 
             if (best_cand >= numcand):
                 return (int(numcand), cand[best_cand,:])
@@ -300,7 +490,9 @@ class GPEIOptChooser:
 
         else:
             # Optimize hyperparameters
-            self.optimize_hypers(comp, vals)
+            if self.needs_refit(comp):
+                self.fit_size = comp.shape[0]
+                self.optimize_hypers(comp, vals)
 
             log("mean: %.2f  amp: %.2f  noise: %.4f  "
                              "min_ls: %.4f  max_ls: %.4f"
@@ -312,33 +504,31 @@ class GPEIOptChooser:
             for i in range(0, cand.shape[1]):
                 b.append((0, 1))
 
-            for i in range(0, cand2.shape[0]):
-                ret = spo.fmin_l_bfgs_b(self.grad_optimize_ei,
-                                        cand2[i,:].flatten(), args=(comp,vals,True),
-                                        bounds=b, disp=0)
-                cand2[i,:] = ret[0]
-            cand = np.vstack((cand, cand2))
+            cand = np.vstack((cand, self.optimize_pts(
+                        cand2, b, comp, pend, vals, self.grad_optimize_ei)))
 
             ei = self.compute_ei(comp, pend, cand, vals)
             best_cand = np.argmax(ei)
+            self.release_chol_cache()
 
             if (best_cand >= numcand):
                 return (int(numcand), cand[best_cand,:])
 
             return int(candidates[best_cand])
 
-    # Compute EI over hyperparameter samples
-    def ei_over_hypers(self,comp,pend,cand,vals):
-        overall_ei = np.zeros((cand.shape[0], self.mcmc_iters))
-        for mcmc_iter in range(self.mcmc_iters):
-            hyper = self.hyper_samples[mcmc_iter]
-            self.mean = hyper[0]
-            self.noise = hyper[1]
-            self.amp2 = hyper[2]
-            self.ls = hyper[3]
-            overall_ei[:,mcmc_iter] = self.compute_ei(comp, pend, cand,
-                                                      vals)
-        return overall_ei
+    # EI for all the hyperparameter samples (mean, noise, amp2, ls) (by
+    # default the current MCMC samples), see
+    # acquisition.ei_over_hypers. With the "penalize" pending strategy, EI is
+    # multiplied by the local penalizers of the pending points instead of
+    # being averaged over fantasies.
+    def ei_over_hypers(self, comp, pend, cand, vals, hyper_samples=None,
+                       top_k=None, block_size=1024):
+        if hyper_samples is None:
+            hyper_samples = self.hyper_samples[:self.mcmc_iters]
+        return acquisition.ei_over_hypers(self.cov_func, self.posterior, comp,
+                                          pend, cand, vals, hyper_samples,
+                                          top_k, block_size,
+                                          self.pending_strategy == 'penalize')
 
     def check_grad_ei(self, cand, comp, pend, vals):
         (ei,dx1) = self.grad_optimize_ei_over_hypers(cand, comp, pend, vals)
@@ -357,266 +547,253 @@ class GPEIOptChooser:
         time.sleep(2)
 
     # Adjust points by optimizing EI over a set of hyperparameter samples
-    def grad_optimize_ei_over_hypers(self, cand, comp, pend, vals, compute_grad=True):
+    def grad_optimize_ei_over_hypers(self, cand, comp, pend, vals, compute_grad=True,
+                                     summed=True):
+        if self.log_ei:
+            return self.log_ei_over_hypers(cand, comp, pend, vals, compute_grad,
+                                           summed)
+
         summed_ei = 0
-        summed_grad_ei = np.zeros(cand.shape).flatten()
-        ls = self.ls.copy()
-        amp2 = self.amp2
-        mean = self.mean
-        noise = self.noise
+        summed_grad_ei = 0
 
         for hyper in self.hyper_samples:
-            self.mean = hyper[0]
-            self.noise = hyper[1]
-            self.amp2 = hyper[2]
-            self.ls = hyper[3]
             if compute_grad:
-                (ei,g_ei) = self.grad_optimize_ei(cand,comp,pend,vals,compute_grad)
+                (ei,g_ei) = self.grad_optimize_ei(cand,comp,pend,vals,compute_grad,hyper,
+                                                  summed)
                 summed_grad_ei = summed_grad_ei + g_ei
             else:
-                ei = self.grad_optimize_ei(cand,comp,pend,vals,compute_grad)
+                ei = self.grad_optimize_ei(cand,comp,pend,vals,compute_grad,hyper,
+                                           summed)
             summed_ei += ei
 
-        self.mean = mean
-        self.amp2 = amp2
-        self.noise = noise
-        self.ls = ls.copy()
-
         if compute_grad:
             return (summed_ei, summed_grad_ei)
         else:
             return summed_ei
 
-    # Adjust points based on optimizing their ei
-    def grad_optimize_ei(self, cand, comp, pend, vals, compute_grad=True):
-        if pend.shape[0] == 0:
-            best = np.min(vals)
-            cand = np.reshape(cand, (-1, comp.shape[1]))
-
-            # The primary covariances for prediction.
-            comp_cov   = self.cov(comp)
-            cand_cross = self.cov(comp, cand)
-
-            # Compute the required Cholesky.
-            obsv_cov  = comp_cov + self.noise*np.eye(comp.shape[0])
-            obsv_chol = spla.cholesky(obsv_cov, lower=True)
-
-            cov_grad_func = getattr(gp, 'grad_' + self.cov_func.__name__)
-            cand_cross_grad = cov_grad_func(self.ls, comp, cand)
+    # Like grad_optimize_ei_over_hypers with log_ei: the log of EI summed
+    # over the hyperparameter samples, whose gradient is the sum of the
+    # samples' log EI gradients weighted by the softmax of their log EI.
+    def log_ei_over_hypers(self, cand, comp, pend, vals, compute_grad=True,
+                           summed=True):
+        results = [self.grad_optimize_ei(cand, comp, pend, vals, True, hyper,
+                                         False)
+                   for hyper in self.hyper_samples]
+        log_ei  = -np.array([res[0] for res in results])
+        log_sum = spsp.logsumexp(log_ei, axis=0)
+        if not compute_grad:
+            return log_sum
+
+        hyper_w = np.exp(log_ei - log_sum)
+        grad_xp = np.sum(hyper_w[:,:,np.newaxis] *
+                         np.array([res[1] for res in results]), axis=0)
+        if not summed:
+            return -log_sum, grad_xp
+
+        return -np.sum(log_sum), grad_xp.flatten()
+
+    # The posterior quantities that do not depend on the candidates, for the
+    # hyperparameter sample hyper = (mean, noise, amp2, ls), or the current
+    # hyperparameters if hyper is None. They are cached per hyperparameter
+    # sample, so that the acquisition optimizer only pays O(N^2) per
+    # evaluation of EI at a new candidate instead of refactoring the O(N^3)
+    # covariance.
+    #
+    # They are in the form of gp.exact_posterior: (obsv, chol_inv, alpha,
+    # bests). With the sparse GP, see gp.sparse_posterior. With the "cg"
+    # solver, the inverse Cholesky is replaced by the factor of
+    # gp.IterativeSolver.pred_factor.
+    def posterior(self, comp, pend, vals, hyper=None):
+        if hyper is None:
+            hyper = self.current_hyper()
+        (mean, noise, amp2, ls) = hyper
+
+        data = (comp, pend, vals)
+        if (self.posterior_data is None or
+            not all(np.array_equal(x, y) for (x, y) in zip(data, self.posterior_data))):
+            self.posterior_cache.clear()
+            self.posterior_data = data
+
+        key = (mean, amp2, noise, ls.tobytes())
+        if key in self.posterior_cache:
+            self.posterior_cache.move_to_end(key)
+            return self.posterior_cache[key]
+
+        self.posterior_cache[key] = self.new_posterior(comp, pend, vals, hyper)
+        while len(self.posterior_cache) > self.mcmc_iters+1:
+            self.posterior_cache.popitem(last=False)
+
+        return self.posterior_cache[key]
+
+    # The uncached posterior. The fantasies are drawn from a copy of the
+    # saved random state, so that they are the same on every call without
+    # resetting the global random state.
+    def new_posterior(self, comp, pend, vals, hyper):
+        normals = None
+        if pend.shape[0] > 0:
+            randomstate = npr.RandomState()
+            randomstate.set_state(self.randomstate)
+            normals = self.fantasy_normals(pend.shape[0], randomstate)
+
+        return gp.posterior(self.cov_func, comp, pend, vals, hyper, normals,
+                            self.inducing(comp, vals), self.solver,
+                            self.comp_chol)
 
-            # Predictive things.
-            # Solve the linear systems.
-            alpha  = spla.cho_solve((obsv_chol, True), vals - self.mean)
-            beta   = spla.solve_triangular(obsv_chol, cand_cross, lower=True)
-
-            # Predict the marginal means and variances at candidates.
-            func_m = np.dot(cand_cross.T, alpha) + self.mean
-            func_v = self.amp2*(1+1e-6) - np.sum(beta**2, axis=0)
+    # Adjust points based on optimizing their ei
+    # for the hyperparameter sample hyper, or the current hyperparameters if
+    # hyper is None. Returns minus EI summed over the candidates and its
+    # gradient, or if not summed minus EI of each candidate and the MxD
+    # gradients. With log_ei, EI is replaced by its log.
+    def grad_optimize_ei(self, cand, comp, pend, vals, compute_grad=True, hyper=None,
+                         summed=True):
+        if hyper is None:
+            hyper = self.current_hyper()
+        (mean, noise, amp2, ls) = hyper
+        cand = np.reshape(cand, (-1, comp.shape[1]))
+
+        # With the "penalize" pending strategy, EI without the pending points
+        # times the local penalizer.
+        penalizer = None
+        if pend.shape[0] > 0 and self.pending_strategy == 'penalize':
+            penalizer = self.local_penalizer(comp, pend, vals, hyper)
+            pend = pend[:0]
+
+        (obsv, chol_inv, alpha, bests) = self.posterior(comp, pend, vals, hyper)
+
+        # The covariances between the observed points and the candidates.
+        # The gradients are derived from the same distances.
+        kern       = gp.get_kernel(self.cov_func.__name__, ls, obsv, cand)
+        cand_cross = amp2 * kern.cov
+
+        # Solve the linear systems, with the inverse Cholesky (or the
+        # predictive factor of the sparse GP).
+        beta   = np.dot(chol_inv, cand_cross)
+
+        # Predict the marginal means and variances at candidates.
+        func_m = np.dot(cand_cross.T, alpha) + mean
+        func_v = amp2*(1+1e-6) - np.sum(beta**2, axis=0)
+
+        # Expected improvement, or its log (see log_ei), and its gradients
+        # w.r.t. the mean and the standard deviation.
+        if self.log_ei:
+            ei_func = acquisition.log_expected_improvement
+        else:
+            ei_func = acquisition.expected_improvement
 
-            # Expected improvement
+        if pend.shape[0] == 0:
             func_s = np.sqrt(func_v)
-            u      = (best - func_m) / func_s
-            ncdf   = sps.norm.cdf(u)
-            npdf   = sps.norm.pdf(u)
-            ei     = func_s*( u*ncdf + npdf)
-
             if not compute_grad:
-                return ei
-
-            # Gradients of ei w.r.t. mean and variance
-            g_ei_m = -ncdf
-            g_ei_s2 = 0.5*npdf / func_s
-
-            # Apply covariance function
-            grad_cross = np.squeeze(cand_cross_grad)
-
-            grad_xp_m = np.dot(alpha.transpose(),grad_cross)
-            grad_xp_v = np.dot(-2*spla.cho_solve(
-                    (obsv_chol, True),cand_cross).transpose(), grad_cross)
-
-            grad_xp = 0.5*self.amp2*(grad_xp_m*g_ei_m + grad_xp_v*g_ei_s2)
+                ei = ei_func(bests, func_m, func_s)
+                if penalizer is None:
+                    return ei
+                log_pen = penalizer.log_penalty(cand)
+                return ei + log_pen if self.log_ei else ei*np.exp(log_pen)
+
+            (ei, g_ei_m, g_ei_s) = ei_func(bests, func_m, func_s, grad=True)
+            g_ei_s2 = 0.5*g_ei_s / func_s
+
+            # Apply covariance function. The gradients of the mean and the
+            # variance w.r.t. a candidate are sums over the observed points of
+            # alpha and -2 K^-1 k times the covariance gradients, so the
+            # chain rule through EI gives one weight per observed point and
+            # candidate, contracted without forming the NxMxD gradients.
+            gamma   = np.dot(chol_inv.T, beta)
+            weights = alpha[:,np.newaxis]*g_ei_m - 2*gamma*g_ei_s2
+            grad_xp = amp2*kern.grad_x(weights)
+
+            # Multiply EI by the penalty, or add its log to log EI. grad_xp
+            # is the gradient of minus EI.
+            if penalizer is not None:
+                (log_pen, g_log_pen) = penalizer.log_penalty(cand, grad=True)
+                if self.log_ei:
+                    ei      = ei + log_pen
+                    grad_xp = grad_xp - g_log_pen
+                else:
+                    pen     = np.exp(log_pen)
+                    grad_xp = pen[:,np.newaxis]*(grad_xp - ei[:,np.newaxis]*g_log_pen)
+                    ei      = ei*pen
+
+            if not summed:
+                return -ei, grad_xp
             ei = -np.sum(ei)
 
             return ei, grad_xp.flatten()
 
         else:
-            # If there are pending experiments, fantasize their outcomes.
-            cand = np.reshape(cand, (-1, comp.shape[1]))
-
-            # Create a composite vector of complete and pending.
-            comp_pend = np.concatenate((comp, pend))
-
-            # Compute the covariance and Cholesky decomposition.
-            comp_pend_cov  = (self.cov(comp_pend) +
-                              self.noise*np.eye(comp_pend.shape[0]))
-            comp_pend_chol = spla.cholesky(comp_pend_cov, lower=True)
-
-            # Compute submatrices.
-            pend_cross = self.cov(comp, pend)
-            pend_kappa = self.cov(pend)
-
-            # Use the sub-Cholesky.
-            obsv_chol = comp_pend_chol[:comp.shape[0],:comp.shape[0]]
-
-            # Solve the linear systems.
-            alpha  = spla.cho_solve((obsv_chol, True), vals - self.mean)
-            beta   = spla.cho_solve((obsv_chol, True), pend_cross)
-
-            # Finding predictive means and variances.
-            pend_m = np.dot(pend_cross.T, alpha) + self.mean
-            pend_K = pend_kappa - np.dot(pend_cross.T, beta)
-
-            # Take the Cholesky of the predictive covariance.
-            pend_chol = spla.cholesky(pend_K, lower=True)
-
-            # Make predictions.
-            npr.set_state(self.randomstate)
-            pend_fant = np.dot(pend_chol, npr.randn(pend.shape[0],self.pending_samples)) + pend_m[:,None]
-
-            # Include the fantasies.
-            fant_vals = np.concatenate(
-                (np.tile(vals[:,np.newaxis],
-                         (1,self.pending_samples)), pend_fant))
-
-            # Compute bests over the fantasies.
-            bests = np.min(fant_vals, axis=0)
-
-            # Now generalize from these fantasies.
-            cand_cross = self.cov(comp_pend, cand)
-            cov_grad_func = getattr(gp, 'grad_' + self.cov_func.__name__)
-            cand_cross_grad = cov_grad_func(self.ls, comp_pend, cand)
-
-            # Solve the linear systems.
-            alpha  = spla.cho_solve((comp_pend_chol, True),
-                                    fant_vals - self.mean)
-            beta   = spla.solve_triangular(comp_pend_chol, cand_cross,
-                                           lower=True)
-
-            # Predict the marginal means and variances at candidates.
-            func_m = np.dot(cand_cross.T, alpha) + self.mean
-            func_v = self.amp2*(1+1e-6) - np.sum(beta**2, axis=0)
-
-            # Expected improvement
             func_s = np.sqrt(func_v[:,np.newaxis])
-            u      = (bests[np.newaxis,:] - func_m) / func_s
-            ncdf   = sps.norm.cdf(u)
-            npdf   = sps.norm.pdf(u)
-            ei     = func_s*( u*ncdf + npdf)
-
-            # Gradients of ei w.r.t. mean and variance
-            g_ei_m = -ncdf
-            g_ei_s2 = 0.5*npdf / func_s
-
-            # Apply covariance function
-            # Squeeze can break the 1D case be careful
-            if pend.shape[1] == 1:
-                grad_cross = np.squeeze(cand_cross_grad, axis=(2,))
+            (ei, g_ei_m, g_ei_s) = ei_func(bests[np.newaxis,:], func_m, func_s,
+                                           grad=True)
+
+            # Average EI over the fantasies. The log of the average of the
+            # fantasies' EI weights their gradients by the softmax of their
+            # log EI instead of equally.
+            if self.log_ei:
+                log_mean = spsp.logsumexp(ei, axis=1) - np.log(ei.shape[1])
+                fant_w   = np.exp(ei - log_mean[:,np.newaxis]) / ei.shape[1]
+                ei       = log_mean
             else:
-                grad_cross = np.squeeze(cand_cross_grad)
-
-            grad_xp_m = np.dot(alpha.transpose(),grad_cross)
-            grad_xp_v = np.dot(-2*spla.cho_solve(
-                    (comp_pend_chol, True),cand_cross).transpose(), grad_cross)
-
-            grad_xp = 0.5*self.amp2*(grad_xp_m*np.tile(g_ei_m,(comp.shape[1],1)).T + (grad_xp_v.T*g_ei_s2).T)
-            ei = -np.mean(ei, axis=1)
-            grad_xp = np.mean(grad_xp,axis=0)
+                fant_w   = 1.0 / ei.shape[1]
+                ei       = np.mean(ei, axis=1)
+            g_ei_m  = fant_w*g_ei_m
+            g_ei_s2 = 0.5*np.sum(fant_w*g_ei_s, axis=1) / func_s[:,0]
+
+            # Apply covariance function, as above.
+            gamma   = np.dot(chol_inv.T, beta)
+            weights = np.dot(alpha, g_ei_m.T) - 2*gamma*g_ei_s2
+            grad_xp = amp2*kern.grad_x(weights)
+            if not summed:
+                return -ei, grad_xp
+            ei = -np.sum(ei)
 
             return ei, grad_xp.flatten()
 
-    def compute_ei(self, comp, pend, cand, vals):
-        if pend.shape[0] == 0:
-            # If there are no pending, don't do anything fancy.
-
-            # Current best.
-            best = np.min(vals)
-
-            # The primary covariances for prediction.
-            comp_cov   = self.cov(comp)
-            cand_cross = self.cov(comp, cand)
-
-            # Compute the required Cholesky.
-            obsv_cov  = comp_cov + self.noise*np.eye(comp.shape[0])
-            obsv_chol = spla.cholesky( obsv_cov, lower=True )
-
-            # Solve the linear systems.
-            alpha  = spla.cho_solve((obsv_chol, True), vals - self.mean)
-            beta   = spla.solve_triangular(obsv_chol, cand_cross, lower=True)
-
-            # Predict the marginal means and variances at candidates.
-            func_m = np.dot(cand_cross.T, alpha) + self.mean
-            func_v = self.amp2*(1+1e-6) - np.sum(beta**2, axis=0)
-
-            # Expected improvement
-            func_s = np.sqrt(func_v)
-            u      = (best - func_m) / func_s
-            ncdf   = sps.norm.cdf(u)
-            npdf   = sps.norm.pdf(u)
-            ei     = func_s*( u*ncdf + npdf)
-
-            return ei
-        else:
-            # If there are pending experiments, fantasize their outcomes.
-
-            # Create a composite vector of complete and pending.
-            comp_pend = np.concatenate((comp, pend))
-
-            # Compute the covariance and Cholesky decomposition.
-            comp_pend_cov  = (self.cov(comp_pend) +
-                              self.noise*np.eye(comp_pend.shape[0]))
-            comp_pend_chol = spla.cholesky(comp_pend_cov, lower=True)
-
-            # Compute submatrices.
-            pend_cross = self.cov(comp, pend)
-            pend_kappa = self.cov(pend)
-
-            # Use the sub-Cholesky.
-            obsv_chol = comp_pend_chol[:comp.shape[0],:comp.shape[0]]
-
-            # Solve the linear systems.
-            alpha  = spla.cho_solve((obsv_chol, True), vals - self.mean)
-            beta   = spla.cho_solve((obsv_chol, True), pend_cross)
-
-            # Finding predictive means and variances.
-            pend_m = np.dot(pend_cross.T, alpha) + self.mean
-            pend_K = pend_kappa - np.dot(pend_cross.T, beta)
-
-            # Take the Cholesky of the predictive covariance.
-            pend_chol = spla.cholesky(pend_K, lower=True)
-
-            # Make predictions.
-            npr.set_state(self.randomstate)
-            pend_fant = np.dot(pend_chol, npr.randn(pend.shape[0],self.pending_samples)) + pend_m[:,None]
-
-            # Include the fantasies.
-            fant_vals = np.concatenate(
-                (np.tile(vals[:,np.newaxis],
-                         (1,self.pending_samples)), pend_fant))
-
-            # Compute bests over the fantasies.
-            bests = np.min(fant_vals, axis=0)
-
-            # Now generalize from these fantasies.
-            cand_cross = self.cov(comp_pend, cand)
-
-            # Solve the linear systems.
-            alpha  = spla.cho_solve((comp_pend_chol, True),
-                                    fant_vals - self.mean)
-            beta   = spla.solve_triangular(comp_pend_chol, cand_cross,
-                                           lower=True)
-
-            # Predict the marginal means and variances at candidates.
-            func_m = np.dot(cand_cross.T, alpha) + self.mean
-            func_v = self.amp2*(1+1e-6) - np.sum(beta**2, axis=0)
-
-            # Expected improvement
-            func_s = np.sqrt(func_v[:,np.newaxis])
-            u      = (bests[np.newaxis,:] - func_m) / func_s
-            ncdf   = sps.norm.cdf(u)
-            npdf   = sps.norm.pdf(u)
-            ei     = func_s*( u*ncdf + npdf)
-
-            return np.mean(ei, axis=1)
+    # Standard normal draws (num_pend x pending_samples) for the fantasies of
+    # the pending points, from randomstate, see acquisition.fantasy_normals.
+    def fantasy_normals(self, num_pend, randomstate):
+        return acquisition.fantasy_normals(num_pend, self.pending_samples,
+                                           randomstate, self.qmc_fantasies,
+                                           self.antithetic_fantasies)
+
+    # The local penalizer of the pending points for the hyperparameter
+    # sample hyper, see acquisition.local_penalizer. Penalizers are cached
+    # like the posteriors, since the acquisition optimizer asks for them at
+    # every evaluation.
+    def local_penalizer(self, comp, pend, vals, hyper):
+        (mean, noise, amp2, ls) = hyper
+
+        data = (comp, pend, vals)
+        if (self.penalizer_data is None or
+            not all(np.array_equal(x, y) for (x, y) in zip(data, self.penalizer_data))):
+            self.penalizer_cache.clear()
+            self.penalizer_data = data
+
+        key = (mean, amp2, noise, ls.tobytes())
+        if key not in self.penalizer_cache:
+            self.penalizer_cache[key] = self.new_local_penalizer(comp, pend,
+                                                                 vals, hyper)
+            while len(self.penalizer_cache) > self.mcmc_iters+1:
+                self.penalizer_cache.popitem(last=False)
+
+        self.penalizer_cache.move_to_end(key)
+        return self.penalizer_cache[key]
+
+    # The uncached local_penalizer.
+    def new_local_penalizer(self, comp, pend, vals, hyper):
+        post = self.posterior(comp, pend[:0], vals, hyper)
+        return acquisition.local_penalizer(self.cov_func, hyper, post, comp,
+                                           pend)
+
+    # EI of the candidates for the current hyperparameters. With an iterator
+    # of candidate blocks or top_k, returns only the top_k candidates and
+    # their EI, see ei_over_hypers.
+    def compute_ei(self, comp, pend, cand, vals, top_k=None):
+        hyper = self.current_hyper()
+        if isinstance(cand, np.ndarray) and top_k is None:
+            return self.ei_over_hypers(comp, pend, cand, vals, [hyper])[:,0]
+
+        (top_cand, ei) = self.ei_over_hypers(comp, pend, cand, vals, [hyper],
+                                             top_k)
+        return top_cand, ei[:,0]
 
     def sample_hypers(self, comp, vals):
         if self.noiseless:
@@ -628,21 +805,22 @@ class GPEIOptChooser:
         self.hyper_samples.append((self.mean, self.noise, self.amp2, self.ls))
 
     def _sample_ls(self, comp, vals):
+        inducing = self.inducing(comp, vals)
+
         def logprob(ls):
             if np.any(ls < 0) or np.any(ls > self.max_ls):
                 return -np.inf
 
-            cov   = (self.amp2 * (self.cov_func(ls, comp, None) +
-                1e-6*np.eye(comp.shape[0])) + self.noise*np.eye(comp.shape[0]))
-            chol  = spla.cholesky(cov, lower=True)
-            solve = spla.cho_solve((chol, True), vals - self.mean)
-            lp    = (-np.sum(np.log(np.diag(chol))) -
-                      0.5*np.dot(vals-self.mean, solve))
-            return lp
+            return gp.log_likelihood(self.cov_func, comp, vals,
+                                     (self.mean, self.noise, self.amp2, ls),
+                                     inducing, self.solver)
 
         self.ls = util.slice_sample(self.ls, logprob, compwise=True)
 
     def _sample_noisy(self, comp, vals):
+        lik = gp.fixed_ls_likelihood(self.cov_func, self.ls, comp, vals,
+                                     self.inducing(comp, vals), self.solver)
+
         def logprob(hypers):
             mean  = hypers[0]
             amp2  = hypers[1]
@@ -655,11 +833,7 @@ class GPEIOptChooser:
             if amp2 < 0 or noise < 0:
                 return -np.inf
 
-            cov   = (amp2 * (self.cov_func(self.ls, comp, None) +
-                1e-6*np.eye(comp.shape[0])) + noise*np.eye(comp.shape[0]))
-            chol  = spla.cholesky(cov, lower=True)
-            solve = spla.cho_solve((chol, True), vals - mean)
-            lp    = -np.sum(np.log(np.diag(chol)))-0.5*np.dot(vals-mean, solve)
+            lp    = lik(mean, amp2, noise)
 
             # Roll in noise horseshoe prior.
             lp += np.log(np.log(1 + (self.noise_scale/noise)**2))
@@ -676,6 +850,9 @@ class GPEIOptChooser:
         self.noise = hypers[2]
 
     def _sample_noiseless(self, comp, vals):
+        lik = gp.fixed_ls_likelihood(self.cov_func, self.ls, comp, vals,
+                                     self.inducing(comp, vals), self.solver)
+
         def logprob(hypers):
             mean  = hypers[0]
             amp2  = hypers[1]
@@ -688,11 +865,7 @@ class GPEIOptChooser:
             if amp2 < 0:
                 return -np.inf
 
-            cov   = (amp2 * (self.cov_func(self.ls, comp, None) +
-                1e-6*np.eye(comp.shape[0])) + noise*np.eye(comp.shape[0]))
-            chol  = spla.cholesky(cov, lower=True)
-            solve = spla.cho_solve((chol, True), vals - mean)
-            lp    = -np.sum(np.log(np.diag(chol)))-0.5*np.dot(vals-mean, solve)
+            lp    = lik(mean, amp2, noise)
 
             # Roll in amplitude lognormal prior
             lp -= 0.5*(np.log(np.sqrt(amp2))/self.amp2_scale)**2
@@ -708,7 +881,13 @@ class GPEIOptChooser:
     def optimize_hypers(self, comp, vals):
         mygp = gp.GP(self.cov_func.__name__)
         mygp.real_init(comp.shape[1], vals)
-        mygp.optimize_hypers(comp,vals)
+        # Warm start from the previous fit (or the initial values), which
+        # changes little when a point is added.
+        mygp.optimize_hypers(comp, vals, init=(self.amp2, self.noise, self.ls),
+                             restarts=self.hyper_restarts,
+                             threads=self.hyper_threads,
+                             inducing=self.inducing(comp, vals),
+                             solver=self.solver)
         self.mean = mygp.mean
         self.ls = mygp.ls
         self.amp2 = mygp.amp2
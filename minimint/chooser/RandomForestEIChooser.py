@@ -1,9 +1,9 @@
 import numpy        as np
 import numpy.random as npr
-import scipy.stats  as sps
 import sklearn.ensemble
 import sklearn.ensemble.forest
 from minimint import util
+from minimint import acquisition
 
 from sklearn.externals.joblib import Parallel, delayed
 
@@ -76,10 +76,7 @@ class RandomForestEIChooser:
 
         # Expected improvement
         func_s = np.sqrt(func_v) + 0.0001
-        u      = (best - func_m) / func_s
-        ncdf   = sps.norm.cdf(u)
-        npdf   = sps.norm.pdf(u)
-        ei     = func_s*( u*ncdf + npdf)
+        ei     = acquisition.expected_improvement(best, func_m, func_s)
 
         best_cand = np.argmax(ei)
         ei.sort()
@@ -22,7 +22,11 @@
 """
 gp.py contains utility functions related to computation in Gaussian processes.
 """
+import collections
+import concurrent.futures
+import threading
 import numpy as np
+import numpy.random as npr
 import scipy.linalg as spla
 import scipy.optimize as spo
 import scipy.io as sio
@@ -34,102 +38,1036 @@ SQRT_5 = np.sqrt(5.0)
 def dist2(ls, x1, x2=None):
     # Assumes NxD and MxD matrices.
     # Compute the squared distance matrix, given length scales.
+    # If ls is a SxD matrix of S sets of length scales, returns the SxNxM
+    # squared distances for all of them, so that all the covariance functions
+    # below can evaluate S hyperparameter samples at once.
 
     if x2 is None:
         # Find distance with self for x1.
 
         # Rescale.
-        xx1 = x1 / ls
+        xx1 = x1 / ls[...,np.newaxis,:]
         xx2 = xx1
 
     else:
         # Rescale.
-        xx1 = x1 / ls
-        xx2 = x2 / ls
+        xx1 = x1 / ls[...,np.newaxis,:]
+        xx2 = x2 / ls[...,np.newaxis,:]
 
-    r2 = np.maximum(-(np.dot(xx1, 2*xx2.T)
-                       - np.sum(xx1*xx1, axis=1)[:,np.newaxis]
-                       - np.sum(xx2*xx2, axis=1)[:,np.newaxis].T), 0.0)
+    r2 = np.maximum(-(np.matmul(xx1, 2*np.swapaxes(xx2, -1, -2))
+                       - np.sum(xx1*xx1, axis=-1)[...,:,np.newaxis]
+                       - np.sum(xx2*xx2, axis=-1)[...,np.newaxis,:]), 0.0)
 
     return r2
 
 def grad_dist2(ls, x1, x2=None):
+    # The NxMxD gradients of the squared distances w.r.t. x1.
     if x2 is None:
         x2 = x1
 
-    # Rescale.
-    x1 = x1 / ls
-    x2 = x2 / ls
-
-    N = x1.shape[0]
-    M = x2.shape[0]
-    D = x1.shape[1]
-    gX = np.zeros((x1.shape[0],x2.shape[0],x1.shape[1]))
-
-    code = \
-    """
-    for (int i=0; i<N; i++)
-      for (int j=0; j<M; j++)
-        for (int d=0; d<D; d++)
-          gX(i,j,d) = (2/ls(d))*(x1(i,d) - x2(j,d));
-    """
-    try:
-        scipy.weave.inline(code, ['x1','x2','gX','ls','M','N','D'], \
-                       type_converters=scipy.weave.converters.blitz, \
-                       compiler='gcc')
-    except:
-        # The C code weave above is 10x faster than this:
-        for i in range(0,x1.shape[0]):
-            gX[i,:,:] = 2*(x1[i,:] - x2[:,:])*(1/ls)
+    return 2*(x1[:,np.newaxis,:] - x2[np.newaxis,:,:]) / ls**2
+
+def grad_from_r2(grad_r2, ls, x1, x2=None, weights=None):
+    # The gradients w.r.t. x1 of a covariance function of the squared
+    # distance, given its NxM derivatives grad_r2 w.r.t. the squared
+    # distances. Without weights, returns the NxMxD gradients. With NxM
+    # weights, returns only their weighted sums over x1 (MxD),
+    #   sum_n weights[n,m] * dk(x1[n],x2[m])/dx1[n],
+    # e.g. alpha^T dK/dx for a candidate, as two matrix products and without
+    # ever forming the NxMxD array.
+    if weights is None:
+        return grad_r2[:,:,np.newaxis] * grad_dist2(ls, x1, x2)
+
+    if x2 is None:
+        x2 = x1
+
+    a = weights * grad_r2
+    return 2*(np.dot(a.T, x1) - np.sum(a, axis=0)[:,np.newaxis]*x2) / ls**2
+
+class Kernel:
+    '''
+    A covariance function evaluated between x1 (NxD) and x2 (MxD, or x1 if
+    None) for the length scales ls.
+
+    The squared distances are computed once, and the covariance (cov), its
+    gradients w.r.t. the inputs x1 (grad_x) and w.r.t. the length scales
+    (grad_ls) are all derived from them. Both gradients can be contracted
+    with NxM weights, in which case the NxMxD array is never formed.
+
+    covar is the name of one of the covariance functions below.
+    '''
+    def __init__(self, covar, ls, x1, x2=None):
+        if covar not in ('SE', 'ARDSE', 'Matern32', 'Matern52'):
+            raise Exception("Unknown covariance function %s" % covar)
+        if covar == 'SE':
+            ls = np.ones(ls.shape)
+
+        self.covar = covar
+        self.ls    = ls
+        self.x1    = x1
+        self.x2    = x1 if x2 is None else x2
+        self.r2    = dist2(ls, x1, x2)
+
+        if covar in ('SE', 'ARDSE'):
+            self.cov = np.exp(-0.5 * self.r2)
+        elif covar == 'Matern32':
+            self.r   = np.sqrt(self.r2)
+            self.cov = (1 + SQRT_3*self.r) * np.exp(-SQRT_3*self.r)
+        else:
+            self.r   = np.sqrt(np.abs(self.r2))
+            self.cov = ((1.0 + SQRT_5*self.r + (5.0/3.0)*self.r2) *
+                        np.exp(-SQRT_5*self.r))
 
-    return gX
+        self._grad_r2 = None
+
+    def grad_r2(self):
+        # The derivatives of the covariance w.r.t. the squared distances.
+        if self._grad_r2 is None:
+            if self.covar in ('SE', 'ARDSE'):
+                self._grad_r2 = -0.5*self.cov
+            elif self.covar == 'Matern32':
+                self._grad_r2 = -1.5*np.exp(-SQRT_3*self.r)
+            else:
+                self._grad_r2 = (-(5.0/6.0)*np.exp(-SQRT_5*self.r)*
+                                 (1 + SQRT_5*self.r))
+        return self._grad_r2
+
+    def grad_x(self, weights=None):
+        # The NxMxD gradients w.r.t. x1, or with NxM weights their weighted
+        # sums over x1 (MxD), see grad_from_r2.
+        return grad_from_r2(self.grad_r2(), self.ls, self.x1, self.x2, weights)
+
+    def grad_ls(self, weights=None):
+        # The NxMxD gradients w.r.t. the length scales, or with NxM weights
+        # their weighted sums over all the pairs (D), without forming the
+        # NxMxD array:
+        #   sum_nm a[n,m]*(x1[n]-x2[m])**2
+        #     = x1**2 . rowsums(a) + x2**2 . colsums(a) - 2*sum_n x1[n]*(a x2)[n]
+        # The SE length scales are fixed to one, so their gradients are zero.
+        if self.covar == 'SE':
+            if weights is None:
+                return np.zeros(self.cov.shape + self.ls.shape)
+            return np.zeros(self.ls.shape)
+
+        if weights is None:
+            diff2 = (self.x1[:,np.newaxis,:] - self.x2[np.newaxis,:,:])**2
+            return -2*self.grad_r2()[:,:,np.newaxis] * diff2 / self.ls**3
+
+        a = weights * self.grad_r2()
+        s = (np.dot(np.sum(a, axis=1), self.x1**2) +
+             np.dot(np.sum(a, axis=0), self.x2**2) -
+             2*np.sum(self.x1*np.dot(a, self.x2), axis=0))
+        return -2*s / self.ls**3
 
 def SE(ls, x1, x2=None, grad=False):
-    ls = np.ones(ls.shape)
-    cov = np.exp(-0.5 * dist2(ls, x1, x2))
+    kern = Kernel('SE', ls, x1, x2)
     if grad:
-        return (cov, grad_ARDSE(ls, x1, x2))
+        return (kern.cov, kern.grad_x())
     else:
-        return cov
+        return kern.cov
 
 def ARDSE(ls, x1, x2=None, grad=False):
-    cov = np.exp(-0.5 * dist2(ls, x1, x2))
+    kern = Kernel('ARDSE', ls, x1, x2)
     if grad:
-        return (cov, grad_ARDSE(ls, x1, x2))
+        return (kern.cov, kern.grad_x())
     else:
-        return cov
+        return kern.cov
 
-def grad_ARDSE(ls, x1, x2=None):
-    r2 = dist2(ls, x1, x2)
-    r  = np.sqrt(r2)
-    return -0.5*np.exp(-0.5*r2)[:,:,np.newaxis] * grad_dist2(ls, x1, x2)
+def grad_ARDSE(ls, x1, x2=None, weights=None):
+    return Kernel('ARDSE', ls, x1, x2).grad_x(weights)
 
 def Matern32(ls, x1, x2=None, grad=False):
-    r   = np.sqrt(dist2(ls, x1, x2))
-    cov = (1 + SQRT_3*r) * np.exp(-SQRT_3*r)
+    kern = Kernel('Matern32', ls, x1, x2)
     if grad:
-        return (cov, grad_Matern32(ls, x1, x2))
+        return (kern.cov, kern.grad_x())
     else:
-        return cov
+        return kern.cov
 
-def grad_Matern32(ls, x1, x2=None):
-    r       = np.sqrt(dist2(ls, x1, x2))
-    grad_r2 = -1.5*np.exp(-SQRT_3*r)
-    return grad_r2[:,:,np.newaxis] * grad_dist2(ls, x1, x2)
+def grad_Matern32(ls, x1, x2=None, weights=None):
+    return Kernel('Matern32', ls, x1, x2).grad_x(weights)
 
 def Matern52(ls, x1, x2=None, grad=False):
-    r2  = np.abs(dist2(ls, x1, x2))
-    r   = np.sqrt(r2)
-    cov = (1.0 + SQRT_5*r + (5.0/3.0)*r2) * np.exp(-SQRT_5*r)
+    kern = Kernel('Matern52', ls, x1, x2)
+    if grad:
+        return (kern.cov, kern.grad_x())
+    else:
+        return kern.cov
+
+def grad_Matern52(ls, x1, x2=None, weights=None):
+    return Kernel('Matern52', ls, x1, x2).grad_x(weights)
+
+# Number of random Fourier features of the RFF_ covariance functions
+NUM_FOURIER_FEATURES = 512
+
+class FourierFeatures:
+    '''
+    Random Fourier features of the ARDSE, Matern32 or Matern52 covariance
+    function: num_features/2 frequencies w drawn from its spectral density
+    (a normal for ARDSE, a Student-t with 2*nu degrees of freedom for the
+    Materns), so that with the features
+        phi(x) = sqrt(2/num_features) [cos(w.x/ls), sin(w.x/ls)]
+    phi(x1).phi(x2) is an unbiased estimate of the covariance of x1 and x2.
+
+    A GP with the covariance phi(x1).phi(x2) is Bayesian linear regression
+    on the features. The feature weights then play the role of inducing
+    points: they are a priori independent and the correlations between the
+    inputs and the weights are the features, so that FITC with the weights
+    as inducing points is exact, at O(N*F^2) for F features. The RFF_
+    covariance functions take this object in place of the points for the
+    weights.
+
+    The frequencies are drawn from a fixed seed, so that the approximate
+    covariance is the same in every process.
+    '''
+    def __init__(self, covar, dims, num_features=NUM_FOURIER_FEATURES, seed=0):
+        rs    = npr.RandomState(seed)
+        freqs = rs.randn(num_features//2, dims)
+        if covar == 'Matern32':
+            freqs *= np.sqrt(3.0 / rs.chisquare(3, (num_features//2, 1)))
+        elif covar == 'Matern52':
+            freqs *= np.sqrt(5.0 / rs.chisquare(5, (num_features//2, 1)))
+        elif covar != 'ARDSE':
+            raise Exception("No Fourier features for covariance function %s"
+                            % covar)
+
+        self.covar        = covar
+        self.num_features = 2*(num_features//2)
+        self.freqs        = np.vstack((freqs, freqs))
+        self.scale        = np.sqrt(2.0 / self.num_features)
+
+    def _phases(self, ls, x):
+        return np.matmul(x / ls[...,np.newaxis,:],
+                         self.freqs[:self.num_features//2].T)
+
+    def features(self, ls, x):
+        # The NxF features of x (SxNxF for SxD length scales).
+        p = self._phases(ls, x)
+        return self.scale * np.concatenate((np.cos(p), np.sin(p)), axis=-1)
+
+    def grad_features(self, ls, x):
+        # The NxF derivatives of the features of x w.r.t. their phases; the
+        # gradient of feature f w.r.t. x is that times freqs[f]/ls.
+        p = self._phases(ls, x)
+        return self.scale * np.concatenate((-np.sin(p), np.cos(p)), axis=-1)
+
+# The Fourier features of each RFF_ covariance function and dimensionality
+_fourier_features = {}
+
+def fourier_features(covar, dims):
+    # The FourierFeatures of the covariance function named covar in dims
+    # dimensions, or None if it is not one of the RFF_ covariance functions.
+    if not covar.startswith('RFF_'):
+        return None
+
+    key = (covar[4:], dims)
+    if key not in _fourier_features:
+        _fourier_features[key] = FourierFeatures(covar[4:], dims)
+    return _fourier_features[key]
+
+class FourierKernel:
+    '''
+    The covariance phi(x1).phi(x2) of the random Fourier features of a
+    covariance function, with the interface of Kernel. Either x1 or x2 can
+    be the FourierFeatures themselves, standing for the feature weights:
+    the covariance of the weights and the points x is then phi(x) (FxM for
+    the weights as x1), and that of the weights with themselves the
+    identity.
+
+    The gradients w.r.t. the weights as x1 follow the stationary kernels,
+    for which the gradients w.r.t. x1 and x2 are opposite: they are minus
+    the gradients w.r.t. x2.
+    '''
+    def __init__(self, covar, ls, x1, x2=None):
+        self.ls = ls
+        self.x1 = x1
+        self.x2 = x1 if x2 is None else x2
+
+        for x in (self.x1, self.x2):
+            if isinstance(x, FourierFeatures):
+                self.features = x
+                break
+        else:
+            self.features = fourier_features(covar, x1.shape[1])
+
+        self.phi1 = self._phi(self.x1)
+        self.phi2 = self.phi1 if x2 is None else self._phi(self.x2)
+
+        if self.phi1 is None and self.phi2 is None:
+            self.cov = np.eye(self.features.num_features)
+        elif self.phi1 is None:
+            self.cov = np.swapaxes(self.phi2, -1, -2)
+        elif self.phi2 is None:
+            self.cov = self.phi1
+        else:
+            self.cov = np.matmul(self.phi1, np.swapaxes(self.phi2, -1, -2))
+
+    def _phi(self, x):
+        if isinstance(x, FourierFeatures):
+            return None
+        return self.features.features(self.ls, x)
+
+    def grad_x(self, weights=None):
+        # The NxMxD gradients w.r.t. x1, or with NxM weights their weighted
+        # sums over x1 (MxD).
+        freqs = self.features.freqs / self.ls
+        if self.phi1 is None:
+            # Minus the gradients w.r.t. x2.
+            g2 = self.features.grad_features(self.ls, self.x2)
+            if weights is None:
+                return -g2.T[:,:,np.newaxis] * freqs[:,np.newaxis,:]
+            return -np.dot(weights.T * g2, freqs)
+
+        g1 = self.features.grad_features(self.ls, self.x1)
+        if self.phi2 is None:
+            if weights is None:
+                return np.einsum('nf,fd->nfd', g1, freqs)
+            return np.sum(weights * g1, axis=0)[:,np.newaxis] * freqs
+
+        if weights is None:
+            return np.einsum('mf,nf,fd->nmd', self.phi2, g1, freqs)
+        return np.dot(np.dot(weights.T, g1) * self.phi2, freqs)
+
+    def grad_ls(self, weights=None):
+        raise Exception("Length scale gradients are not available for "
+                        "Fourier feature covariance functions")
+
+def get_kernel(covar, ls, x1, x2=None):
+    # The Kernel of the covariance function named covar, or its
+    # FourierKernel for the RFF_ covariance functions.
+    if covar.startswith('RFF_'):
+        return FourierKernel(covar, ls, x1, x2)
+    return Kernel(covar, ls, x1, x2)
+
+def RFF_ARDSE(ls, x1, x2=None, grad=False):
+    kern = FourierKernel('RFF_ARDSE', ls, x1, x2)
+    if grad:
+        return (kern.cov, kern.grad_x())
+    else:
+        return kern.cov
+
+def RFF_Matern32(ls, x1, x2=None, grad=False):
+    kern = FourierKernel('RFF_Matern32', ls, x1, x2)
     if grad:
-        return (cov, grad_Matern52(ls, x1, x2))
+        return (kern.cov, kern.grad_x())
+    else:
+        return kern.cov
+
+def RFF_Matern52(ls, x1, x2=None, grad=False):
+    kern = FourierKernel('RFF_Matern52', ls, x1, x2)
+    if grad:
+        return (kern.cov, kern.grad_x())
+    else:
+        return kern.cov
+
+class JitterCholesky:
+    '''
+    Lower Cholesky factors of covariance matrices that may be numerically
+    not positive definite.
+
+    A failed factorization is retried with jitter*mean(diag)*I added to the
+    matrix, the jitter growing geometrically by factor from min_jitter up to
+    max_jitter, past which numpy.linalg.LinAlgError is raised. Matrices of
+    the same family (e.g. 'comp' for the noisy covariances of the complete
+    points) tend to need the same jitter, so a factorization starts one step
+    below the last jitter its family succeeded with: a family that keeps
+    needing jitter pays at most one failure per factorization, and one that
+    stops needing it decays back to none.
+
+    Nothing is printed: counts holds the numbers of factorizations, of
+    failed attempts and of factorizations that needed jitter.
+
+    The jitters and counts are updated under a lock, since the restarts of
+    GP.optimize_hypers factorize in several threads; the factorizations
+    themselves run outside of it.
+    '''
+    def __init__(self, min_jitter=1e-10, max_jitter=1e-1, factor=10.0):
+        self.min_jitter = min_jitter
+        self.max_jitter = max_jitter
+        self.factor     = factor
+        self.jitters    = {}
+        self.counts     = collections.Counter()
+        self.lock       = threading.Lock()
+
+    def __call__(self, covmat, family=None):
+        with self.lock:
+            self.counts['factorizations'] += 1
+            jitter = self.jitters.get(family, 0.0) / self.factor
+        if jitter < self.min_jitter:
+            jitter = 0.0
+        scale = np.mean(np.abs(np.diag(covmat))) or 1.0
+
+        while True:
+            try:
+                if jitter == 0.0:
+                    chol = spla.cholesky(covmat, lower=True)
+                else:
+                    chol = spla.cholesky(covmat + jitter*scale*np.eye(covmat.shape[0]),
+                                         lower=True)
+                break
+            except np.linalg.LinAlgError:
+                with self.lock:
+                    self.counts['failures'] += 1
+                jitter = self.min_jitter if jitter == 0.0 else jitter*self.factor
+                if jitter > self.max_jitter:
+                    raise
+
+        with self.lock:
+            if jitter > 0.0:
+                self.counts['jittered'] += 1
+            self.jitters[family] = jitter
+        return chol
+
+# The factorizations of the GP and of the choosers share one jitter history
+# and one set of counters.
+jitter_chol = JitterCholesky()
+
+def chol_extend(chol, cross, kappa):
+    # Given the lower Cholesky factor of K11, returns the lower Cholesky
+    # factor of [[K11, K12], [K12.T, K22]] with K12 = cross and K22 = kappa.
+    # This is a rank-k block update costing O(N^2*k + k^3) instead of the
+    # O((N+k)^3) of a new factorization.
+    n = chol.shape[0]
+    k = kappa.shape[0]
+    L21 = spla.solve_triangular(chol, cross, lower=True).T
+    L22 = jitter_chol(kappa - np.dot(L21, L21.T), 'extend')
+
+    new_chol = np.zeros((n+k, n+k))
+    new_chol[:n,:n] = chol
+    new_chol[n:,:n] = L21
+    new_chol[n:,n:] = L22
+    return new_chol
+
+def batch_predict(cov_func, mean, amp2, ls, obsv, chol_inv, alpha, cand,
+                  block_size=256):
+    # Predictive means and variances at the candidates for S hyperparameter
+    # samples at once, given for each sample the inverse of the Cholesky of
+    # the noisy covariance of the observed points and the weights alpha of
+    # the observed values (SxN, or SxNxF for F fantasies per sample).
+    # mean and amp2 are S vectors and ls is SxD.
+    # Returns the means (SxM, or SxMxF) and the variances (SxM).
+    # The candidates are processed in blocks of block_size, so that the SxNxM
+    # temporaries stay small for large candidate sets.
+    func_m = np.zeros((mean.shape[0], cand.shape[0]) + alpha.shape[2:])
+    func_v = np.zeros((mean.shape[0], cand.shape[0]))
+
+    for i in range(0, cand.shape[0], block_size):
+        block      = slice(i, i+block_size)
+        cand_cross = (amp2[:,np.newaxis,np.newaxis] *
+                      cov_func(ls, obsv, cand[block]))
+        beta       = np.matmul(chol_inv, cand_cross)
+
+        if alpha.ndim == 2:
+            func_m[:,block] = (np.einsum('snm,sn->sm', cand_cross, alpha)
+                               + mean[:,np.newaxis])
+        else:
+            func_m[:,block] = (np.matmul(np.swapaxes(cand_cross, 1, 2), alpha)
+                               + mean[:,np.newaxis,np.newaxis])
+        func_v[:,block] = amp2[:,np.newaxis]*(1+1e-6) - np.sum(beta**2, axis=1)
+
+    return func_m, func_v
+
+class CholeskyCache:
+    '''
+    Cholesky factors of covariance matrices, one per hyperparameter sample.
+
+    A factor is looked up by a key identifying the hyperparameters. If the
+    points it was computed for share their first rows with the requested
+    points, its leading block is reused and extended with a block update
+    for the remaining rows, so that adding k points to N costs
+    O(N^2*k + k^3) instead of O((N+k)^3). A full factorization happens only
+    for hyperparameters that are not in the cache.
+
+    Only the max_size most recently used hyperparameter samples are kept.
+    Since the hyperparameters are resampled or refitted at every proposal,
+    the choosers only keep a factor across proposals for hyperparameters
+    they hold fixed (see retain).
+    '''
+    def __init__(self, max_size=10):
+        self.max_size = max_size
+        self.entries  = collections.OrderedDict()
+
+    def cholesky(self, key, x, cov):
+        # cov(x1, x2=None) returns the covariance between x1 and x2, or the
+        # covariance of x1 with its noise (and jitter) if x2 is None.
+        entry = self.entries.pop(key, None)
+
+        n = 0
+        if entry is not None:
+            (x_old, chol_old) = entry
+            m = min(x.shape[0], x_old.shape[0])
+            same = np.all(x[:m] == x_old[:m], axis=1)
+            n = m if np.all(same) else int(np.argmin(same))
+
+        if n == 0:
+            chol = jitter_chol(cov(x), 'comp')
+        elif n == x.shape[0]:
+            chol = chol_old[:n,:n]
+        else:
+            chol = chol_extend(chol_old[:n,:n], cov(x[:n], x[n:]), cov(x[n:]))
+
+        self.entries[key] = (x.copy(), chol)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return chol
+
+    def clear(self):
+        self.entries.clear()
+
+    def retain(self, key):
+        # Drop all the factors but the one of key, if it is cached.
+        entry = self.entries.get(key)
+        self.entries.clear()
+        if entry is not None:
+            self.entries[key] = entry
+
+class EigLikelihood:
+    '''
+    Marginal log likelihood of a GP with covariance K = amp2*corr + noise*I
+    for a fixed correlation matrix corr, as a function of mean, amp2 and
+    noise only.
+
+    With corr = Q*diag(lam)*Q^T, K = Q*diag(amp2*lam + noise)*Q^T, so after
+    one O(N^3) eigendecomposition of corr both the log determinant and the
+    quadratic form of K are O(N) sums. This makes slice sampling mean, amp2
+    and noise for fixed length scales as cheap as it can be.
+    '''
+    def __init__(self, corr, vals):
+        (self.lam, vecs) = np.linalg.eigh(corr)
+        self.proj_vals   = np.dot(vecs.T, vals)
+        self.proj_ones   = np.sum(vecs, axis=0)
+
+    def __call__(self, mean, amp2, noise):
+        # Same as -sum(log(diag(chol))) - 0.5*(vals-mean)^T K^-1 (vals-mean)
+        # with chol the Cholesky of K.
+        d = amp2*self.lam + noise
+        if np.any(d <= 0):
+            return -np.inf
+        r = self.proj_vals - mean*self.proj_ones
+        return -0.5*np.sum(np.log(d)) - 0.5*np.sum(r**2 / d)
+
+def select_inducing(x, num, start=0):
+    # Indices of num points of x to use as inducing points, chosen by
+    # farthest point traversal from x[start], so that they cover the inputs
+    # as evenly as possible. O(N*num*D).
+    idx  = [start]
+    dist = np.sum((x - x[start])**2, axis=1)
+    for i in range(1, min(num, x.shape[0])):
+        idx.append(int(np.argmax(dist)))
+        dist = np.minimum(dist, np.sum((x - x[idx[-1]])**2, axis=1))
+    return np.array(idx)
+
+class InducingPoints:
+    '''
+    The inducing points of the sparse GP for the complete points of a
+    chooser, or None if the exact GP is used (num_inducing <= 0, or no more
+    complete points than num_inducing). They are selected by farthest point
+    traversal from the best point, and kept as long as the complete points
+    are the same, so that all the hyperparameter samples share them. For the
+    RFF_ covariance functions, they are the feature weights (see
+    FourierFeatures).
+    '''
+    def __init__(self, num_inducing):
+        self.num_inducing = num_inducing
+        # The complete points the inducing points were last selected for,
+        # and the inducing points
+        self.data = None
+
+    def select(self, covar, comp, vals):
+        features = fourier_features(covar, comp.shape[1])
+        if features is not None:
+            return features
+
+        if self.num_inducing <= 0 or comp.shape[0] <= self.num_inducing:
+            return None
+
+        if self.data is None or not np.array_equal(self.data[0], comp):
+            idx = select_inducing(comp, self.num_inducing, np.argmin(vals))
+            self.data = (comp.copy(), comp[idx])
+
+        return self.data[1]
+
+class FITC:
+    '''
+    The FITC sparse approximation of a GP with M inducing points, given the
+    MxM correlation corr_mm of the inducing points and the NxM correlation
+    corr_nm between the N inputs and the inducing points:
+        K ~= Q + diag(K - Q) + noise*I,  Q = K_nm K_mm^-1 K_mn.
+
+    Everything costs O(N*M^2) instead of the O(N^3) of the exact GP. The
+    predictions only involve the inducing points: the predictive mean at a
+    candidate is k_cm alpha and its variance amp2 - |P k_mc|^2, so that
+    (inducing points, P, alpha) replace (observed points, inverse Cholesky,
+    alpha) of the exact GP.
+    '''
+    def __init__(self, corr_mm, corr_nm, amp2, noise):
+        self.amp2 = amp2
+        M = corr_mm.shape[0]
+
+        kmm      = amp2 * (corr_mm + 1e-6*np.eye(M))
+        self.lmm = jitter_chol(kmm, 'inducing')
+        v        = spla.solve_triangular(self.lmm, amp2*corr_nm.T, lower=True)
+
+        # The diagonal correction and noise, and B = I + V Lambda^-1 V^T, with
+        # K_mm + K_mn Lambda^-1 K_nm = L_mm B L_mm^T.
+        self.lam = np.maximum(amp2*(1+1e-6) - np.sum(v**2, axis=0), 0) + noise
+        self.vs  = v / np.sqrt(self.lam)
+        self.b   = np.eye(M) + np.dot(self.vs, self.vs.T)
+        self.lb  = jitter_chol(self.b, 'fitc')
+
+        self.logdet = 2*np.sum(np.log(np.diag(self.lb))) + np.sum(np.log(self.lam))
+
+    def _project(self, vals, mean):
+        # The scaled residuals and LB^-1 V Lambda^-1 (vals - mean), for a
+        # vector of values or a matrix with one column per set of values.
+        rs = (vals - mean) / np.sqrt(self.lam).reshape((-1,) + (1,)*(vals.ndim-1))
+        c  = spla.solve_triangular(self.lb, np.dot(self.vs, rs), lower=True)
+        return rs, c
+
+    def loglik(self, vals, mean):
+        # Same as -sum(log(diag(chol))) - 0.5*(vals-mean)^T K^-1 (vals-mean)
+        # for the approximate covariance K.
+        (rs, c) = self._project(vals, mean)
+        return -0.5*self.logdet - 0.5*(np.sum(rs**2, axis=0) - np.sum(c**2, axis=0))
+
+    def weights(self, vals, mean):
+        # The weights alpha of the inducing points in the predictive mean.
+        (rs, c) = self._project(vals, mean)
+        return spla.solve_triangular(self.lmm,
+                                     spla.solve_triangular(self.lb, c, trans=1, lower=True),
+                                     trans=1, lower=True)
+
+    def pred_factor(self):
+        # P with P^T P = K_mm^-1 - (K_mm + K_mn Lambda^-1 K_nm)^-1
+        #              = L_mm^-T (I - B^-1) L_mm^-1.
+        (b, u) = np.linalg.eigh(self.b)
+        lmm_inv = spla.solve_triangular(self.lmm, np.eye(self.lmm.shape[0]),
+                                        lower=True)
+        return np.sqrt(np.maximum(1 - 1/b, 0))[:,np.newaxis] * np.dot(u.T, lmm_inv)
+
+class KernelMatrix:
+    '''
+    The correlation matrix (with its 1e-6 jitter) of the points x for the
+    length scales ls, as an operator for the iterative solvers.
+
+    The matrix is computed block_entries/N rows at a time, so that the
+    temporaries of the covariance function stay small. If it has at most
+    max_dense entries, the blocks are computed once and stored. Otherwise
+    they are recomputed on every product, so that memory stays
+    O(block_entries) however many points there are, at the price of
+    evaluating the covariance function on every product.
+    '''
+    def __init__(self, cov_func, ls, x, max_dense=2**22, block_entries=2**22):
+        self.cov_func   = cov_func
+        self.ls         = ls
+        self.x          = x
+        self.block_size = max(1, block_entries // x.shape[0])
+        self.dense      = None
+        if x.shape[0]**2 <= max_dense:
+            dense = np.empty((x.shape[0], x.shape[0]))
+            for (block, corr) in self.blocks():
+                dense[block] = corr
+            self.dense = dense
+        self._pivoted = {}
+
+    def blocks(self):
+        # The blocks of rows of the matrix, with their slices.
+        if self.dense is not None:
+            yield slice(0, self.x.shape[0]), self.dense
+            return
+
+        for i in range(0, self.x.shape[0], self.block_size):
+            block = slice(i, i+self.block_size)
+            corr  = self.cov_func(self.ls, self.x[block], self.x)
+            rows  = np.arange(corr.shape[0])
+            corr[rows, i+rows] += 1e-6
+            yield block, corr
+
+    def dot(self, v):
+        # The product with a vector or a matrix v.
+        out = np.empty(v.shape)
+        for (block, corr) in self.blocks():
+            out[block] = np.dot(corr, v)
+        return out
+
+    def pivoted_cholesky(self, rank):
+        # The Nxrank factor L of the partial pivoted Cholesky decomposition
+        # of the matrix, ~= L L^T, pivoting on the largest remaining diagonal
+        # entry. Needs only rank rows of the matrix, O(N*rank^2). Cached per
+        # rank.
+        if rank not in self._pivoted:
+            N    = self.x.shape[0]
+            L    = np.zeros((N, min(rank, N)))
+            diag = np.ones(N) + 1e-6
+            for k in range(L.shape[1]):
+                i = np.argmax(diag)
+                if diag[i] <= 1e-8:
+                    L = L[:,:k]
+                    break
+                row = self.cov_func(self.ls, self.x[i:i+1], self.x)[0]
+                row[i] += 1e-6
+                L[:,k] = (row - np.dot(L[:,:k], L[i,:k])) / np.sqrt(diag[i])
+                diag  -= L[:,k]**2
+            self._pivoted[rank] = L
+        return self._pivoted[rank]
+
+def cg_solve(matvec, b, precond=None, tol=1e-6, max_iters=1000):
+    # Preconditioned conjugate gradients for A x = b, with A symmetric
+    # positive definite, matvec(v) = A v and precond(v) ~= A^-1 v. b is a
+    # vector or a matrix whose columns are all solved together, with one
+    # product with A per iteration for all of them. Stops when the residual
+    # of every column is below tol relative to that column of b.
+    if precond is None:
+        precond = lambda v: v
+
+    x     = np.zeros(b.shape)
+    r     = np.array(b, dtype=float)
+    z     = precond(r)
+    p     = z.copy()
+    rz    = np.sum(r*z, axis=0)
+    bnorm = np.sqrt(np.sum(r**2, axis=0))
+
+    for i in range(max_iters):
+        done = np.sqrt(np.sum(r**2, axis=0)) <= tol*bnorm
+        if np.all(done):
+            break
+
+        q  = matvec(p)
+        pq = np.sum(p*q, axis=0)
+        a  = np.where(done, 0, rz / np.where(done, 1, pq))
+        x += a*p
+        r -= a*q
+        z  = precond(r)
+        rz_new = np.sum(r*z, axis=0)
+        p  = z + np.where(done, 0, rz_new / np.where(done, 1, rz))*p
+        rz = rz_new
+
+    return x
+
+def lanczos(matvec, v0, num_iters, reorthogonalize=False):
+    # num_iters steps of the Lanczos process of the symmetric A, with
+    # matvec(v) = A v, from each column of v0 (NxT), all run together.
+    # Returns the diagonals (kxT) and off-diagonals (k-1xT) of the k <=
+    # num_iters tridiagonal matrices, and with reorthogonalize the kxNxT
+    # Lanczos vectors, each reorthogonalized against the previous ones.
+    # The process stops early once all the columns have spanned an
+    # invariant subspace; columns that do before are padded with zeros.
+    q      = v0 / np.sqrt(np.sum(v0**2, axis=0))
+    q_prev = np.zeros(q.shape)
+    b_prev = np.zeros(q.shape[1])
+    (alphas, betas, qs) = ([], [], [q])
+
+    for k in range(num_iters):
+        w = matvec(q) - b_prev*q_prev
+        a = np.sum(q*w, axis=0)
+        w -= a*q
+        if reorthogonalize:
+            Q  = np.array(qs)
+            w -= np.einsum('knt,kt->nt', Q, np.einsum('knt,nt->kt', Q, w))
+        alphas.append(a)
+
+        b = np.sqrt(np.sum(w**2, axis=0))
+        if k == num_iters-1 or np.all(b <= 1e-10*np.max(np.abs(alphas))):
+            break
+        betas.append(b)
+
+        (q_prev, q) = (q, w / np.where(b > 1e-10*np.max(np.abs(alphas)), b, np.inf))
+        b_prev = b
+        qs.append(q)
+
+    alphas = np.array(alphas)
+    betas  = np.array(betas).reshape((-1, q.shape[1]))
+    if reorthogonalize:
+        return alphas, betas, np.array(qs)
+    return alphas, betas
+
+def slq_logdet(matvec, n, num_probes=10, num_iters=30, seed=0):
+    # Stochastic Lanczos quadrature estimate of the log determinant of the
+    # nxn symmetric positive definite A, with matvec(v) = A v:
+    #   log det A = tr(log A) ~= mean_t z_t^T log(A) z_t
+    # for Rademacher probes z_t, each quadratic form being the Gauss
+    # quadrature given by num_iters Lanczos steps from z_t. The probes are
+    # drawn from a fixed seed, so that the estimate is a deterministic,
+    # smooth function of A.
+    z = 2.0*npr.RandomState(seed).randint(2, size=(n, num_probes)) - 1
+    (alphas, betas) = lanczos(matvec, z, min(num_iters, n))
+
+    logdet = 0
+    for t in range(num_probes):
+        (theta, s) = spla.eigh_tridiagonal(alphas[:,t], betas[:,t])
+        logdet += n * np.sum(s[0]**2 * np.log(np.maximum(theta, 1e-300)))
+    return logdet / num_probes
+
+class IterativeSolver:
+    '''
+    The noisy covariance K = amp2*corr + noise*I of a KernelMatrix corr,
+    used without factorizing it, for a number of points N whose O(N^3)
+    Cholesky or O(N^2) memory are out of reach. The partial pivoted
+    Cholesky L of corr (of rank rank) gives the preconditioner
+    P = amp2*L L^T + s*I (s the noise and jitter), whose inverse and
+    square root are O(N*rank) through the eigendecomposition of L^T L.
+      - solve: preconditioned conjugate gradients;
+      - logdet: log det P plus the stochastic Lanczos quadrature of the
+        well conditioned P^-1/2 K P^-1/2, with probes from a fixed seed so
+        that the likelihood stays a deterministic function of the
+        hyperparameters, as the slice sampler requires;
+      - pred_factor: W (rankxN) with W^T W the Galerkin approximation of
+        K^-1 on the span of L, in place of the inverse Cholesky in the
+        predictive variances. It underestimates the variance reductions,
+        never the variances.
+    '''
+    def __init__(self, corr, amp2, noise, rank=200, tol=1e-6, max_iters=1000,
+                 num_probes=10, num_lanczos=30):
+        self.corr  = corr
+        self.amp2  = amp2
+        self.noise = noise
+        self.n     = corr.x.shape[0]
+        self.tol         = tol
+        self.max_iters   = max_iters
+        self.num_probes  = num_probes
+        self.num_lanczos = num_lanczos
+
+        # P = U diag(d) U^T + s (I - U U^T), with U the left singular
+        # vectors of L.
+        self.pl = corr.pivoted_cholesky(rank)
+        self.ps = noise + 1e-6*amp2
+        (sig2, v) = np.linalg.eigh(np.dot(self.pl.T, self.pl))
+        sig2   = np.maximum(sig2, 1e-12)
+        self.u = np.dot(self.pl, v) / np.sqrt(sig2)
+        self.d = amp2*sig2 + self.ps
+
+    def dot(self, v):
+        return self.amp2*self.corr.dot(v) + self.noise*v
+
+    def _precond_pow(self, v, power):
+        # P^power v
+        uv = np.dot(self.u.T, v)
+        scale = (self.d**power - self.ps**power).reshape((-1,) + (1,)*(v.ndim-1))
+        return np.dot(self.u, scale*uv) + self.ps**power * v
+
+    def precond(self, v):
+        return self._precond_pow(v, -1)
+
+    def solve(self, b):
+        return cg_solve(self.dot, b, self.precond, self.tol, self.max_iters)
+
+    def logdet(self):
+        def precond_dot(v):
+            return self._precond_pow(self.dot(self._precond_pow(v, -0.5)), -0.5)
+
+        return (np.sum(np.log(self.d)) + (self.n - self.d.shape[0])*np.log(self.ps)
+                + slq_logdet(precond_dot, self.n, self.num_probes,
+                             self.num_lanczos))
+
+    def loglik(self, vals, mean):
+        # Same as -sum(log(diag(chol))) - 0.5*(vals-mean)^T K^-1 (vals-mean)
+        # with chol the Cholesky of K.
+        r = vals - mean
+        return -0.5*self.logdet() - 0.5*np.dot(r, self.solve(r))
+
+    def pred_factor(self):
+        # With Z = U, K^-1 ~= Z (Z^T K Z)^-1 Z^T = W^T W for
+        # W = chol(Z^T K Z)^-1 Z^T.
+        chol = jitter_chol(np.dot(self.u.T, self.dot(self.u)), 'galerkin')
+        return spla.solve_triangular(chol, self.u.T, lower=True)
+
+# The posteriors of the choosers: the quantities that do not depend on the
+# candidates, for a hyperparameter sample hyper = (mean, noise, amp2, ls).
+#
+# They are (obsv, chol_inv, alpha, bests): the observed points (complete, or
+# complete and pending), the inverse of the Cholesky of their noisy
+# covariance, the weights of the (fantasized) values and the best
+# (fantasized) values, as batch_predict takes them. Without pending points,
+# alpha and bests are for the values only; with pending points they have
+# one column per fantasy, drawn from the standard normals (PxF) normals.
+
+def fantasize(vals, pend_m, pend_K, normals):
+    # The values of the complete points and the fantasized values of the
+    # pending points, with predictive means pend_m and covariance pend_K,
+    # one column per fantasy, and the best value of each fantasy.
+    pend_chol = jitter_chol(pend_K, 'pend')
+    pend_fant = np.dot(pend_chol, normals) + pend_m[:,None]
+    fant_vals = np.concatenate((np.tile(vals[:,np.newaxis],
+                                        (1,normals.shape[1])), pend_fant))
+    return fant_vals, np.min(fant_vals, axis=0)
+
+def exact_posterior(cov_func, comp_chol, comp, pend, vals, hyper,
+                    normals=None):
+    # The posterior of the exact GP, given the Cholesky comp_chol of the
+    # noisy covariance of the complete points.
+    (mean, noise, amp2, ls) = hyper
+
+    if pend.shape[0] == 0:
+        obsv      = comp
+        obsv_chol = comp_chol
+        alpha     = spla.cho_solve((obsv_chol, True), vals - mean)
+        bests     = np.min(vals)
+    else:
+        obsv = np.concatenate((comp, pend))
+
+        pend_cross = amp2 * cov_func(ls, comp, pend)
+        pend_kappa = amp2 * (cov_func(ls, pend, None) +
+                             1e-6*np.eye(pend.shape[0]))
+
+        # Extend the Cholesky of the complete points with a block for the
+        # pending ones instead of factoring their joint covariance: with
+        # L21 = (comp_chol^-1 pend_cross)^T, the Schur complement
+        # pend_kappa - L21 L21^T is the predictive covariance of the pending
+        # points, and with their noise it is the block to factor.
+        # O(N^2*P + P^3) for P pending points.
+        L21    = spla.solve_triangular(comp_chol, pend_cross, lower=True).T
+        pend_m = np.dot(L21, spla.solve_triangular(comp_chol, vals - mean,
+                                                   lower=True)) + mean
+        pend_K = pend_kappa - np.dot(L21, L21.T)
+
+        n = comp.shape[0]
+        obsv_chol = np.zeros((obsv.shape[0], obsv.shape[0]))
+        obsv_chol[:n,:n] = comp_chol
+        obsv_chol[n:,:n] = L21
+        obsv_chol[n:,n:] = jitter_chol(pend_K + noise*np.eye(pend.shape[0]),
+                                       'obsv')
+
+        (fant_vals, bests) = fantasize(vals, pend_m, pend_K, normals)
+        alpha = spla.cho_solve((obsv_chol, True), fant_vals - mean)
+
+    # Invert the Cholesky once, so that the predictions for all the samples
+    # are batched matrix products.
+    chol_inv = spla.solve_triangular(obsv_chol, np.eye(obsv.shape[0]),
+                                     lower=True)
+
+    return (obsv, chol_inv, alpha, bests)
+
+def sparse_posterior(cov_func, inducing, comp, pend, vals, hyper,
+                     normals=None):
+    # The posterior of the sparse GP with the given inducing points, which
+    # are also the observed points, with the predictive factor of FITC in
+    # place of the inverse Cholesky. O(N*M^2) for M inducing points.
+    (mean, noise, amp2, ls) = hyper
+
+    corr_mm = cov_func(ls, inducing, None)
+    fitc    = FITC(corr_mm, cov_func(ls, comp, inducing), amp2, noise)
+    pred    = fitc.pred_factor()
+
+    if pend.shape[0] == 0:
+        alpha = fitc.weights(vals, mean)
+        bests = np.min(vals)
+    else:
+        # Fantasize the outcomes of the pending experiments from the sparse
+        # predictive distribution.
+        pend_cross = amp2 * cov_func(ls, inducing, pend)
+        pend_beta  = np.dot(pred, pend_cross)
+        pend_m     = np.dot(pend_cross.T, fitc.weights(vals, mean)) + mean
+        pend_K     = (amp2 * (cov_func(ls, pend, None) +
+                              1e-6*np.eye(pend.shape[0]))
+                      - np.dot(pend_beta.T, pend_beta))
+        (fant_vals, bests) = fantasize(vals, pend_m, pend_K, normals)
+
+        # Condition on the fantasies with the same inducing points.
+        obsv  = np.concatenate((comp, pend))
+        fitc  = FITC(corr_mm, cov_func(ls, obsv, inducing), amp2, noise)
+        pred  = fitc.pred_factor()
+        alpha = fitc.weights(fant_vals, mean)
+
+    return (inducing, pred, alpha, bests)
+
+def iterative_posterior(cov_func, comp, pend, vals, hyper, normals=None):
+    # The posterior of the exact GP with the iterative solvers, with the
+    # factor of IterativeSolver.pred_factor in place of the inverse
+    # Cholesky. Nothing larger than the KernelMatrix and O(N*rank) is stored.
+    (mean, noise, amp2, ls) = hyper
+
+    obsv   = comp
+    solver = IterativeSolver(KernelMatrix(cov_func, ls, comp), amp2, noise)
+    alpha  = solver.solve(vals - mean)
+    bests  = np.min(vals)
+
+    if pend.shape[0] > 0:
+        # Fantasize the outcomes of the pending experiments.
+        pend_cross = amp2 * cov_func(ls, comp, pend)
+        pend_m     = np.dot(pend_cross.T, alpha) + mean
+        pend_K     = (amp2 * (cov_func(ls, pend, None) +
+                              1e-6*np.eye(pend.shape[0]))
+                      - np.dot(pend_cross.T, solver.solve(pend_cross)))
+        (fant_vals, bests) = fantasize(vals, pend_m, pend_K, normals)
+
+        obsv   = np.concatenate((comp, pend))
+        solver = IterativeSolver(KernelMatrix(cov_func, ls, obsv), amp2, noise)
+        alpha  = solver.solve(fant_vals - mean)
+
+    return (obsv, solver.pred_factor(), alpha, bests)
+
+def posterior(cov_func, comp, pend, vals, hyper, normals=None, inducing=None,
+              solver='cholesky', comp_chol=None):
+    # The posterior of the sparse GP if there are inducing points, else of
+    # the exact GP with the solver ('cholesky' or 'cg'). comp_chol(comp,
+    # hyper) returns the Cholesky of the noisy covariance of the complete
+    # points, e.g. from a CholeskyCache; by default it is factored.
+    if inducing is not None:
+        return sparse_posterior(cov_func, inducing, comp, pend, vals, hyper,
+                                normals)
+    if solver == 'cg':
+        return iterative_posterior(cov_func, comp, pend, vals, hyper, normals)
+
+    if comp_chol is None:
+        (mean, noise, amp2, ls) = hyper
+        chol = jitter_chol(amp2 * (cov_func(ls, comp, None) +
+                                   1e-6*np.eye(comp.shape[0])) +
+                           noise*np.eye(comp.shape[0]), 'comp')
     else:
-        return cov
+        chol = comp_chol(comp, hyper)
+    return exact_posterior(cov_func, chol, comp, pend, vals, hyper, normals)
+
+def log_likelihood(cov_func, comp, vals, hyper, inducing=None,
+                   solver='cholesky'):
+    # The log marginal likelihood (up to a constant) of the values for the
+    # hyperparameter sample hyper = (mean, noise, amp2, ls), of the sparse GP
+    # if there are inducing points, else of the exact GP with the solver.
+    (mean, noise, amp2, ls) = hyper
+
+    if inducing is not None:
+        fitc = FITC(cov_func(ls, inducing, None), cov_func(ls, comp, inducing),
+                    amp2, noise)
+        return fitc.loglik(vals, mean)
+
+    if solver == 'cg':
+        return IterativeSolver(KernelMatrix(cov_func, ls, comp),
+                               amp2, noise).loglik(vals, mean)
+
+    cov   = (amp2 * (cov_func(ls, comp, None) + 1e-6*np.eye(comp.shape[0])) +
+             noise*np.eye(comp.shape[0]))
+    chol  = jitter_chol(cov, 'comp')
+    solve = spla.cho_solve((chol, True), vals - mean)
+    return -np.sum(np.log(np.diag(chol))) - 0.5*np.dot(vals - mean, solve)
+
+def fixed_ls_likelihood(cov_func, ls, comp, vals, inducing=None,
+                        solver='cholesky'):
+    # The log likelihood as a function of (mean, amp2, noise) for the length
+    # scales ls. These are fixed while the choosers sample the other
+    # hyperparameters, so one eigendecomposition of the correlation matrix
+    # makes every probe of the sampler O(N) (see EigLikelihood); with the
+    # inducing points of the sparse GP, the correlations of the inducing
+    # points are computed once and every probe is O(N*M^2). With the 'cg'
+    # solver, the KernelMatrix and its preconditioner are shared by all the
+    # probes.
+    if inducing is None and solver == 'cg':
+        corr = KernelMatrix(cov_func, ls, comp)
+
+        def lik(mean, amp2, noise):
+            return IterativeSolver(corr, amp2, noise).loglik(vals, mean)
+
+        return lik
+
+    if inducing is None:
+        return EigLikelihood(cov_func(ls, comp, None) +
+                             1e-6*np.eye(comp.shape[0]), vals)
+
+    corr_mm = cov_func(ls, inducing, None)
+    corr_nm = cov_func(ls, comp, inducing)
 
-def grad_Matern52(ls, x1, x2=None):
-    r       = np.sqrt(dist2(ls, x1, x2))
-    grad_r2 = -(5.0/6.0)*np.exp(-SQRT_5*r)*(1 + SQRT_5*r)
-    return grad_r2[:,:,np.newaxis] * grad_dist2(ls, x1, x2)
+    def lik(mean, amp2, noise):
+        return FITC(corr_mm, corr_nm, amp2, noise).loglik(vals, mean)
+
+    return lik
 
 class GP:
     def __init__(self, covar="Matern52", mcmc_iters=10, noiseless=False):
@@ -173,34 +1111,46 @@ class GP:
             noise = self.noise
 
             cov   = amp2 * (self.cov_func(self.ls, comp, None) + 1e-6*np.eye(comp.shape[0])) + noise*np.eye(comp.shape[0])
-            chol  = spla.cholesky(cov, lower=True)
+            chol  = jitter_chol(cov, 'comp')
             solve = spla.cho_solve((chol, True), vals - mean)
             lp    = -np.sum(np.log(np.diag(chol)))-0.5*np.dot(vals-mean, solve)
             return lp
 
-    def optimize_hypers(self, comp, vals):
-        self.mean = np.mean(vals)
-        diffs     = vals - self.mean
+    # The negative log marginal likelihood of the data as a function of the
+    # log amplitude, log noise and log length scales (for the mean of the
+    # values), and its gradient. With inducing points, the likelihood is the
+    # sparse FITC one, and its gradient is None (left to finite differences).
+    # The RFF_ covariance functions always use their feature weights as the
+    # inducing points. With the 'cg' solver, see iterative_objective.
+    def hyper_objective(self, comp, vals, inducing=None, solver='cholesky'):
+        diffs = vals - np.mean(vals)
+
+        if inducing is None:
+            inducing = fourier_features(self.cov_func.__name__, comp.shape[1])
+
+        if inducing is not None:
+            def sparse_nlogprob(hypers):
+                ls   = np.exp(hypers[2:])
+                fitc = FITC(self.cov_func(ls, inducing, None),
+                            self.cov_func(ls, comp, inducing),
+                            np.exp(hypers[0]), np.exp(hypers[1]))
+                return -fitc.loglik(diffs, 0)
+
+            return (sparse_nlogprob, None)
+
+        if solver == 'cg':
+            return self.iterative_objective(comp, vals)
 
         state = { }
 
-        def jitter_chol(covmat):
-            passed = False
-            jitter = 1e-8
-            val = 0
-            while not passed:
-                if (jitter > 100000):
-                    val = spla.cholesky(np.eye(covmat.shape[0]))
-                    break
-                try:
-                    val = spla.cholesky(covmat +
-                        jitter*np.eye(covmat.shape[0]), lower=True)
-                    passed = True
-                except ValueError:
-                    jitter = jitter*1.1
-                    print ("Covariance matrix not PSD, adding jitter:", jitter)
-                    passed = False
-            return val
+        def hyper_chol(covmat):
+            # Hyperparameters past the largest jitter get an identity factor,
+            # as if they were uninformative, instead of stopping the
+            # optimizer.
+            try:
+                return jitter_chol(covmat, 'hypers')
+            except np.linalg.LinAlgError:
+                return np.eye(covmat.shape[0])
 
         def memoize(amp2, noise, ls):
             if ( 'corr' not in state
@@ -208,8 +1158,10 @@ class GP:
                  or state['noise'] != noise
                  or np.any(state['ls'] != ls)):
 
-                # Get the correlation matrix
-                (corr, grad_corr) = self.cov_func(ls, comp, None, grad=True)
+                # Get the correlation matrix, keeping the distances for the
+                # gradients
+                kern = Kernel(self.cov_func.__name__, ls, comp)
+                corr = kern.cov
 
                 # Scale and add noise & jitter.
                 covmat = (amp2 * (corr + 1e-6*np.eye(comp.shape[0]))
@@ -217,13 +1169,13 @@ class GP:
 
                 # Memoize
                 state['corr']      = corr
-                state['grad_corr'] = grad_corr
-                state['chol']      = jitter_chol(covmat)
+                state['kern']      = kern
+                state['chol']      = hyper_chol(covmat)
                 state['amp2']      = amp2
                 state['noise']     = noise
                 state['ls']        = ls
 
-            return (state['chol'], state['corr'], state['grad_corr'])
+            return (state['chol'], state['corr'], state['kern'])
 
         def nlogprob(hypers):
             amp2  = np.exp(hypers[0])
@@ -240,7 +1192,7 @@ class GP:
             noise = np.exp(hypers[1])
             ls    = np.exp(hypers[2:])
 
-            chol, corr, grad_corr = memoize(amp2, noise, ls)
+            chol, corr, kern = memoize(amp2, noise, ls)
             solve   = spla.cho_solve((chol, True), diffs)
             inv_cov = spla.cho_solve((chol, True), np.eye(chol.shape[0]))
 
@@ -248,32 +1200,131 @@ class GP:
 
             grad = np.zeros(self.D + 2)
 
+            # The gradient w.r.t. a hyperparameter h is
+            # 0.5*trace(jacobian*dK/dh), and for symmetric matrices the trace
+            # of the product is the sum of the elementwise product, which is
+            # O(N^2) instead of O(N^3).
+
             # Log amplitude gradient.
-            grad[0] = 0.5 * np.trace(np.dot( jacobian, corr + 1e-6*np.eye(chol.shape[0]))) * amp2
+            grad[0] = 0.5 * (np.sum(jacobian*corr) + 1e-6*np.trace(jacobian)) * amp2
 
             # Log noise gradient.
-            grad[1] = 0.5 * np.trace(np.dot( jacobian, np.eye(chol.shape[0]))) * noise
+            grad[1] = 0.5 * np.trace(jacobian) * noise
 
-            # Log length scale gradients.
-            for dd in range(self.D):
-                grad[dd+2] = 1 * np.trace(np.dot( jacobian, -amp2*grad_corr[:,:,dd]*comp[:,dd][:,np.newaxis]/(np.exp(ls[dd]))))*np.exp(ls[dd])
+            # Log length scale gradients, all at once contracted with the
+            # jacobian.
+            grad[2:] = 0.5 * amp2 * kern.grad_ls(jacobian) * ls
 
             # Roll in the prior variance.
             #grad -= 2*hypers/self.hyper_prior
 
             return -grad
 
-        # Initial length scales.
-        self.ls = np.ones(self.D)
-        # Initial amplitude.
-        self.amp2 = np.std(vals)
-        # Initial observation noise.
-        self.noise = 1e-3
+        return (nlogprob, grad_nlogprob)
+
+    # The objective of hyper_objective with the iterative solvers: the log
+    # determinant by stochastic Lanczos quadrature, and the traces of its
+    # gradient split with the preconditioner P = U diag(d) U^T + s(I - U U^T)
+    # of the IterativeSolver into an exact part and a small remainder,
+    # estimated by Hutchinson's estimator with Rademacher probes z_t:
+    #   tr(K^-1 dK) = tr(dK)/s + sum_j (1/d_j - 1/s) u_j^T dK u_j
+    #                 + mean_t (K^-1 z_t - P^-1 z_t)^T dK z_t,
+    # all the solves done together by conjugate gradients. The length scale
+    # gradients are accumulated a block of rows at a time, so that memory
+    # stays that of the KernelMatrix.
+    def iterative_objective(self, comp, vals, num_probes=10):
+        diffs  = vals - np.mean(vals)
+        probes = 2.0*npr.RandomState(0).randint(2, size=(comp.shape[0],
+                                                          num_probes)) - 1
+        state = { }
+
+        def memoize(hypers):
+            if 'hypers' not in state or np.any(state['hypers'] != hypers):
+                corr   = KernelMatrix(self.cov_func, np.exp(hypers[2:]), comp)
+                solver = IterativeSolver(corr, np.exp(hypers[0]),
+                                         np.exp(hypers[1]))
+                sol    = solver.solve(np.column_stack((diffs, probes)))
+
+                state['hypers'] = hypers.copy()
+                state['corr']   = corr
+                state['solver'] = solver
+                state['alpha']  = sol[:,0]
+                state['u']      = sol[:,1:]
+            return state
+
+        def nlogprob(hypers):
+            memoize(hypers)
+            return (0.5*state['solver'].logdet() +
+                    0.5*np.dot(diffs, state['alpha']))
+
+        def grad_nlogprob(hypers):
+            memoize(hypers)
+            amp2  = np.exp(hypers[0])
+            noise = np.exp(hypers[1])
+            ls    = np.exp(hypers[2:])
+            (corr, solver, alpha) = (state['corr'], state['solver'],
+                                     state['alpha'])
+            n = comp.shape[0]
 
-        hypers     = np.zeros(self.ls.shape[0]+2)
-        hypers[0]  = np.log(self.amp2)
-        hypers[1]  = np.log(self.noise)
-        hypers[2:] = np.log(self.ls)
+            # Apart from tr(dK)/s, the gradients are sums of weights*dK over
+            # all the pairs, with weights = 0.5*(a b^T - alpha alpha^T).
+            a = np.column_stack((solver.u*(1/solver.d - 1/solver.ps),
+                                 (state['u'] - solver.precond(probes))/num_probes))
+            b = np.column_stack((solver.u, probes))
+
+            corr_b = corr.dot(np.column_stack((alpha, b)))
+            grad = np.zeros(hypers.shape)
+            grad[0] = 0.5*amp2*(np.sum(a*corr_b[:,1:]) + n*(1+1e-6)/solver.ps -
+                                np.dot(alpha, corr_b[:,0]))
+            grad[1] = 0.5*noise*(np.sum(a*b) + n/solver.ps -
+                                 np.dot(alpha, alpha))
+            for i in range(0, n, corr.block_size):
+                block   = slice(i, i+corr.block_size)
+                weights = 0.5*(np.dot(a[block], b.T) -
+                               np.outer(alpha[block], alpha))
+                kern = Kernel(self.cov_func.__name__, ls, comp[block], comp)
+                grad[2:] += kern.grad_ls(weights)
+            grad[2:] *= amp2*ls
+
+            return grad
+
+        return (nlogprob, grad_nlogprob)
+
+    # Compare the gradient of the hyperparameter objective with finite
+    # differences at the log hyperparameters hypers (by default the current
+    # ones), with the solver ('cholesky' or 'cg'). Returns the norm of the
+    # difference.
+    def check_grad_hypers(self, comp, vals, hypers=None, solver='cholesky'):
+        if hypers is None:
+            hypers = np.hstack((np.log(self.amp2), np.log(self.noise),
+                                np.log(self.ls)))
+        (nlogprob, grad_nlogprob) = self.hyper_objective(comp, vals,
+                                                         solver=solver)
+        return spo.check_grad(nlogprob, grad_nlogprob, hypers)
+
+    # Fit the amplitude, noise and length scales by maximizing the marginal
+    # likelihood (type-II maximum likelihood), for the mean of the values.
+    #
+    # The fit starts from init = (amp2, noise, ls), e.g. the previous
+    # optimum when refitting after adding points, or from default values.
+    # With restarts > 0, as many additional fits start from random length
+    # scales and the best of all is kept. The fits run in up to threads
+    # threads; most of their time is spent in LAPACK, which releases the GIL.
+    # With inducing points, the sparse FITC likelihood is maximized, and with
+    # the 'cg' solver the likelihood of the iterative solvers.
+    def optimize_hypers(self, comp, vals, init=None, restarts=0, threads=1,
+                        inducing=None, solver='cholesky'):
+        self.mean = np.mean(vals)
+
+        if init is None:
+            # Initial length scales.
+            self.ls = np.ones(self.D)
+            # Initial amplitude.
+            self.amp2 = np.std(vals)
+            # Initial observation noise.
+            self.noise = 1e-3
+        else:
+            (self.amp2, self.noise, self.ls) = init
 
         # Use a bounded bfgs just to prevent the length-scales and noise from
         # getting into regions that are numerically unstable
@@ -281,11 +1332,31 @@ class GP:
         for i in range(comp.shape[1]):
             b.append((-10,5))
 
-        hypers = spo.fmin_l_bfgs_b(nlogprob, hypers, grad_nlogprob, args=(), bounds=b, disp=0)
+        starts = [np.hstack((np.log(self.amp2), np.log(self.noise),
+                             np.log(self.ls)))]
+        for i in range(restarts):
+            starts.append(np.hstack((np.log(np.std(vals)), np.log(1e-3),
+                                     np.log(self.max_ls*npr.rand(self.D)))))
+        starts = [np.clip(hypers, [l for (l, u) in b], [u for (l, u) in b])
+                  for hypers in starts]
+
+        def fit(hypers):
+            # Every fit has its own objective, whose memoized state is not
+            # shared between threads.
+            (nlogprob, grad_nlogprob) = self.hyper_objective(comp, vals,
+                                                             inducing, solver)
+            return spo.fmin_l_bfgs_b(nlogprob, hypers, grad_nlogprob, args=(),
+                                     approx_grad=grad_nlogprob is None,
+                                     bounds=b, disp=0)
+
+        if threads > 1 and len(starts) > 1:
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                fits = list(executor.map(fit, starts))
+        else:
+            fits = [fit(hypers) for hypers in starts]
 
         #hypers = spo.fmin_bfgs(nlogprob, hypers, grad_nlogprob, maxiter=100)
-        hypers = hypers[0]
-        #hypers = spo.fmin_bfgs(nlogprob, hypers, grad_nlogprob, maxiter=100)
+        hypers = min(fits, key=lambda ret: ret[1])[0]
 
         self.amp2  = np.exp(hypers[0])
         self.noise = np.exp(hypers[1])
@@ -309,7 +1380,7 @@ def main():
         K = mygp.cov(x)
         y = np.random.randn(100)
 
-        fsamp = mygp.mean + np.dot(spla.cholesky(K).transpose(), y)
+        fsamp = mygp.mean + np.dot(jitter_chol(K), y)
         try:
             plt.plot(x, fsamp)
         except:
@@ -1,5 +1,29 @@
 import math
+import os
+import threading
 from numpy import *
+
+#
+#	The public names, so that a star import of this module does not also
+#	import numpy's (and shadow builtins such as min and max).
+#
+__all__ = [ 'SOBOL_DIM_MAX', 'SOBOL_DIRECTIONS_FILE', 'SobolSequence',
+	'i4_bit_hi1', 'i4_bit_lo0', 'i4_sobol', 'i4_sobol_block',
+	'i4_sobol_directions', 'i4_sobol_generate', 'i4_sobol_scramble',
+	'i4_uniform', 'isprime', 'prime_ge' ]
+
+#
+#	Dimensions 1 to 40 use the direction numbers of Bratley and Fox, higher
+#	dimensions the ones of Joe and Kuo, stored in SOBOL_DIRECTIONS_FILE.
+#
+SOBOL_DIM_MAX = 4096
+SOBOL_DIRECTIONS_FILE = os.path.join ( os.path.dirname ( __file__ ),
+	'sobol_direction_numbers.npz' )
+
+_directions_cache = {}
+_directions_lock = threading.Lock()
+_joe_kuo_table = None
+
 def i4_bit_hi1 ( n ):
 #*****************************************************************************80
 #
@@ -126,6 +150,12 @@ def i4_sobol_generate ( m, n, skip ):
 #
 ## I4_SOBOL_GENERATE generates a Sobol dataset.
 #
+#	Discussion:
+#
+#		The points are computed in a single call to I4_SOBOL_BLOCK rather than
+#		with one call to I4_SOBOL per point.  The result is identical to the
+#		one obtained by calling I4_SOBOL with seeds SKIP-1, ..., SKIP+N-2.
+#
 #	Licensing:
 #
 #		This code is distributed under the GNU LGPL license.
@@ -149,11 +179,377 @@ def i4_sobol_generate ( m, n, skip ):
 #
 #		Output, real R(M,N), the points.
 #
-	r=zeros((m,n))
-	for j in range (1, n+1):
-		seed = skip + j - 2
-		[ r[0:m,j-1], seed ] = i4_sobol ( m, seed )
-	return r
+	r = zeros ( ( n, m ) )
+#
+#	Negative seeds are treated as 0, as in I4_SOBOL.
+#
+	seed = skip - 1
+	nzero = 0
+	if ( seed < 0 ):
+		nzero = n if ( n < -seed ) else -seed
+		seed = 0
+	r[nzero:n,:] = i4_sobol_block ( m, seed, n - nzero )
+	return transpose ( r )
+def i4_sobol_directions ( dim_num ):
+#*****************************************************************************80
+#
+## I4_SOBOL_DIRECTIONS returns the direction numbers of the Sobol sequence.
+#
+#	Discussion:
+#
+#		This is the table V used by I4_SOBOL, computed in integer arithmetic
+#		and with its columns already multiplied by the appropriate power of 2,
+#		so that point SEED of the sequence is the XOR of the columns of V
+#		selected by the bits of the Gray code of SEED, times RECIPD.
+#
+#		The first 40 dimensions are the ones of I4_SOBOL in its original
+#		form.  Dimensions 41 to SOBOL_DIM_MAX use the primitive polynomials
+#		and initial direction numbers of Joe and Kuo, skipping the
+#		polynomials already used by the first 40 dimensions.  That table is
+#		only loaded the first time more than 40 dimensions are requested.
+#
+#	Reference:
+#
+#		Stephen Joe, Frances Kuo,
+#		Constructing Sobol sequences with better two-dimensional projections,
+#		SIAM Journal on Scientific Computing,
+#		Volume 30, Number 5, pages 2635-2654, 2008.
+#
+#	Parameters:
+#
+#		Input, integer DIM_NUM, the number of spatial dimensions.
+#		DIM_NUM must satisfy 1 <= DIM_NUM <= SOBOL_DIM_MAX.
+#
+#		Output, integer V(DIM_NUM,MAXCOL), the direction numbers.
+#
+#		Output, real RECIPD, 1/(common denominator of the elements in V).
+#
+#	The tables are computed once per dimension and cached.  The cached V is
+#	read-only, since it is shared by all the callers.
+#
+	with _directions_lock:
+		if ( dim_num not in _directions_cache ):
+			_directions_cache[dim_num] = _i4_sobol_directions ( dim_num )
+		return _directions_cache[dim_num]
+def _i4_sobol_directions ( dim_num ):
+	dim_max = SOBOL_DIM_MAX
+	log_max = 30
+
+	if ( dim_num < 1 or dim_max < dim_num ):
+		raise Exception ( 'I4_SOBOL_DIRECTIONS - Fatal error!\n'
+			'	The spatial dimension DIM_NUM should satisfy:\n'
+			'		1 <= DIM_NUM <= %d\n'
+			'	But this input value is DIM_NUM = %d' % ( dim_max, dim_num ) )
+
+	maxcol = i4_bit_hi1 ( 2**log_max - 1 )
+#
+#	Initialize (part of) V.
+#
+	v = zeros ( ( 40 if dim_num < 40 else dim_num, maxcol ), dtype = int64 )
+	v[0:40,0] = transpose([ \
+		1, 1, 1, 1, 1, 1, 1, 1, 1, 1, \
+		1, 1, 1, 1, 1, 1, 1, 1, 1, 1, \
+		1, 1, 1, 1, 1, 1, 1, 1, 1, 1, \
+		1, 1, 1, 1, 1, 1, 1, 1, 1, 1 ])
+
+	v[2:40,1] = transpose([ \
+		1, 3, 1, 3, 1, 3, 3, 1, \
+		3, 1, 3, 1, 3, 1, 1, 3, 1, 3, \
+		1, 3, 1, 3, 3, 1, 3, 1, 3, 1, \
+		3, 1, 1, 3, 1, 3, 1, 3, 1, 3 ])
+
+	v[3:40,2] = transpose([ \
+		7, 5, 1, 3, 3, 7, 5, \
+		5, 7, 7, 1, 3, 3, 7, 5, 1, 1, \
+		5, 3, 3, 1, 7, 5, 1, 3, 3, 7, \
+		5, 1, 1, 5, 7, 7, 5, 1, 3, 3 ])
+
+	v[5:40,3] = transpose([ \
+		1, 7, 9,13,11, \
+		1, 3, 7, 9, 5,13,13,11, 3,15, \
+		5, 3,15, 7, 9,13, 9, 1,11, 7, \
+		5,15, 1,15,11, 5, 3, 1, 7, 9 ])
+
+	v[7:40,4] = transpose([ \
+		9, 3,27, \
+		15,29,21,23,19,11,25, 7,13,17, \
+		1,25,29, 3,31,11, 5,23,27,19, \
+		21, 5, 1,17,13, 7,15, 9,31, 9 ])
+
+	v[13:40,5] = transpose([ \
+						37,33, 7, 5,11,39,63, \
+	 27,17,15,23,29, 3,21,13,31,25, \
+		9,49,33,19,29,11,19,27,15,25 ])
+
+	v[19:40,6] = transpose([ \
+		13, \
+		33,115, 41, 79, 17, 29,119, 75, 73,105, \
+		7, 59, 65, 21,	3,113, 61, 89, 45,107 ])
+
+	v[37:40,7] = transpose([ \
+		7, 23, 39 ])
+#
+#	Set POLY.
+#
+	poly= [ \
+		1,	 3,	 7,	11,	13,	19,	25,	37,	59,	47, \
+		61,	55,	41,	67,	97,	91, 109, 103, 115, 131, \
+		193, 137, 145, 143, 241, 157, 185, 167, 229, 171, \
+		213, 191, 253, 203, 211, 239, 247, 285, 369, 299 ]
+#
+#	Add the Joe and Kuo dimensions.
+#
+	if ( 40 < dim_num ):
+		[ jk_poly, jk_vinit ] = _joe_kuo_directions ( )
+		v[40:dim_num,0:jk_vinit.shape[1]] = jk_vinit[0:dim_num-40,:]
+		poly = poly + list ( jk_poly[0:dim_num-40] )
+	poly = array ( poly[0:dim_num], dtype = int64 )
+#
+#	Find the degree M of each polynomial from its binary encoding.
+#
+	m = frexp ( poly )[1] - 1
+#
+#	Initialize row 1 of V.
+#
+	v[0,0:maxcol] = 1
+#
+#	Calculate the remaining elements of the other rows as explained
+#	in Bratley and Fox, section 2, one column at a time for all the rows.
+#	The bits of the integer POLY(I) gives the form of polynomial I.
+#
+	for j in range ( 1, maxcol ):
+		i = nonzero ( m <= j )[0]
+		i = i[i > 0]
+		mi = m[i]
+		newv = v[i,j-mi]
+		for k in range ( 1, m.max ( ) + 1 ):
+			includ = ( k <= mi ) & ( ( ( poly[i] >> ( mi - k ) ) & 1 ) == 1 )
+			newv[includ] = newv[includ] ^ ( v[i[includ],j-k] << k )
+		v[i,j] = newv
+#
+#	Multiply columns of V by appropriate power of 2.
+#
+	v = v[0:dim_num,:]
+	l = 1
+	for j in range ( maxcol-1, 0, -1 ):
+		l = 2 * l
+		v[:,j-1] = v[:,j-1] * l
+#
+#	RECIPD is 1/(common denominator of the elements in V).
+#
+	recipd = 1.0 / ( 2 * l )
+	v.flags.writeable = False
+
+	return [ v, recipd ]
+def _joe_kuo_directions ( ):
+#
+#	Lazily load the Joe and Kuo polynomials and initial direction numbers
+#	of dimensions 41 to SOBOL_DIM_MAX.  Called with _directions_lock held.
+#
+	global _joe_kuo_table
+
+	if ( _joe_kuo_table is None ):
+		with load ( SOBOL_DIRECTIONS_FILE ) as table:
+			_joe_kuo_table = [ table['poly'].astype ( int64 ),
+							   table['vinit'].astype ( int64 ) ]
+
+	return _joe_kuo_table
+def i4_sobol_scramble ( v, stream ):
+#*****************************************************************************80
+#
+## I4_SOBOL_SCRAMBLE randomizes the direction numbers of a Sobol sequence.
+#
+#	Discussion:
+#
+#		Each dimension gets a random linear matrix scrambling (a random lower
+#		triangular binary matrix with unit diagonal applied to the binary
+#		digits of the direction numbers) followed by a random digital shift
+#		(an XOR of every point with a random vector).  Both are linear in
+#		the binary digits, so they are applied once to the direction numbers
+#		and the scrambled sequence is generated with the same Gray code
+#		recurrence, starting from SHIFT instead of 0.
+#
+#		Every scrambled sequence is still a (t,s)-sequence, and the points
+#		of two different streams are independent randomizations of it.
+#
+#	Reference:
+#
+#		Jiri Matousek,
+#		On the L2-discrepancy for anchored boxes,
+#		Journal of Complexity,
+#		Volume 14, Number 4, pages 527-556, 1998.
+#
+#	Parameters:
+#
+#		Input, integer V(DIM_NUM,MAXCOL), the direction numbers.
+#
+#		Input, integer STREAM, the seed of the random scrambling.
+#
+#		Output, integer W(DIM_NUM,MAXCOL), the scrambled direction numbers.
+#
+#		Output, integer SHIFT(DIM_NUM), the digital shift.
+#
+	[ dim_num, maxcol ] = v.shape
+	rng = random.RandomState ( stream )
+	allbits = 2**maxcol - 1
+	w = zeros ( ( dim_num, maxcol ), dtype = int64 )
+#
+#	Row I of the scrambling matrix gives digit I (weight 2**(-I-1)) of the
+#	result from digits 0 to I of the input, which sit in the bits above
+#	bit MAXCOL-1-I of the direction numbers.
+#
+	for i in range ( maxcol ):
+		bit = 1 << ( maxcol - 1 - i )
+		row = rng.randint ( 0, 2**maxcol, size = dim_num ).astype ( int64 )
+		row = ( row & ( allbits ^ ( 2 * bit - 1 ) ) ) | bit
+#
+#	The new digit is the parity of the selected input digits.
+#
+		x = v & row[:,newaxis]
+		for s in [ 16, 8, 4, 2, 1 ]:
+			x = x ^ ( x >> s )
+		w = w | ( ( x & 1 ) << ( maxcol - 1 - i ) )
+
+	shift = rng.randint ( 0, 2**maxcol, size = dim_num ).astype ( int64 )
+
+	return [ w, shift ]
+def i4_sobol_block ( dim_num, seed, n ):
+#*****************************************************************************80
+#
+## I4_SOBOL_BLOCK generates N consecutive Sobol vectors in one call.
+#
+#	Parameters:
+#
+#		Input, integer DIM_NUM, the number of spatial dimensions.
+#		DIM_NUM must satisfy 1 <= DIM_NUM <= SOBOL_DIM_MAX.
+#
+#		Input, integer SEED, the index of the first vector, SEED >= 0.
+#
+#		Input, integer N, the number of vectors to generate.
+#
+#		Output, real QUASI(N,DIM_NUM), the vectors with seeds SEED, ...,
+#		SEED+N-1.
+#
+	return SobolSequence ( dim_num, seed ).draw ( n )
+class SobolSequence ( object ):
+#*****************************************************************************80
+#
+## SOBOLSEQUENCE is a stateful generator of the Sobol sequence.
+#
+#	Discussion:
+#
+#		The direction numbers are computed once, when the object is created.
+#		The object then only keeps the integer vector LASTQ of the current
+#		point and its SEED, so that
+#
+#			NEXT()			costs O(DIM_NUM),
+#			DRAW(N)			costs O(N*DIM_NUM), without a Python loop over the points,
+#			SKIP_TO(SEED)	costs O(DIM_NUM*log(SEED)),
+#
+#		independently of how far into the sequence the object already is.
+#		Without STREAM, the points are the same as the ones returned by
+#		I4_SOBOL.  With STREAM, the sequence is scrambled by I4_SOBOL_SCRAMBLE
+#		with STREAM as random seed: different streams are different
+#		randomized Sobol sequences, each one with the low discrepancy of the
+#		original one.
+#
+#	Parameters:
+#
+#		Input, integer DIM_NUM, the number of spatial dimensions.
+#		DIM_NUM must satisfy 1 <= DIM_NUM <= SOBOL_DIM_MAX.
+#
+#		Input, integer SEED, the index of the first vector to generate.
+#
+#		Input, integer STREAM, the random seed of the scrambling, or None
+#		for the original sequence.
+#
+	def __init__ ( self, dim_num, seed = 0, stream = None ):
+		self.dim_num = dim_num
+		self.stream = stream
+		[ self.v, self.recipd ] = i4_sobol_directions ( dim_num )
+		self.maxcol = self.v.shape[1]
+		if ( stream is None ):
+			self.shift = zeros ( dim_num, dtype = int64 )
+		else:
+			[ self.v, self.shift ] = i4_sobol_scramble ( self.v, stream )
+		self.seed = 0
+		self.lastq = self.shift.copy ( )
+		self.skip_to ( seed )
+
+	def skip_to ( self, seed ):
+		'''
+		Positions the sequence so that the next vector has index SEED.
+
+		The vector is computed directly from the Gray code of SEED.
+		'''
+		seed = int ( seed )
+		if ( seed < 0 ):
+			raise Exception ( 'SOBOLSEQUENCE - Fatal error!\n'
+				'	Input SEED = %d < 0!' % seed )
+		self._check ( seed )
+		if ( seed == self.seed ):
+			return
+
+		gray = seed ^ ( seed >> 1 )
+		lastq = self.shift.copy ( )
+		k = 0
+		while ( gray ):
+			if ( gray & 1 ):
+				lastq = lastq ^ self.v[:,k]
+			gray = gray >> 1
+			k = k + 1
+		self.lastq = lastq
+		self.seed = seed
+
+	def fast_forward ( self, n ):
+		'''
+		Skips the next N vectors of the sequence.
+		'''
+		self.skip_to ( self.seed + n )
+
+	def next ( self ):
+		'''
+		Returns the next vector of the sequence, QUASI(DIM_NUM).
+		'''
+		self._check ( self.seed + 1 )
+		quasi = self.lastq * self.recipd
+		l = i4_bit_lo0 ( self.seed )
+		self.lastq = self.lastq ^ self.v[:,l-1]
+		self.seed = self.seed + 1
+		return quasi
+
+	def draw ( self, n ):
+		'''
+		Returns the next N vectors of the sequence, QUASI(N,DIM_NUM).
+
+		Consecutive vectors differ by the column of V given by the position
+		of the low 0 bit of their seed (Antonov and Saleev), so the vectors
+		are a cumulative XOR of the selected columns.
+		'''
+		self._check ( self.seed + n )
+		q = zeros ( ( n + 1, self.dim_num ), dtype = int64 )
+		q[0,:] = self.lastq
+#
+#	The low 0 bit of SEED is the low 1 bit of SEED+1.
+#
+		i = arange ( self.seed + 1, self.seed + n + 1, dtype = int64 )
+		l = frexp ( i & -i )[1] - 1
+		q[1:n+1,:] = self.v[:,l].T
+		q = bitwise_xor.accumulate ( q, axis = 0 )
+
+		self.lastq = q[n,:]
+		self.seed = self.seed + n
+		return q[0:n,:] * self.recipd
+
+	def _check ( self, seed ):
+#
+#	Check that the user is not asking for too many vectors!
+#
+		if ( 2**self.maxcol <= seed ):
+			raise Exception ( 'SOBOLSEQUENCE - Fatal error!\n'
+				'	Too many calls!\n'
+				'	MAXCOL = %d\n'
+				'	SEED = %d' % ( self.maxcol, seed ) )
 def i4_sobol ( dim_num, seed ):
 #*****************************************************************************80
 #
@@ -163,6 +559,11 @@ def i4_sobol ( dim_num, seed ):
 #
 #		The routine adapts the ideas of Antonov and Saleev.
 #
+#		The routine keeps no state between calls, so it can be used from
+#		several threads, and with several dimensions, at the same time.
+#		Each call jumps directly to SEED in O(DIM_NUM*log(SEED)).  Use a
+#		SobolSequence object to generate many consecutive vectors.
+#
 #	Licensing:
 #
 #		This code is distributed under the GNU LGPL license.
@@ -209,7 +610,7 @@ def i4_sobol ( dim_num, seed ):
 #	Parameters:
 #
 #		Input, integer DIM_NUM, the number of spatial dimensions.
-#		DIM_NUM must satisfy 1 <= DIM_NUM <= 40.
+#		DIM_NUM must satisfy 1 <= DIM_NUM <= SOBOL_DIM_MAX.
 #
 #		Input/output, integer SEED, the "seed" for the sequence.
 #		This is essentially the index in the sequence of the quasirandom
@@ -220,212 +621,12 @@ def i4_sobol ( dim_num, seed ):
 #
 #		Output, real QUASI(DIM_NUM), the next quasirandom vector.
 #
-	global atmost
-	global dim_max
-	global dim_num_save
-	global initialized
-	global lastq
-	global log_max
-	global maxcol
-	global poly
-	global recipd
-	global seed_save
-	global v
-
-	if ( not 'initialized' in globals().keys() ):
-		initialized = 0
-		dim_num_save = -1
-
-	if ( not initialized or dim_num != dim_num_save ):
-		initialized = 1
-		dim_max = 40
-		dim_num_save = -1
-		log_max = 30
-		seed_save = -1
-#
-#	Initialize (part of) V.
-#
-		v = zeros((dim_max,log_max))
-		v[0:40,0] = transpose([ \
-			1, 1, 1, 1, 1, 1, 1, 1, 1, 1, \
-			1, 1, 1, 1, 1, 1, 1, 1, 1, 1, \
-			1, 1, 1, 1, 1, 1, 1, 1, 1, 1, \
-			1, 1, 1, 1, 1, 1, 1, 1, 1, 1 ])
-
-		v[2:40,1] = transpose([ \
-			1, 3, 1, 3, 1, 3, 3, 1, \
-			3, 1, 3, 1, 3, 1, 1, 3, 1, 3, \
-			1, 3, 1, 3, 3, 1, 3, 1, 3, 1, \
-			3, 1, 1, 3, 1, 3, 1, 3, 1, 3 ])
-
-		v[3:40,2] = transpose([ \
-			7, 5, 1, 3, 3, 7, 5, \
-			5, 7, 7, 1, 3, 3, 7, 5, 1, 1, \
-			5, 3, 3, 1, 7, 5, 1, 3, 3, 7, \
-			5, 1, 1, 5, 7, 7, 5, 1, 3, 3 ])
-
-		v[5:40,3] = transpose([ \
-			1, 7, 9,13,11, \
-			1, 3, 7, 9, 5,13,13,11, 3,15, \
-			5, 3,15, 7, 9,13, 9, 1,11, 7, \
-			5,15, 1,15,11, 5, 3, 1, 7, 9 ])
-
-		v[7:40,4] = transpose([ \
-			9, 3,27, \
-			15,29,21,23,19,11,25, 7,13,17, \
-			1,25,29, 3,31,11, 5,23,27,19, \
-			21, 5, 1,17,13, 7,15, 9,31, 9 ])
-
-		v[13:40,5] = transpose([ \
-							37,33, 7, 5,11,39,63, \
-		 27,17,15,23,29, 3,21,13,31,25, \
-			9,49,33,19,29,11,19,27,15,25 ])
-
-		v[19:40,6] = transpose([ \
-			13, \
-			33,115, 41, 79, 17, 29,119, 75, 73,105, \
-			7, 59, 65, 21,	3,113, 61, 89, 45,107 ])
-
-		v[37:40,7] = transpose([ \
-			7, 23, 39 ])
-#
-#	Set POLY.
-#
-		poly= [ \
-			1,	 3,	 7,	11,	13,	19,	25,	37,	59,	47, \
-			61,	55,	41,	67,	97,	91, 109, 103, 115, 131, \
-			193, 137, 145, 143, 241, 157, 185, 167, 229, 171, \
-			213, 191, 253, 203, 211, 239, 247, 285, 369, 299 ]
-
-		atmost = 2**log_max - 1
-#
-#	Find the number of bits in ATMOST.
-#
-		maxcol = i4_bit_hi1 ( atmost )
-#
-#	Initialize row 1 of V.
-#
-		v[0,0:maxcol] = 1
-
-#
-#	Things to do only if the dimension changed.
-#
-	if ( dim_num != dim_num_save ):
-#
-#	Check parameters.
-#
-		if ( dim_num < 1 or dim_max < dim_num ):
-			print('I4_SOBOL - Fatal error!')
-			print( '	The spatial dimension DIM_NUM should satisfy:')
-			print( '		1 <= DIM_NUM <= %d'%dim_max)
-			print( '	But this input value is DIM_NUM = %d'%dim_num)
-			return
-
-		dim_num_save = dim_num
-#
-#	Initialize the remaining rows of V.
-#
-		for i in range(2 , dim_num+1):
-#
-#	The bits of the integer POLY(I) gives the form of polynomial I.
-#
-#	Find the degree of polynomial I from binary encoding.
-#
-			j = poly[i-1]
-			m = 0
-			while ( 1 ):
-				j = math.floor ( j / 2. )
-				if ( j <= 0 ):
-					break
-				m = m + 1
-#
-#	Expand this bit pattern to separate components of the logical array INCLUD.
-#
-			j = poly[i-1]
-			includ=zeros(m)
-			for k in range(m, 0, -1):
-				j2 = math.floor ( j / 2. )
-				includ[k-1] =  (j != 2 * j2 )
-				j = j2
-#
-#	Calculate the remaining elements of row I as explained
-#	in Bratley and Fox, section 2.
-#
-			for j in range( m+1, maxcol+1 ):
-				newv = v[i-1,j-m-1]
-				l = 1
-				for k in range(1, m+1):
-					l = 2 * l
-					if ( includ[k-1] ):
-						newv = bitwise_xor ( int(newv), int(l * v[i-1,j-k-1]) )
-				v[i-1,j-1] = newv
-#
-#	Multiply columns of V by appropriate power of 2.
-#
-		l = 1
-		for j in range( maxcol-1, 0, -1):
-			l = 2 * l
-			v[0:dim_num,j-1] = v[0:dim_num,j-1] * l
-#
-#	RECIPD is 1/(common denominator of the elements in V).
-#
-		recipd = 1.0 / ( 2 * l )
-		lastq=zeros(dim_num)
-
-	seed = int(math.floor ( seed ))
+	seed = int ( math.floor ( seed ) )
 
 	if ( seed < 0 ):
 		seed = 0
 
-	if ( seed == 0 ):
-		l = 1
-		lastq=zeros(dim_num)
-
-	elif ( seed == seed_save + 1 ):
-#
-#	Find the position of the right-hand zero in SEED.
-#
-		l = i4_bit_lo0 ( seed )
-
-	elif ( seed <= seed_save ):
-
-		seed_save = 0
-		l = 1
-		lastq=zeros(dim_num)
-
-		for seed_temp in range( int(seed_save), int(seed)):
-			l = i4_bit_lo0 ( seed_temp )
-			for i in range(1 , dim_num+1):
-				lastq[i-1] = bitwise_xor ( int(lastq[i-1]), int(v[i-1,l-1]) )
-
-		l = i4_bit_lo0 ( seed )
-
-	elif ( seed_save + 1 < seed ):
-
-		for seed_temp in range( int(seed_save + 1), int(seed) ):
-			l = i4_bit_lo0 ( seed_temp )
-			for i in range(1, dim_num+1):
-				lastq[i-1] = bitwise_xor ( int(lastq[i-1]), int(v[i-1,l-1]) )
-
-		l = i4_bit_lo0 ( seed )
-#
-#	Check that the user is not calling too many times!
-#
-	if ( maxcol < l ):
-		print( 'I4_SOBOL - Fatal error!')
-		print( '	Too many calls!')
-		print( '	MAXCOL = %d\n'%maxcol)
-		print( '	L =			%d\n'%l)
-		return
-#
-#	Calculate the new components of QUASI.
-#
-	quasi=zeros(dim_num)
-	for i in range( 1, dim_num+1):
-		quasi[i-1] = lastq[i-1] * recipd
-		lastq[i-1] = bitwise_xor ( int(lastq[i-1]), int(v[i-1,l-1]) )
-
-	seed_save = seed
+	quasi = SobolSequence ( dim_num, seed ).next ( )
 	seed = seed + 1
 
 	return [ quasi, seed ]
@@ -90,3 +90,51 @@ def slice_sample(init_x, logprob, sigma=1.0, step_out=True, max_steps_out=1000,
         direction = npr.randn(dims)
         direction = direction / np.sqrt(np.sum(direction**2))
         return direction_slice(direction, init_x)
+
+def batch_minimize(func, init_x, lower, upper, max_iters=200, xtol=1e-6,
+                   ftol=1e-9, init_step=0.05):
+    # Minimize M independent functions of D bound-constrained variables at
+    # once by projected gradient descent with Barzilai-Borwein steps.
+    #
+    # func(x) takes a MxD matrix and returns the M function values and the
+    # MxD gradients, the i-th ones depending on row i only. Every row has
+    # its own step size, backtracking and convergence test, so the rows are
+    # optimized exactly as if they were separate problems, but with one
+    # vectorized evaluation of func per iteration for the rows still active.
+    x      = np.clip(np.array(init_x, dtype=float), lower, upper)
+    (f, g) = func(x)
+    step   = init_step / np.maximum(np.max(np.abs(g), axis=1), 1e-300)
+    active = np.ones(x.shape[0], dtype=bool)
+
+    for it in range(max_iters):
+        idx = np.nonzero(active)[0]
+        if idx.shape[0] == 0:
+            break
+
+        new_x = np.clip(x[idx] - step[idx,np.newaxis]*g[idx], lower, upper)
+        (new_f, new_g) = func(new_x)
+
+        s  = new_x - x[idx]
+        ok = new_f <= f[idx] + 1e-4*np.sum(g[idx]*s, axis=1)
+
+        # Backtrack the rows without sufficient decrease.
+        rej = idx[~ok]
+        step[rej] *= 0.5
+        active[rej] = np.max(np.abs(s[~ok]), axis=1) > xtol
+
+        # Take the step for the others, and guess the next step size from
+        # the change in gradient.
+        acc   = idx[ok]
+        s     = s[ok]
+        y     = new_g[ok] - g[acc]
+        sy    = np.sum(s*y, axis=1)
+        ss    = np.sum(s*s, axis=1)
+        df    = f[acc] - new_f[ok]
+        x[acc] = new_x[ok]
+        f[acc] = new_f[ok]
+        g[acc] = new_g[ok]
+        step[acc] = np.where(sy > 0, ss / np.where(sy > 0, sy, 1), 2*step[acc])
+        active[acc] = ((np.max(np.abs(s), axis=1) > xtol) &
+                       (df > ftol*np.maximum(np.abs(f[acc]), 1e-300)))
+
+    return x, f
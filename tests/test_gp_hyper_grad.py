@@ -0,0 +1,66 @@
+"""
+Gradient checks of the hyperparameter objective of gp.GP against finite
+differences, for the exact (Cholesky) and the iterative ("cg") solvers, and
+checks of the likelihoods without an analytic gradient (the sparse FITC one
+and gp.EigLikelihood) against the exact one.  Run from the repository root:
+
+    python -m pytest tests
+"""
+import numpy as np
+
+from minimint import gp
+
+def problem(N, D=3, seed=0):
+    # A small random problem, and log hyperparameters away from the bounds
+    # of optimize_hypers.
+    rs   = np.random.RandomState(seed)
+    comp = rs.rand(N, D)
+    vals = np.sin(3*comp).sum(1) + 0.1*rs.randn(N)
+
+    mygp = gp.GP('Matern52')
+    mygp.real_init(D, vals)
+    hypers = np.hstack((np.log(mygp.amp2), np.log(0.01),
+                        np.log(0.5 + rs.rand(D))))
+    return mygp, comp, vals, hypers
+
+def relative_grad_error(mygp, comp, vals, hypers, solver='cholesky'):
+    grad = mygp.hyper_objective(comp, vals, solver=solver)[1](hypers)
+    return (mygp.check_grad_hypers(comp, vals, hypers, solver) /
+            np.sqrt(np.sum(grad**2)))
+
+def test_exact_grad():
+    for seed in range(3):
+        (mygp, comp, vals, hypers) = problem(40, seed=seed)
+        assert relative_grad_error(mygp, comp, vals, hypers) < 1e-4
+
+def test_iterative_grad():
+    # Below the rank of the preconditioner, the traces are exact.
+    (mygp, comp, vals, hypers) = problem(40)
+    assert relative_grad_error(mygp, comp, vals, hypers, 'cg') < 1e-4
+
+    # Above it, part of the traces are Hutchinson estimates.
+    (mygp, comp, vals, hypers) = problem(300)
+    assert relative_grad_error(mygp, comp, vals, hypers, 'cg') < 1e-2
+
+def test_iterative_objective():
+    (mygp, comp, vals, hypers) = problem(300)
+    exact     = mygp.hyper_objective(comp, vals)
+    iterative = mygp.hyper_objective(comp, vals, solver='cg')
+    assert abs(exact[0](hypers) - iterative[0](hypers)) < 1e-2*abs(exact[0](hypers))
+
+def test_fitc_objective():
+    # With all the points as inducing points, FITC is the exact GP.
+    (mygp, comp, vals, hypers) = problem(40)
+    exact  = mygp.hyper_objective(comp, vals)
+    sparse = mygp.hyper_objective(comp, vals, inducing=comp)
+    assert sparse[1] is None
+    assert abs(exact[0](hypers) - sparse[0](hypers)) < 1e-5
+
+def test_eig_likelihood():
+    (mygp, comp, vals, hypers) = problem(40)
+    ls  = np.exp(hypers[2:])
+    lik = gp.EigLikelihood(mygp.cov_func(ls, comp, None) +
+                           1e-6*np.eye(comp.shape[0]), vals)
+    exact = mygp.hyper_objective(comp, vals)[0](hypers)
+    assert abs(lik(np.mean(vals), np.exp(hypers[0]), np.exp(hypers[1])) +
+               exact) < 1e-8
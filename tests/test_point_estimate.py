@@ -0,0 +1,76 @@
+"""
+Checks that the choosers in point-estimate mode (mcmc_iters == 0) start
+each hyperparameter fit from the optimum of the previous one, and that the
+Cholesky factor of the complete points is only kept across proposals for a
+point estimate that is not refitted.  Run from the repository root:
+
+    python -m pytest tests
+"""
+import numpy as np
+
+from minimint import gp
+from minimint.chooser.GPEIChooser import GPEIChooser
+from minimint.chooser.GPEIOptChooser import GPEIOptChooser
+
+def proposals(chooser, monkeypatch, N=30, M=50, D=3):
+    # Two consecutive proposals, the second one with one more complete
+    # point. Returns the init of each fit and the chooser's
+    # hyperparameters after each of them.
+    inits = []
+    optimize_hypers = gp.GP.optimize_hypers
+    def recorded(self, comp, vals, init=None, **kwargs):
+        inits.append(init)
+        return optimize_hypers(self, comp, vals, init=init, **kwargs)
+    monkeypatch.setattr(gp.GP, 'optimize_hypers', recorded)
+
+    rs     = np.random.RandomState(0)
+    grid   = rs.rand(N + 1 + M, D)
+    values = np.sin(3*grid).sum(1)
+    cand   = np.arange(N + 1, N + 1 + M)
+    fits   = []
+    for n in (N, N + 1):
+        chooser.next(grid, values, None, cand, np.arange(0), np.arange(n))
+        fits.append((chooser.amp2, chooser.noise, chooser.ls.copy()))
+    return inits, fits
+
+def check_warm_start(inits, fits):
+    assert len(inits) == 2
+    (amp2, noise, ls) = inits[1]
+    assert amp2 == fits[0][0] and noise == fits[0][1]
+    assert np.array_equal(ls, fits[0][2])
+
+def test_gpei_warm_start(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    check_warm_start(*proposals(GPEIChooser(mcmc_iters=0), monkeypatch))
+
+def test_gpeiopt_warm_start(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    chooser = GPEIOptChooser(mcmc_iters=0, grid_subset=2,
+                             use_multiprocessing=False)
+    check_warm_start(*proposals(chooser, monkeypatch))
+
+def test_refit_every_extends_cholesky(monkeypatch, tmp_path):
+    # Between refits the point estimate is kept, so the second proposal
+    # extends the cached factor with the new point instead of refactoring.
+    monkeypatch.chdir(tmp_path)
+    extends = []
+    chol_extend = gp.chol_extend
+    def recorded(chol, cross, kappa):
+        extends.append(kappa.shape[0])
+        return chol_extend(chol, cross, kappa)
+    monkeypatch.setattr(gp, 'chol_extend', recorded)
+
+    chooser = GPEIChooser(mcmc_iters=0, refit_every=2)
+    (inits, fits) = proposals(chooser, monkeypatch)
+    assert len(inits) == 1 and extends == [1]
+    assert len(chooser.chol_cache.entries) == 1
+
+def test_chol_cache_released():
+    chooser = GPEIChooser(mcmc_iters=2)
+    chooser.burn_in_mcmc_iters = 2
+    rs     = np.random.RandomState(0)
+    grid   = rs.rand(60, 3)
+    values = np.sin(3*grid).sum(1)
+    chooser.next(grid, values, None, np.arange(30, 60), np.arange(0),
+                 np.arange(30))
+    assert len(chooser.chol_cache.entries) == 0